@@ -3,8 +3,36 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
+from app.database import upgrade_schema
+from app.middleware.compression import JSONCompressionMiddleware
+from app.middleware.rate_limit import RateLimitMiddleware, create_bucket_store
 from app.routes.video_routes import video_router
 from app.routes.auth_routes import auth_router
+from app.services.broker import connect_broker, disconnect_broker
+from app.services.mail_service import warm_mail_templates
+from app.services.mail_worker import start_mail_worker, stop_mail_worker
+from app.services.scheduler import (
+    register_job,
+    start_scheduler,
+    stop_scheduler,
+)
+from app.services.search_service import init_search_index
+from app.services.stats_service import reconcile_user_stats_job
+from app.services.storage_gc import collect_garbage_job
+from app.services.tiering import demote_cold_videos_job, flush_accesses_job
+from app.settings import (
+    ACCESS_FLUSH_INTERVAL,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MIN_SIZE,
+    GC_INTERVAL,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_MAX_KEYS,
+    RATE_LIMIT_REDIS_URL,
+    RATE_LIMIT_TRUST_PROXY,
+    SECRET_KEY,
+    STATS_RECONCILE_INTERVAL,
+    TIER_INTERVAL,
+)
 
 
 def create_app() -> FastAPI:
@@ -13,10 +41,34 @@ def create_app() -> FastAPI:
 
     Returns:
         FastAPI: The FastAPI app.
+
+    Raises:
+        RuntimeError: If SECRET_KEY is not set.
     """
+    if not SECRET_KEY:
+        raise RuntimeError("SECRET_KEY must be set to sign sessions")
+
     # Create the FastAPI app
     app = FastAPI()
 
+    # Compress large JSON responses
+    app.add_middleware(
+        JSONCompressionMiddleware,
+        minimum_size=COMPRESSION_MIN_SIZE,
+        level=COMPRESSION_LEVEL,
+    )
+
+    # Shed bursts on the auth and mail endpoints, inside CORS so that
+    # browsers can read the 429
+    if RATE_LIMIT_ENABLED:
+        app.add_middleware(
+            RateLimitMiddleware,
+            store=create_bucket_store(
+                RATE_LIMIT_REDIS_URL, RATE_LIMIT_MAX_KEYS
+            ),
+            trust_proxy=RATE_LIMIT_TRUST_PROXY,
+        )
+
     # Initialize CORS
     app.add_middleware(
         CORSMiddleware,
@@ -30,6 +82,26 @@ def create_app() -> FastAPI:
     app.include_router(video_router)
     app.include_router(auth_router)
 
-    app.add_middleware(SessionMiddleware, secret_key="")
+    app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+
+    # Schedule maintenance jobs
+    register_job(
+        "reconcile-user-stats",
+        STATS_RECONCILE_INTERVAL,
+        reconcile_user_stats_job,
+    )
+    register_job("collect-garbage", GC_INTERVAL, collect_garbage_job)
+    register_job("flush-accesses", ACCESS_FLUSH_INTERVAL, flush_accesses_job)
+    register_job("demote-cold-videos", TIER_INTERVAL, demote_cold_videos_job)
+    app.add_event_handler("startup", upgrade_schema)
+    app.add_event_handler("startup", init_search_index)
+    app.add_event_handler("startup", warm_mail_templates)
+    app.add_event_handler("startup", start_scheduler)
+    app.add_event_handler("startup", connect_broker)
+    app.add_event_handler("startup", start_mail_worker)
+    app.add_event_handler("shutdown", stop_scheduler)
+    app.add_event_handler("shutdown", flush_accesses_job)
+    app.add_event_handler("shutdown", disconnect_broker)
+    app.add_event_handler("shutdown", stop_mail_worker)
 
     return app
@@ -1,5 +1,8 @@
 """ Database setup and connection """
-from sqlalchemy import create_engine
+import threading
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -20,12 +23,80 @@ else:
     DB_URL = f"sqlite:///./{DB_NAME}.db"
     engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
 
+    @event.listens_for(engine, "connect")
+    def _enable_foreign_keys(dbapi_connection, _connection_record):
+        """Enforces foreign keys and their cascades, off by default."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 # Create all Tables
 Base = declarative_base()
 
 # Setup SessionLocal
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Columns added to tables that already existed, as (table, column, SQL
+# default). `create_all` never alters an existing table, so
+# `upgrade_schema` adds them to databases created before them
+SCHEMA_UPGRADES: list[tuple[str, str, str | None]] = [
+    ("videos", "storage_bytes", "0"),
+    ("videos", "content_digest", None),
+    ("videos", "merge_claimed_until", None),
+    ("videos", "published_key", None),
+    ("videos", "chunks_reclaimed", "0"),
+    ("videos", "storage_tier", "'hot'"),
+    ("videos", "last_accessed_date", None),
+    ("videos", "tier_claimed_until", None),
+]
+
+_schema_lock = threading.Lock()
+_schema_upgraded = False
+
+
+def upgrade_schema() -> None:
+    """
+    Adds the columns of SCHEMA_UPGRADES missing from the database. Safe to
+    run from several processes at once, and only inspects the database
+    once per process.
+    """
+    global _schema_upgraded  # pylint: disable=global-statement
+    if _schema_upgraded:
+        return
+
+    with _schema_lock:
+        if _schema_upgraded:
+            return
+
+        inspector = inspect(engine)
+        for table_name, column_name, default in SCHEMA_UPGRADES:
+            table = Base.metadata.tables.get(table_name)
+            if table is None or not inspector.has_table(table_name):
+                continue
+            columns = inspector.get_columns(table_name)
+            if column_name in {column["name"] for column in columns}:
+                continue
+
+            column = table.c[column_name]
+            ddl = (
+                f"ALTER TABLE {table_name} ADD COLUMN {column_name} "
+                f"{column.type.compile(dialect=engine.dialect)}"
+            )
+            if default is not None:
+                ddl += f" DEFAULT {default}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(ddl))
+            except DBAPIError:
+                # Another process may have added it in the meantime
+                columns = inspect(engine).get_columns(table_name)
+                if column_name not in {column["name"] for column in columns}:
+                    raise
+
+        _schema_upgraded = True
+
 
 # Connect db session
 def get_db() -> SessionLocal:
@@ -36,6 +107,7 @@ def get_db() -> SessionLocal:
         SessionLocal: The database session
     """
     Base.metadata.create_all(bind=engine)
+    upgrade_schema()
     db = SessionLocal()
     try:
         yield db
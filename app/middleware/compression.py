@@ -0,0 +1,86 @@
+""" Response compression for the dynamic JSON endpoints. """
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.services.compression import (
+    available_encodings,
+    compress_data,
+    parse_accept_encoding,
+)
+
+
+class JSONCompressionMiddleware:
+    """
+    Compresses JSON responses larger than a threshold with the best
+    encoding the client accepts.
+
+    Only complete `application/json` bodies are compressed; file and
+    streaming responses pass through untouched, so range requests on media
+    keep working.
+    """
+
+    def __init__(
+        self, app: ASGIApp, minimum_size: int = 1024, level: int = 5
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = parse_accept_encoding(
+            Headers(scope=scope).get("accept-encoding", "")
+        )
+        encoding = next(
+            (
+                encoding
+                for encoding in available_encodings()
+                if encoding in accepted
+            ),
+            None,
+        )
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if headers.get("content-type", "").startswith(
+                    "application/json"
+                ) and "content-encoding" not in headers:
+                    # Hold the headers back until the body size is known
+                    start_message = message
+                    return
+                await send(message)
+                return
+
+            if start_message is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            pending, start_message = start_message, None
+
+            # Streamed or small bodies are sent as they are
+            if message.get("more_body") or len(body) < self.minimum_size:
+                await send(pending)
+                await send(message)
+                return
+
+            body = compress_data(body, encoding, self.level)
+            headers = MutableHeaders(raw=pending["headers"])
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(pending)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,370 @@
+""" Token-bucket rate limiting for the expensive auth and mail endpoints. """
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # pragma: no cover - redis is optional
+    aioredis = None
+
+# Bodies read to find the username of a limited request
+MAX_INSPECTED_BODY = 16 * 1024
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """A bucket refilled with `rate` tokens per second, holding `burst`."""
+
+    rate: float
+    burst: int
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """
+    The limits of an endpoint, per client IP and per value of a request
+    field such as the username.
+
+    `field` is read from the query string, or from the JSON body when
+    `in_body` is set.
+    """
+
+    method: str
+    path: re.Pattern
+    per_ip: RateLimit
+    per_field: RateLimit | None = None
+    field: str | None = None
+    in_body: bool = False
+
+
+def per_minute(count: int) -> RateLimit:
+    """
+    Returns a limit of `count` requests per minute, all usable at once.
+
+    Args:
+        count (int): The number of requests.
+
+    Returns:
+        RateLimit: The limit.
+    """
+    return RateLimit(rate=count / 60, burst=count)
+
+
+DEFAULT_RULES = (
+    RateLimitRule(
+        "POST",
+        re.compile(r"/login/?"),
+        per_ip=per_minute(20),
+        per_field=per_minute(5),
+        field="username",
+        in_body=True,
+    ),
+    RateLimitRule(
+        "POST",
+        re.compile(r"/get-signup-otp/?"),
+        per_ip=per_minute(5),
+        per_field=per_minute(3),
+        field="username",
+        in_body=True,
+    ),
+    RateLimitRule(
+        "POST",
+        re.compile(r"/request-otp/?"),
+        per_ip=per_minute(5),
+        per_field=per_minute(3),
+        field="username",
+    ),
+    RateLimitRule(
+        "POST",
+        re.compile(r"/send-email/[^/]+/?"),
+        per_ip=per_minute(10),
+        per_field=per_minute(3),
+        field="recipient",
+    ),
+)
+
+
+class MemoryBucketStore:
+    """
+    Token buckets kept in this process, evicting the least recently used
+    ones beyond `max_keys`.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> [tokens, last refill time]
+        self._buckets: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        """
+        Takes a token from a bucket.
+
+        Args:
+            key (str): The key of the bucket.
+            limit (RateLimit): The limit of the bucket.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the number of seconds
+                until one is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(limit.burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(
+                    limit.burst, bucket[0] + (now - bucket[1]) * limit.rate
+                )
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / limit.rate
+
+
+class RedisBucketStore:
+    """
+    Token buckets shared by every worker through Redis. The refill and take
+    run in one script, so concurrent workers can't overdraw a bucket.
+    """
+
+    SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+    local last = tonumber(redis.call('HGET', KEYS[1], 'l') or ARGV[3])
+    local now = tonumber(ARGV[3])
+    tokens = math.min(tonumber(ARGV[2]), tokens + (now - last) * ARGV[1])
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / ARGV[1]
+    end
+    redis.call('HSET', KEYS[1], 't', tokens, 'l', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(ARGV[2] / ARGV[1]) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str, prefix: str = "helpmeout:ratelimit:"):
+        self.client = aioredis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(self.SCRIPT)
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        """
+        Takes a token from a bucket.
+
+        Args:
+            key (str): The key of the bucket.
+            limit (RateLimit): The limit of the bucket.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the number of seconds
+                until one is available.
+        """
+        wait = await self._take(
+            keys=[self.prefix + key],
+            args=[limit.rate, limit.burst, time.time()],
+        )
+        return float(wait)
+
+
+def create_bucket_store(redis_url: str | None = None, max_keys: int = 100_000):
+    """
+    Returns the shared Redis store when a URL is configured and redis is
+    installed, otherwise an in-memory store.
+
+    Args:
+        redis_url (str | None, optional): The URL of the Redis server.
+        max_keys (int, optional): The size of the in-memory store.
+
+    Returns:
+        MemoryBucketStore | RedisBucketStore: The store.
+    """
+    if redis_url:
+        if aioredis is not None:
+            return RedisBucketStore(redis_url)
+        print("RATE_LIMIT_REDIS_URL is set but redis is not installed.")
+
+    return MemoryBucketStore(max_keys)
+
+
+class RateLimitMiddleware:
+    """
+    Rejects requests over their limits with a 429 before they reach the
+    routes, so a burst costs no database query, hashing or mail.
+
+    Only the requests matching a rule are inspected; a JSON body is read
+    only for rules keyed on a body field, and then replayed to the
+    application. Such bodies are rejected with a 413 past
+    `MAX_INSPECTED_BODY` bytes, so padding can't hide the field.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        store=None,
+        rules: tuple[RateLimitRule, ...] = DEFAULT_RULES,
+        trust_proxy: bool = False,
+    ) -> None:
+        self.app = app
+        self.store = store or MemoryBucketStore()
+        self.rules = rules
+        self.trust_proxy = trust_proxy
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rule = next(
+            (
+                rule
+                for rule in self.rules
+                if rule.method == scope["method"]
+                and rule.path.fullmatch(scope["path"])
+            ),
+            None,
+        )
+        if not rule:
+            await self.app(scope, receive, send)
+            return
+
+        name = rule.path.pattern
+        wait = await self.store.take(
+            f"{name}|ip|{self._client_ip(scope)}", rule.per_ip
+        )
+
+        if not wait and rule.per_field:
+            if rule.in_body:
+                body, more_body = await self._read_body(receive)
+                if more_body or len(body) > MAX_INSPECTED_BODY:
+                    await self._reject(
+                        send, 413, "Request body is too large."
+                    )
+                    return
+                receive = self._replay(body, more_body, receive)
+                value = self._body_field(body, rule.field)
+            else:
+                value = parse_qs(scope["query_string"].decode("latin-1")).get(
+                    rule.field, [None]
+                )[0]
+
+            if value:
+                wait = await self.store.take(
+                    f"{name}|{rule.field}|{str(value).lower()}",
+                    rule.per_field,
+                )
+
+        if wait:
+            await self._reject(
+                send,
+                429,
+                "Too many requests. Please try again later.",
+                [(b"retry-after", str(max(1, round(wait))).encode())],
+            )
+            return
+
+        await self.app(scope, receive, send)
+
+    def _client_ip(self, scope: Scope) -> str:
+        """
+        Returns the address of the client. Behind a trusted proxy, that is
+        the last X-Forwarded-For entry, the one the proxy appended; the
+        earlier ones come from the client and can be forged.
+        """
+        if self.trust_proxy:
+            forwarded = Headers(scope=scope).get("x-forwarded-for")
+            if forwarded:
+                return forwarded.split(",")[-1].strip()
+
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    @staticmethod
+    async def _read_body(receive: Receive) -> tuple[bytes, bool]:
+        """
+        Reads the request body, stopping once it is larger than what is
+        inspected.
+
+        Returns:
+            tuple[bytes, bool]: The body read, and whether more is left.
+        """
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body and size <= MAX_INSPECTED_BODY:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            more_body = message.get("more_body", False)
+
+        return b"".join(chunks), more_body
+
+    @staticmethod
+    def _replay(body: bytes, more_body: bool, receive: Receive) -> Receive:
+        """
+        Returns a receive function replaying the part of the body already
+        read, then passing the rest through.
+        """
+        sent = False
+
+        async def replay() -> Message:
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {
+                "type": "http.request",
+                "body": body,
+                "more_body": more_body,
+            }
+
+        return replay
+
+    @staticmethod
+    def _body_field(body: bytes, field: str) -> str | None:
+        """Returns a field of a JSON body, if any."""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+
+        return data.get(field) if isinstance(data, dict) else None
+
+    @staticmethod
+    async def _reject(
+        send: Send,
+        status: int,
+        detail: str,
+        headers: list[tuple[bytes, bytes]] | None = None,
+    ) -> None:
+        """Sends an error response with a JSON detail."""
+        body = json.dumps({"detail": detail}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    *(headers or []),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,42 @@
+""" The mail models """
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Enum,
+    Integer,
+    String,
+    Text,
+)
+
+from app.database import Base
+
+
+class OutboxMail(Base):
+    """An email waiting in the outbox, or sent from it"""
+
+    __tablename__ = "mail_outbox"
+
+    id: int = Column(Integer, primary_key=True, index=True)
+    # Identifies a message, so enqueuing it twice sends it once
+    dedupe_key: str = Column(String(255), unique=True, nullable=False)
+    recipient: str = Column(String, nullable=False)
+    subject: str = Column(String, nullable=False)
+    template: str = Column(String, nullable=False)
+    # The JSON encoded values of the template variables
+    context: str = Column(Text, nullable=False, default="{}")
+    status: str = Column(
+        Enum("pending", "sent", "failed", name="mail_status"),
+        default="pending",
+        index=True,
+    )
+    attempts: int = Column(Integer, nullable=False, default=0)
+    # Also pushed forward while a worker holds the message
+    next_attempt_at: datetime = Column(
+        DateTime, nullable=False, default=datetime.utcnow
+    )
+    last_error: Optional[str] = Column(Text, nullable=True)
+    created_date: datetime = Column(DateTime, default=datetime.utcnow)
+    sent_date: Optional[datetime] = Column(DateTime, nullable=True)
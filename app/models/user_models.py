@@ -3,7 +3,9 @@ from typing import Optional
 
 from pydantic import BaseModel
 from sqlalchemy import (
+    BigInteger,
     Column,
+    ForeignKey,
     Integer,
     String,
     DateTime,
@@ -36,6 +38,26 @@ class User(Base):
     )
 
 
+class UserStats(Base):
+    """Denormalized per-user video counters and storage totals"""
+
+    __tablename__ = "user_stats"
+
+    username: str = Column(
+        String,
+        ForeignKey(
+            "users.username", ondelete="CASCADE", onupdate="CASCADE"
+        ),
+        primary_key=True,
+    )
+    video_count: int = Column(Integer, nullable=False, default=0)
+    bytes_stored: int = Column(BigInteger, nullable=False, default=0)
+    processing_count: int = Column(Integer, nullable=False, default=0)
+    updated_date: Optional[DateTime] = Column(
+        DateTime, server_default=func.now(), onupdate=func.now()
+    )
+
+
 class UserRequest(BaseModel):
     """The user request model"""
 
@@ -75,3 +97,12 @@ class OtpResponse(BaseModel):
     message: str
     username: Optional[str] = None
     verification_code: Optional[int] = None
+
+
+class UsageResponse(BaseModel):
+    """The storage usage response model"""
+
+    username: str
+    video_count: int
+    bytes_stored: int
+    processing_count: int
@@ -4,6 +4,7 @@ from typing import Optional
 
 from pydantic import BaseModel
 from sqlalchemy import (
+    BigInteger,
     Column,
     Enum,
     String,
@@ -11,6 +12,8 @@ from sqlalchemy import (
     ForeignKey,
     Boolean,
     Float,
+    Integer,
+    LargeBinary,
 )
 from sqlalchemy.orm import relationship
 
@@ -25,7 +28,9 @@ class Video(Base):
     id: str = Column(String, primary_key=True, unique=True, nullable=False)
     username: str = Column(
         String,
-        ForeignKey("users.username", ondelete="CASCADE"),
+        ForeignKey(
+            "users.username", ondelete="CASCADE", onupdate="CASCADE"
+        ),
         nullable=False,
     )
     title: str = Column(String, nullable=False)
@@ -35,6 +40,9 @@ class Video(Base):
     thumbnail_location: Optional[str] = Column(String, nullable=True)
     transcript_location: Optional[str] = Column(String, nullable=True)
     video_length: Optional[int] = Column(Float, nullable=True)
+    storage_bytes: int = Column(BigInteger, nullable=False, default=0)
+    # SHA-256 of the merged recording, for ETags and deduplication
+    content_digest: Optional[str] = Column(String(64), nullable=True)
     status: str = Column(
         Enum(
             "processing",
@@ -44,12 +52,74 @@ class Video(Base):
         ),
         default="processing",
     )
+    # "cold" videos were re-encoded and moved to COLD_VIDEO_DIR
+    storage_tier: str = Column(
+        Enum("hot", "cold", name="storage_tier"),
+        nullable=False,
+        default="hot",
+    )
+    # Flushed from memory every ACCESS_FLUSH_INTERVAL, so slightly behind
+    last_accessed_date: Optional[datetime] = Column(DateTime, nullable=True)
+    # Set once the chunks of the merged video are deleted, so the GC job
+    # stops looking for them
+    chunks_reclaimed: bool = Column(Boolean, nullable=False, default=False)
+    # Key of the original file in the storage backend once it is uploaded
+    published_key: Optional[str] = Column(String, nullable=True)
+    # Set while the chunks are merged, so no other request merges them
+    merge_claimed_until: Optional[datetime] = Column(DateTime, nullable=True)
+    # Set while a tiering run re-encodes the video, so no other run does
+    tier_claimed_until: Optional[datetime] = Column(DateTime, nullable=True)
     is_public: bool = Column(Boolean, default=True)
     pa_expiry_date: Optional[datetime] = Column(DateTime, nullable=True)
 
     user = relationship("User", backref="videos")
 
 
+class TranscriptIndex(Base):
+    """The word timings of an indexed transcript"""
+
+    __tablename__ = "transcript_index"
+
+    video_id: str = Column(
+        String,
+        ForeignKey("videos.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    # Packed float32 (start, end) pairs, one per indexed word position
+    word_times: bytes = Column(LargeBinary, nullable=False)
+
+
+class SearchDocument(Base):
+    """The stable integer key of a video in the full-text indexes"""
+
+    __tablename__ = "search_documents"
+
+    # The rowid of the video in the SQLite FTS tables
+    id: int = Column(Integer, primary_key=True)
+    video_id: str = Column(
+        String,
+        ForeignKey("videos.id", ondelete="CASCADE"),
+        unique=True,
+        nullable=False,
+    )
+
+
+class VideoChunk(Base):
+    """The manifest entry of an uploaded chunk"""
+
+    __tablename__ = "video_chunks"
+
+    video_id: str = Column(
+        String,
+        ForeignKey("videos.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    blob_index: int = Column(Integer, primary_key=True, autoincrement=False)
+    size: int = Column(BigInteger, nullable=False)
+    # "<algorithm>:<hex digest>" of the chunk, e.g. "crc32:1c291ca3"
+    digest: str = Column(String(80), nullable=False)
+
+
 class VideoBlob(BaseModel):
     """The video blob model"""
 
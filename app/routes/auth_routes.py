@@ -1,9 +1,7 @@
 """ This module contains the routes for user authentication. """
 
 import random
-import bcrypt
 from fastapi import (
-    BackgroundTasks,
     Depends,
     HTTPException,
     APIRouter,
@@ -21,11 +19,14 @@ from app.models.user_models import (
     UserRequest,
     OtpResponse,
 )
-from app.services.mail_service import send_otp, send_welcome_mail
-from app.services.services import (
-    hash_password,
-    get_otp,
+from app.services.mail_service import queue_otp, queue_welcome_mail
+from app.services.passwords import (
+    check_password_async,
+    hash_password_async,
+    needs_rehash,
 )
+from app.services.services import get_otp
+from app.services.users import is_anonymous_credential, rename_user
 from app.settings import (
     GOOGLE_CLIENT_ID,
     GOOGLE_CLIENT_SECRET,
@@ -65,12 +66,13 @@ async def get_signup_otp(
     ):
         raise HTTPException(status_code=409, detail="Username already exists.")
 
+    if not user.email:
+        raise HTTPException(status_code=400, detail="Email is required.")
+
     otp = get_otp()
 
-    try:
-        send_otp(recipient_address=user.email, otp=otp, subject="SIGNUP OTP")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Failed to send mail")
+    # The mail worker sends it, the request only queues it
+    queue_otp(db, recipient_address=user.email, otp=otp, subject="SIGNUP OTP")
 
     return OtpResponse(
         status_code=200,
@@ -82,14 +84,12 @@ async def get_signup_otp(
 
 @auth_router.post("/signup/", response_model=UserResponse)
 async def signup_user(
-    background_tasks: BackgroundTasks,
     user: UserAuthentication, db: Session = Depends(get_db)
 ) -> UserResponse:
     """
     Registers a new user. Registration is not case sensitive.
 
     Args:
-        background_tasks (BackgroundTasks): The background tasks object.
         user (UserAuthentication): The user authentication data.
         db (Session, optional): The db session. Defaults to Depends(get_db).
 
@@ -105,8 +105,8 @@ async def signup_user(
     ):
         raise HTTPException(status_code=409, detail="Username exists already.")
 
-    # converting password to array of bytes
-    hashed_password = hash_password(user.password)
+    # Hash the password off the event loop
+    hashed_password = await hash_password_async(user.password)
 
     new_user = User(
         username=user.username,
@@ -114,21 +114,13 @@ async def signup_user(
         email=user.email,
     )
 
-    try:
-        send_welcome_mail(user.email, user.username)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Failed to send mail")
-
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
-    db.close()
 
-    background_tasks.add_task(
-        send_welcome_mail,
-        user.email,
-        user.username
-    )
+    if user.email:
+        queue_welcome_mail(db, user.email, user.username)
+    db.close()
 
     return UserResponse(
         message="User registered successfully",
@@ -163,22 +155,30 @@ async def login_user(
     if not needed_user:
         raise HTTPException(status_code=404, detail="Invalid Username")
 
-    # converting password to array of bytes
-    provided_password = user.password
-
-    hashed_password = provided_password.encode("utf-8")
-
+    # Check the password off the event loop; users created by a recording
+    # have no password until they set one
     actual_user_password = needed_user.hashed_password
 
-    if _ := bcrypt.checkpw(hashed_password, actual_user_password):
-        return UserResponse(
-            status_code=200,
-            message="Login Successful",
-            username=needed_user.username,
-        )
-    else:
+    if is_anonymous_credential(
+        actual_user_password
+    ) or not await check_password_async(user.password, actual_user_password):
         raise HTTPException(status_code=401, detail="Invalid Password.")
 
+    # Upgrade hashes made with another cost factor while we have the
+    # password in hand
+    if needs_rehash(actual_user_password):
+        db.query(User).filter(User.username == needed_user.username).update(
+            {User.hashed_password: await hash_password_async(user.password)}
+        )
+        db.commit()
+        db.close()
+
+    return UserResponse(
+        status_code=200,
+        message="Login Successful",
+        username=needed_user.username,
+    )
+
 
 @auth_router.post("/request-otp/")
 async def request_otp(
@@ -208,15 +208,13 @@ async def request_otp(
     # generate otp
     otp = get_otp()
 
-    # send otp to user's email address
-    try:
-        send_otp(
-            recipient_address=user.email,
-            otp=otp,
-            subject="Forgotten Helpmeout Password",
-        )
-    except Exception as e:
-        raise HTTPException(status_code=400, detail="Failed to send mail")
+    # queue the otp for the user's email address
+    queue_otp(
+        db,
+        recipient_address=user.email,
+        otp=otp,
+        subject="Forgotten Helpmeout Password",
+    )
 
     return OtpResponse(
         status_code=200,
@@ -252,7 +250,7 @@ async def change_password(
 
     username = requested_user.username
 
-    new_password = hash_password(user.password)
+    new_password = await hash_password_async(user.password)
 
     requested_user.hashed_password = new_password
 
@@ -275,14 +273,12 @@ async def google_login():
 
 @auth_router.get("/google/callback/")
 async def google_callback(
-    background_tasks: BackgroundTasks,
     request: Request, db: Session = Depends(get_db)
 ) -> UserResponse:
     """
     Process Login response from Google and return user info
 
     Args:
-        background_tasks: The background tasks object.
         request: The HTTPS request object
         db: The database session object
 
@@ -312,7 +308,7 @@ async def google_callback(
             random_suffix = random.randint(100000, 999999)
             display_name = f"{display_name}_{random_suffix}"
 
-        password = hash_password(user_email)
+        password = await hash_password_async(user_email)
         current_user = User(
             email=user_email,
             username=display_name,
@@ -322,13 +318,9 @@ async def google_callback(
         db.add(current_user)
         db.commit()
         db.refresh(current_user)
-        db.close()
 
-        background_tasks.add_task(
-            send_welcome_mail,
-            current_user.email,
-            current_user.username
-        )
+        queue_welcome_mail(db, current_user.email, current_user.username)
+        db.close()
 
     return UserResponse(
         status_code=200,
@@ -369,7 +361,7 @@ async def edit_username(
     ):
         raise HTTPException(status_code=409, detail="username exists already.")
 
-    user.username = new_username
+    rename_user(db, user, new_username)
 
     db.commit()
     db.refresh(user)
@@ -1,7 +1,11 @@
 """ Video routes for the FastAPI application. """
-import base64
+import asyncio
 import datetime
+import json
 import os
+import subprocess
+import uuid
+from functools import partial
 from fastapi import Query
 from sqlalchemy import desc
 import math
@@ -13,31 +17,178 @@ from fastapi import (
     Depends,
     HTTPException,
     Request,
+    WebSocket,
 )
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import (
+    FileResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 
 from app.database import get_db
-from app.models.user_models import User
+from app.models.user_models import User, UsageResponse
 from app.models.video_models import Video, VideoBlob
-from app.services.mail_service import send_video
+from app.services.mail_service import queue_video_mail
 from app.services.services import (
-    save_blob,
-    merge_blobs,
+    create_directory,
     generate_id,
     process_video,
-    hash_password,
     is_owner,
 )
-from app.settings import VIDEO_MIME_TYPE
+from app.services.broker import user_topic, video_topic
+from app.services.captions import CAPTION_FORMATS, get_captions_path
+from app.services.events import (
+    SSE_HEADERS,
+    load_video,
+    read_video_snapshot,
+    sse_events,
+    websocket_events,
+)
+from app.services.media_tokens import can_access_media, issue_media_token
+from app.services.responses import (
+    cached_file_response,
+    negotiated_file_response,
+)
+from app.services.paths import get_blob_path
+from app.services.search_service import (
+    index_video_title,
+    search_transcripts,
+    search_video_titles,
+    update_transcript_owner,
+)
+from app.services.stats_service import (
+    add_video_bytes,
+    count_user_videos,
+    file_size,
+    get_user_stats,
+    record_video_created,
+    transfer_user_stats,
+)
+from app.services.storage import get_storage, is_remote_storage, media_key
+from app.services.storage_gc import reclaim_merged_chunks, remove_video
+from app.services.streaming import (
+    FIRST_BLOB_INDEX,
+    list_blob_files,
+    stored_file_response,
+    stream_files_response,
+    tail_blobs,
+)
+from app.services.thumbnails import (
+    THUMBNAIL_FORMATS,
+    THUMBNAIL_WIDTHS,
+    get_thumbnail_variant,
+)
+from app.services.tiering import record_access
+from app.services.transcript_store import open_compact_transcript
+from app.services.uploads import (
+    chunk_digest,
+    finalize_recording,
+    get_chunk_manifest,
+    is_recorded_chunk,
+    move_chunk,
+    receive_chunk_envelope,
+    record_chunk,
+    write_chunk,
+)
+from app.services.users import ensure_user, forget_user, remember_user
+from app.settings import (
+    LIST_THUMBNAIL_WIDTH,
+    LIVE_TAIL_TIMEOUT,
+    STORAGE_REDIRECT,
+    VIDEO_DIR,
+    VIDEO_MIME_TYPE,
+)
 
 video_router = APIRouter(prefix="")
 
 
+def _media_response(
+    request: Request,
+    path: str | None,
+    media_type: str,
+    filename: str | None = None,
+    published_key: str | None = None,
+):
+    """
+    Serves a media file: through a presigned URL of the storage backend
+    when redirects are enabled and the file was uploaded, otherwise from
+    the local copy, or streamed from the storage backend when this node
+    has none.
+
+    Args:
+        request (Request): The FastAPI request object.
+        path (str | None): The local path of the file.
+        media_type (str): The media type of the file.
+        filename (str | None, optional): The name to download the file as.
+            Defaults to displaying it inline.
+        published_key (str | None, optional): The key the file was
+            uploaded under, as recorded by `publish_files`.
+
+    Returns:
+        Response: The redirect, file or streaming response.
+
+    Raises:
+        HTTPException: If the file is not found.
+    """
+    key = media_key(path)
+    # Presigning never checks the object, only redirect to published files
+    if key and key == published_key and STORAGE_REDIRECT:
+        url = get_storage().presign(key, filename=filename)
+        if url:
+            return RedirectResponse(url, status_code=307)
+
+    if path and os.path.isfile(path):
+        return FileResponse(path, media_type=media_type, filename=filename)
+
+    if key and is_remote_storage():
+        return stored_file_response(
+            request, get_storage(), key, media_type, filename
+        )
+
+    raise HTTPException(status_code=404, detail="File not found.")
+
+
+def _link_media(
+    request: Request,
+    video: Video,
+    token: str | None = None,
+    **thumbnail_params,
+) -> None:
+    """
+    Replaces the absolute paths of a video with downloadable URLs, signed
+    with a media token for private videos.
+
+    Args:
+        request (Request): The FastAPI request object.
+        video (Video): The video, detached from its session.
+        token (str | None, optional): The media token of the video.
+        **thumbnail_params: Query parameters of the thumbnail URL.
+    """
+    params = {"token": token} if token else {}
+    video.original_location = str(
+        request.url_for("stream_video", video_id=video.id)
+        .include_query_params(**params)
+    )
+    video.thumbnail_location = str(
+        request.url_for("get_thumbnail", video_id=video.id)
+        .include_query_params(**thumbnail_params, **params)
+    )
+    video.transcript_location = str(
+        request.url_for("get_transcript", video_id=video.id)
+        .include_query_params(**params)
+    )
+
+
 @video_router.post("/start-recording/")
 def start_recording(
     username: str,
+    request: Request,
     db: Session = Depends(get_db),
 ):
     """
@@ -45,137 +196,522 @@ def start_recording(
 
     Args:
         username (str): The username of the user.
+        request (Request): The FastAPI request object.
         db (Session, optional): The database session. Default
             Depends(get_db).
 
     Returns:
-        dict: A dictionary containing the success message and video ID.
+        dict: A dictionary containing the success message, the video ID
+            and the WebSocket URL to stream the chunks to.
 
     Raises:
         None
     """
 
-    # Check if the user exists
-    if not db.query(User).filter(User.username == username).first():
-        password = "starhkzdidnotcontribute"
-        hashed_password = hash_password(password)
-        new_user = User(username=username, hashed_password=hashed_password)
+    for attempt in range(2):
+        # Create the user on their first recording, without a password
+        ensure_user(db, username)
 
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        video_id = generate_id()
+        video_data = Video(
+            id=video_id,
+            username=username,
+            title=f"Untitled Video {video_id}",
+        )
 
-    video_id = generate_id()
-    video_data = Video(
-        id=video_id,
-        username=username,
-        title=f"Untitled Video {video_id}",
+        try:
+            db.add(video_data)
+            db.flush()
+            record_video_created(db, video_data)
+            index_video_title(db, video_data)
+            db.commit()
+            break
+        except IntegrityError:
+            # The cached user may have been renamed by another worker
+            db.rollback()
+            forget_user(username)
+            if attempt:
+                raise
+    remember_user(username)
+
+    upload_url = request.url_for("upload_socket", video_id=video_id)
+    upload_url = upload_url.replace(
+        scheme="wss" if upload_url.scheme == "https" else "ws"
     )
 
-    db.add(video_data)
-    db.commit()
-
     return {
         "message": "Recording started successfully",
         "video_id": video_data.id,
+        "upload_url": str(upload_url),
     }
 
 
-@video_router.post("/upload-blob/")
-def upload_video_blob(
+@video_router.post(
+    "/upload-blob/",
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {"schema": VideoBlob.model_json_schema()}
+            },
+            "required": True,
+        }
+    },
+)
+async def upload_video_blob(
     background_tasks: BackgroundTasks,
     request: Request,
-    video_data: VideoBlob,
-    db: Session = Depends(get_db),
 ):
     """
     Uploads a video blob to the server.
 
+    The `VideoBlob` JSON body is parsed as it arrives and `blob_object` is
+    decoded straight to a file, so memory use stays flat whatever the chunk
+    size. Chunks larger than `MAX_CHUNK_SIZE` are rejected. An optional
+    `X-Chunk-Checksum: sha256:<hex>` (or `crc32:<hex>`) header is verified
+    while decoding, and a mismatching chunk is rejected with a 400. A
+    retried chunk whose checksum matches the chunk manifest is acknowledged
+    without being decoded or written.
+
     Args:
         background_tasks (BackgroundTasks): The background tasks object.
-        video_data (VideoBlob): The json data containing video information
-        Db (Session, optional): The database session.
-            Defaults to Depends(get_db).
+        request (Request): The FastAPI request object.
 
     Returns:
         dict: A dictionary containing the success message and video data
             if applicable.
 
     Raises:
-        None
+        HTTPException: If the body is malformed (400), the user or video is
+            not found (404), the video is already processed (403), another
+            request is merging it (409) or the chunk is too large (413).
+        RequestValidationError: If a field of the body is invalid.
     """
-    # Query the database for the video id
-    video = db.query(Video).filter(Video.id == video_data.video_id).first()
+    create_directory(VIDEO_DIR)
+    temp_path = os.path.join(VIDEO_DIR, f".incoming.{uuid.uuid4().hex}.tmp")
 
-    # If the user is not found, raise an exception
-    user = db.query(User).filter(User.username == video_data.username).first()
-    if not user:
-        raise HTTPException(
-            status_code=404,
-            detail="User not found. Please start recording again.",
+    try:
+        fields, digest, recorded = await receive_chunk_envelope(
+            request, temp_path, _is_stored_blob
         )
+        try:
+            video_data = VideoBlob.model_validate(fields)
+        except ValidationError as err:
+            raise RequestValidationError(err.errors()) from err
 
-    # If the video is not found, raise an exception
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found.")
+        merged_location, merged = await run_in_threadpool(
+            _store_blob, video_data, temp_path, digest, recorded
+        )
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # If it was the last blob, process the merged video and then drop its
+    # chunks in the background, unless a previous copy of this request
+    # already did
+    if merged_location:
+        if merged:
+            background_tasks.add_task(
+                process_video,
+                video_data.video_id,
+                merged_location,
+                video_data.username,
+            )
+            background_tasks.add_task(
+                reclaim_merged_chunks, video_data.video_id
+            )
 
-    # If the video is already completed, raise an exception
-    if video.status == "completed":
-        raise HTTPException(
-            status_code=403,
-            detail="Video already processed. Please start recording again.",
+        video_id = video_data.video_id
+        video_url = str(request.url_for("stream_video", video_id=video_id))
+        return {
+            "message": "Blobs received successfully, video is being processed",
+            "video_id": video_id,
+            "video_url": video_url,
+        }
+
+    return {
+        "message": "Blob received successfully",
+        "video_id": video_data.video_id,
+    }
+
+
+def _is_stored_blob(fields: dict, digest: str) -> bool:
+    """
+    Checks the chunk manifest for a blob before its body is decoded.
+
+    Args:
+        fields (dict): The fields of the upload read before the blob.
+        digest (str): The digest announced by the client.
+
+    Returns:
+        bool: True if the same blob is already stored.
+    """
+    try:
+        video_id = str(fields["video_id"])
+        blob_index = int(fields["blob_index"])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+    db = next(get_db())
+    try:
+        video = db.query(Video).filter(Video.id == video_id).first()
+        return bool(
+            video
+            and is_recorded_chunk(db, video_id, blob_index, None, digest)
+            and (
+                # The chunks of a merged video may already be reclaimed,
+                # even when its processing failed
+                video.original_location
+                or os.path.isfile(
+                    get_blob_path(video.username, video_id, blob_index)
+                )
+            )
         )
+    finally:
+        db.close()
 
-    # Decode the blob data
-    blob_data = base64.b64decode(video_data.blob_object)
 
-    # Save the blob
-    _ = save_blob(
-        video_data.username,
-        video_data.video_id,
-        video_data.blob_index,
-        blob_data,
-    )
+def _store_blob(
+    video_data: VideoBlob,
+    blob_path: str,
+    digest: str,
+    recorded: bool = False,
+) -> tuple[str | None, bool]:
+    """
+    Moves a decoded blob into place and merges the recording if it was the
+    last blob. A retried blob identical to the stored one is acknowledged
+    from the chunk manifest without being written again, and a retried
+    last blob gets the result of the first merge.
+
+    Args:
+        video_data (VideoBlob): The fields of the upload.
+        blob_path (str): The path to the decoded blob.
+        digest (str): The digest of the decoded blob.
+        recorded (bool, optional): Whether the blob was already found in
+            the chunk manifest and skipped without being decoded.
 
-    # If it's the last blob, merge all blobs and process the video
-    if video_data.is_last:
-        # Merge the blobs
-        video.original_location = merge_blobs(
-            video_data.username, video_data.video_id
+    Returns:
+        tuple[str | None, bool]: The path to the merged video if it was
+            the last blob, and whether this request merged it.
+
+    Raises:
+        HTTPException: If the user or video is not found, or if the video
+            is already processed.
+    """
+    db = next(get_db())
+    try:
+        # Query the user and the video at once
+        row = (
+            db.query(User.username, Video)
+            .outerjoin(Video, Video.id == video_data.video_id)
+            .filter(User.username == video_data.username)
+            .first()
         )
-        if not video.original_location:
-            db.close()
+
+        # If the user is not found, raise an exception
+        if not row:
+            forget_user(video_data.username)
             raise HTTPException(
                 status_code=404,
-                detail="No blobs found. Please start recording again.",
+                detail="User not found. Please start recording again.",
             )
 
-        video.status = "completed"
-        db.commit()
+        # If the video is not found, raise an exception
+        video = row.Video
+        if not video:
+            raise HTTPException(status_code=404, detail="Video not found.")
 
-        # Process the video in the background
-        background_tasks.add_task(
-            process_video,
-            video_data.video_id,
-            video.original_location,
-            video_data.username,
+        size = file_size(blob_path)
+        duplicate = recorded or (
+            is_recorded_chunk(
+                db, video.id, video_data.blob_index, size, digest
+            )
+            and (
+                # Merged, even if processing failed: chunks may be gone
+                video.original_location
+                or os.path.isfile(
+                    get_blob_path(
+                        video.username, video.id, video_data.blob_index
+                    )
+                )
+            )
         )
 
+        # If the video is already merged, only retries are accepted
+        if video.original_location:
+            if not duplicate:
+                raise HTTPException(
+                    status_code=403,
+                    detail=(
+                        "Video already processed. "
+                        "Please start recording again."
+                    ),
+                )
+            if video_data.is_last:
+                return video.original_location, False
+            return None, False
+
+        # Save the blob, accounting for a previous copy of a retried blob
+        if not duplicate:
+            add_video_bytes(
+                db,
+                video,
+                move_chunk(
+                    video_data.username,
+                    video_data.video_id,
+                    video_data.blob_index,
+                    blob_path,
+                ),
+            )
+            record_chunk(
+                db, video.id, video_data.blob_index, size, digest
+            )
+
+        # If it's the last blob, merge all blobs
+        if video_data.is_last:
+            return finalize_recording(db, video)
+        db.commit()
+        return None, False
+    finally:
         db.close()
-        video_id = video_data.video_id
-        video_url = str(request.url_for("stream_video", video_id=video_id))
-        return {
-            "message": "Blobs received successfully, video is being processed",
-            "video_id": video_id,
-            "video_url": video_url,
-        }
 
+
+# Background work started outside of a request, kept until it finishes
+_background_runs: set[asyncio.Task] = set()
+
+
+def _run_in_background(video_id: str, tasks: BackgroundTasks) -> None:
+    """
+    Runs background tasks the way a response would after being sent, and
+    reports their failure.
+
+    Args:
+        video_id (str): The ID of the video the tasks work on.
+        tasks (BackgroundTasks): The tasks to run, in order.
+    """
+
+    def report(run: asyncio.Task) -> None:
+        _background_runs.discard(run)
+        if not run.cancelled() and run.exception():
+            print(f"Processing of {video_id} failed: {run.exception()!r}")
+
+    run = asyncio.create_task(tasks())
+    _background_runs.add(run)
+    run.add_done_callback(report)
+
+
+@video_router.websocket("/ws/upload/{video_id}")
+async def upload_socket(
+    websocket: WebSocket,
+    video_id: str,
+    start: int = Query(default=FIRST_BLOB_INDEX),
+):
+    """
+    Receive the chunks of a recording over one WebSocket. Every binary
+    message is the next chunk, numbered from `start`, and is acknowledged
+    with `{"ack": index, "size": bytes}` once written, so a client waiting
+    for acks gets backpressure for free. A text message `{"event": "end"}`
+    merges the recording, answers with its URL and closes the socket; if
+    the merge fails the answer is `{"event": "error", "status": code}`,
+    and a 409 means another request is merging it and `end` should be
+    sent again on a new socket.
+    A client reconnecting after a drop resumes with `start` set to the
+    chunk after the last acknowledged one.
+
+    A text message `{"checksum": "sha256:<hex>"}` (or `crc32:<hex>`) before
+    a chunk has it verified; a mismatching chunk is answered with
+    `{"nack": index, "detail": ...}` and must be sent again. Text messages
+    that aren't JSON objects close the socket with code 1003.
+
+    Parameters:
+        websocket (WebSocket): The WebSocket connection.
+        video_id (str): The ID of the recording.
+        start (int, optional): The index of the first chunk. Defaults to 1.
+    """
+    db = next(get_db())
+    video = db.query(Video).filter(Video.id == video_id).first()
+    manifest = get_chunk_manifest(db, video_id) if video else {}
     db.close()
 
-    return {
-        "message": "Blob received successfully",
-        "video_id": video_data.video_id,
-    }
+    if not video or video.status != "processing":
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    username = video.username
+    blob_index = start
+    received = 0
+    new_chunks = {}
+    checksum = None
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                try:
+                    chunk = await run_in_threadpool(
+                        _store_socket_chunk,
+                        username,
+                        video_id,
+                        blob_index,
+                        message["bytes"],
+                        checksum,
+                        manifest,
+                    )
+                except ValueError as err:
+                    await websocket.send_json(
+                        {"nack": blob_index, "detail": str(err)}
+                    )
+                    continue
+                finally:
+                    checksum = None
+
+                if chunk:
+                    received += chunk[0]
+                    new_chunks[blob_index] = chunk[1:]
+                await websocket.send_json(
+                    {"ack": blob_index, "size": len(message["bytes"])}
+                )
+                blob_index += 1
+                continue
+
+            try:
+                control = json.loads(message.get("text") or "{}")
+            except ValueError:
+                control = None
+            if not isinstance(control, dict):
+                await websocket.close(code=1003)
+                return
+            if "checksum" in control:
+                checksum = control["checksum"]
+                if not isinstance(checksum, str):
+                    await websocket.close(code=1008)
+                    return
+                continue
+            if control.get("event") != "end":
+                continue
+
+            try:
+                merged_location, merged = await run_in_threadpool(
+                    _finish_socket_upload, video_id, received, new_chunks
+                )
+            except HTTPException as err:
+                await websocket.send_json(
+                    {
+                        "event": "error",
+                        "status": err.status_code,
+                        "detail": err.detail,
+                    }
+                )
+                await websocket.close(code=1011)
+                return
+            finally:
+                received, new_chunks = 0, {}
+
+            # Process the video, then drop its chunks, in the background
+            if merged:
+                background_tasks = BackgroundTasks()
+                background_tasks.add_task(
+                    process_video, video_id, merged_location, username
+                )
+                background_tasks.add_task(reclaim_merged_chunks, video_id)
+                _run_in_background(video_id, background_tasks)
+            await websocket.send_json(
+                {
+                    "event": "merged",
+                    "video_id": video_id,
+                    "video_url": str(
+                        websocket.url_for("stream_video", video_id=video_id)
+                    ),
+                }
+            )
+            await websocket.close()
+            break
+    finally:
+        # Account for chunks received before the client went away
+        if new_chunks:
+            await run_in_threadpool(
+                _finish_socket_upload, video_id, received, new_chunks, False
+            )
+
+
+def _store_socket_chunk(
+    username: str,
+    video_id: str,
+    blob_index: int,
+    blob: bytes,
+    checksum: str | None,
+    manifest: dict[int, tuple],
+) -> tuple[int, int, str] | None:
+    """
+    Verifies and saves a chunk received over an upload socket, unless an
+    identical copy was already stored.
+
+    Args:
+        username (str): The user associated with the recording.
+        video_id (str): The ID of the recording.
+        blob_index (int): The index of the chunk.
+        blob (bytes): The chunk data.
+        checksum (str | None): The checksum sent by the client.
+        manifest (dict[int, tuple]): The size and digest of the chunks
+            stored so far, by index; updated with this chunk.
+
+    Returns:
+        tuple[int, int, str] | None: The number of bytes the recording grew
+            by, the size and the digest of the chunk, or None if it was
+            already stored.
+
+    Raises:
+        ValueError: If the chunk doesn't match its checksum.
+    """
+    digest = chunk_digest(blob, checksum)
+    if manifest.get(blob_index) == (len(blob), digest) and os.path.isfile(
+        get_blob_path(username, video_id, blob_index)
+    ):
+        return None
+
+    grown = write_chunk(username, video_id, blob_index, blob)
+    manifest[blob_index] = (len(blob), digest)
+
+    return grown, len(blob), digest
+
+
+def _finish_socket_upload(
+    video_id: str,
+    received: int,
+    new_chunks: dict[int, tuple],
+    finalize: bool = True,
+) -> tuple[str | None, bool]:
+    """
+    Accounts for the chunks received over an upload socket in one
+    transaction, then merges the recording.
+
+    Args:
+        video_id (str): The ID of the recording.
+        received (int): The number of bytes the recording grew by.
+        new_chunks (dict[int, tuple]): The size and digest of the chunks
+            written, by index.
+        finalize (bool, optional): Whether to merge the recording.
+            Defaults to True.
+
+    Returns:
+        tuple[str | None, bool]: The path to the merged video if merging
+            was requested, and whether this call merged it.
+    """
+    db = next(get_db())
+    try:
+        video = db.query(Video).filter(Video.id == video_id).first()
+        add_video_bytes(db, video, received)
+        for blob_index, (size, digest) in new_chunks.items():
+            record_chunk(db, video_id, blob_index, size, digest)
+        if finalize:
+            return finalize_recording(db, video)
+        db.commit()
+        return None, False
+    finally:
+        db.close()
 
 
 @video_router.get("/recording/user/{username}")
@@ -214,11 +750,14 @@ def get_videos(
         .all()
     )
 
-    total_videos = (
-        db.query(Video)
-        .filter(func.lower(Video.username) == func.lower(username))
-        .count()
-    )
+    # Read the total from the user's stats row, counting only as a fallback
+    total_videos = count_user_videos(db, username)
+    if total_videos is None:
+        total_videos = (
+            db.query(Video)
+            .filter(func.lower(Video.username) == func.lower(username))
+            .count()
+        )
 
     if not videos:
         raise HTTPException(
@@ -227,17 +766,17 @@ def get_videos(
 
     db.close()
 
-    # Replace the absolute paths with downloadable URLs
+    # Replace the absolute paths with downloadable URLs, signing the
+    # private ones only for their owner
+    owner = is_owner(request, username)
     for video in videos:
-        video_id = video.id
-        video.original_location = str(
-            request.url_for("stream_video", video_id=video_id)
-        )
-        video.thumbnail_location = str(
-            request.url_for("get_thumbnail", video_id=video_id)
+        token = (
+            issue_media_token(video.id)
+            if owner and not video.is_public
+            else None
         )
-        video.transcript_location = str(
-            request.url_for("get_transcript", video_id=video_id)
+        _link_media(
+            request, video, token, w=LIST_THUMBNAIL_WIDTH, format="webp"
         )
 
     return {
@@ -259,8 +798,8 @@ def search_videos(
 ):
     """
     Search for videos associated with the given username based on a search
-    query in the video title with pagination support and sorting from most
-    recent to least recent.
+    query in the video title with pagination support. Every query term is
+    matched as a word prefix and the best matches come first.
 
     Parameters:
         username (str): The username for which to search for videos.
@@ -279,23 +818,9 @@ def search_videos(
     # Calculate the offset to skip items on previous pages
     offset = (page - 1) * items_per_page
 
-    # Query the database with pagination and sorting by creation date in
-    # descending order
-    videos = (
-        db.query(Video)
-        .filter(func.lower(Video.username) == func.lower(username))
-        .filter(func.lower(Video.title).like(f"%{video_name.lower()}%"))
-        .order_by(desc(Video.created_date))
-        .offset(offset)
-        .limit(items_per_page)
-        .all()
-    )
-
-    total_videos = (
-        db.query(Video)
-        .filter(func.lower(Video.username) == func.lower(username))
-        .filter(func.lower(Video.title).like(f"%{video_name.lower()}%"))
-        .count()
+    # Query the title index with pagination, best matches first
+    videos, total_videos = search_video_titles(
+        db, username, video_name, items_per_page, offset
     )
 
     if not videos:
@@ -305,17 +830,17 @@ def search_videos(
 
     db.close()
 
-    # Replace the absolute paths with downloadable URLs
+    # Replace the absolute paths with downloadable URLs, signing the
+    # private ones only for their owner
+    owner = is_owner(request, username)
     for video in videos:
-        video_id = video.id
-        video.original_location = str(
-            request.url_for("stream_video", video_id=video_id)
+        token = (
+            issue_media_token(video.id)
+            if owner and not video.is_public
+            else None
         )
-        video.thumbnail_location = str(
-            request.url_for("get_thumbnail", video_id=video_id)
-        )
-        video.transcript_location = str(
-            request.url_for("get_transcript", video_id=video_id)
+        _link_media(
+            request, video, token, w=LIST_THUMBNAIL_WIDTH, format="webp"
         )
 
     return {
@@ -327,6 +852,100 @@ def search_videos(
     }
 
 
+@video_router.get("/search/transcripts/user/{username}")
+def search_video_transcripts(
+    username: str,
+    q: str,
+    request: Request,
+    page: int = Query(default=1, ge=1),
+    db: Session = Depends(get_db),
+):
+    """
+    Search the transcripts of the videos associated with the given username
+    for a phrase, with pagination support. Every matching video comes with
+    the timestamps of its hits so the player can seek straight to them.
+
+    Parameters:
+        username (str): The username for which to search for videos.
+        q (str): The phrase to search for.
+        page (int): The page number (default: 1).
+        request (Request): The FastAPI request object.
+        db (Session): The database session.
+
+    Returns:
+        dict: A dictionary containing the matching videos and their hits for
+        the requested page, along with pagination information.
+
+    Raises:
+        HTTPException: If no transcript matches the phrase.
+    """
+    items_per_page: int = 6
+
+    # Calculate the offset to skip items on previous pages
+    offset = (page - 1) * items_per_page
+
+    results, total_videos = search_transcripts(
+        db, username, q, items_per_page, offset
+    )
+    db.close()
+
+    if not results:
+        raise HTTPException(
+            status_code=404, detail="No matching transcripts found."
+        )
+
+    for result in results:
+        result["video_url"] = str(
+            request.url_for("stream_video", video_id=result["video_id"])
+        )
+
+    return {
+        "total_items": total_videos,
+        "items_per_page": items_per_page,
+        "page": page,
+        "total_pages": math.ceil(total_videos / items_per_page),
+        "videos": results,
+    }
+
+
+@video_router.get("/usage/user/{username}", response_model=UsageResponse)
+def get_usage(username: str, db: Session = Depends(get_db)):
+    """
+    Returns the number of videos and the storage used by a user.
+
+    Parameters:
+        username (str): The username of the user.
+        db (Session): The database session.
+
+    Returns:
+        UsageResponse: The usage of the user.
+
+    Raises:
+        HTTPException: If the user is not found.
+    """
+    stats = get_user_stats(db, username)
+    if not stats:
+        if not db.query(User).filter(User.username == username).first():
+            db.close()
+            raise HTTPException(status_code=404, detail="User not found.")
+        db.close()
+        return UsageResponse(
+            username=username,
+            video_count=0,
+            bytes_stored=0,
+            processing_count=0,
+        )
+
+    db.close()
+
+    return UsageResponse(
+        username=stats.username,
+        video_count=stats.video_count,
+        bytes_stored=stats.bytes_stored,
+        processing_count=stats.processing_count,
+    )
+
+
 @video_router.get("/recording/{video_id}")
 def get_video(video_id: str, request: Request, db: Session = Depends(get_db)):
     """
@@ -353,6 +972,7 @@ def get_video(video_id: str, request: Request, db: Session = Depends(get_db)):
     # Check if the video is public and if the current user is the owner
     if not video.is_public and not is_owner(request, video.username):
         raise HTTPException(status_code=403, detail="Video is not public.")
+    private = not video.is_public
 
     # Check if public access period to video has expired,
     # make video private if it has
@@ -364,27 +984,25 @@ def get_video(video_id: str, request: Request, db: Session = Depends(get_db)):
             db.commit()
             db.close()
 
-    # Replace the absolute paths with downloadable URLs
-    video.original_location = str(
-        request.url_for("stream_video", video_id=video_id)
-    )
-    video.thumbnail_location = str(
-        request.url_for("get_thumbnail", video_id=video_id)
-    )
-    video.transcript_location = str(
-        request.url_for("get_transcript", video_id=video_id)
-    )
+    # Replace the absolute paths with downloadable URLs; the owner of a
+    # private video gets them signed, so the player needs no session
+    token = issue_media_token(video_id) if private else None
+    _link_media(request, video, token)
 
     return video
 
 
 @video_router.get("/stream/{video_id}")
-def stream_video(video_id: str, db: Session = Depends(get_db)):
+def stream_video(
+    video_id: str, request: Request, db: Session = Depends(get_db)
+):
     """
-    Stream a video by its video ID.
+    Stream a video by its video ID. Private videos need the media token
+    issued by `/recording/{video_id}` or the owner's session.
 
     Parameters:
         video_id (str): The ID of the video to be streamed.
+        request (Request): The FastAPI request object.
         db (Session, optional): The database session. Defaults to the
             result of the get_db function.
 
@@ -392,110 +1010,449 @@ def stream_video(video_id: str, db: Session = Depends(get_db)):
         FileResponse: The file response containing the video stream.
 
     Raises:
-        HTTPException: If the video is not found.
+        HTTPException(403): If the video is private and not authorized.
+        HTTPException(404): If the video is not found.
     """
     video = db.query(Video).filter(Video.id == video_id).first()
 
     if not video:
         raise HTTPException(status_code=404, detail="Video not found.")
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
 
     if video.status == "processing":
         raise HTTPException(status_code=404, detail="Video not ready.")
 
-    return FileResponse(
-        video.original_location, media_type=f"video/{VIDEO_MIME_TYPE}"
+    record_access(video_id)
+    return _media_response(
+        request,
+        video.original_location,
+        f"video/{VIDEO_MIME_TYPE}",
+        published_key=video.published_key,
+    )
+
+
+@video_router.get("/live/{video_id}")
+def live_video(
+    video_id: str, request: Request, db: Session = Depends(get_db)
+):
+    """
+    Stream a recording while it is still being uploaded. The chunks
+    received so far are sent right away and new ones are pushed as they
+    arrive, over a single chunked response.
+
+    Parameters:
+        video_id (str): The ID of the video to be streamed.
+        request (Request): The FastAPI request object.
+        db (Session, optional): The database session. Defaults to the
+            result of the get_db function.
+
+    Returns:
+        StreamingResponse | RedirectResponse: The live stream, or a redirect
+            to the regular stream once the recording is complete.
+
+    Raises:
+        HTTPException(403): If the video is private and not authorized.
+        HTTPException(404): If the video is not found.
+    """
+    video = db.query(Video).filter(Video.id == video_id).first()
+    db.close()
+
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found.")
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
+
+    if video.status != "processing":
+        token = request.query_params.get("token")
+        return RedirectResponse(
+            str(
+                request.url_for(
+                    "stream_video", video_id=video_id
+                ).include_query_params(**({"token": token} if token else {}))
+            )
+        )
+
+    return StreamingResponse(
+        tail_blobs(video.username, video_id, LIVE_TAIL_TIMEOUT),
+        media_type=f"video/{VIDEO_MIME_TYPE}",
+        headers={"cache-control": "no-store"},
     )
 
 
+@video_router.get("/events/{video_id}")
+def video_events(
+    video_id: str, request: Request, db: Session = Depends(get_db)
+):
+    """
+    Push the processing stages of a video as Server-Sent Events, instead
+    of polling `/recording/{video_id}`. The current state is sent first and
+    the stream ends once the video is processed or has failed.
+
+    Parameters:
+        video_id (str): The ID of the video.
+        request (Request): The FastAPI request object.
+        db (Session, optional): The database session. Defaults to the
+            result of the get_db function.
+
+    Returns:
+        StreamingResponse: The text/event-stream response.
+
+    Raises:
+        HTTPException(403): If the video is not public.
+        HTTPException(404): If the video is not found.
+    """
+    video = db.query(Video).filter(Video.id == video_id).first()
+    db.close()
+
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found.")
+    if not video.is_public and not is_owner(request, video.username):
+        raise HTTPException(status_code=403, detail="Video is not public.")
+
+    # The state is read again once subscribed, so no stage falls between
+    return StreamingResponse(
+        sse_events(
+            video_topic(video_id), partial(read_video_snapshot, video_id)
+        ),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@video_router.get("/events/user/{username}")
+async def user_events(username: str, request: Request):
+    """
+    Push the processing stages of all of a user's videos as Server-Sent
+    Events.
+
+    Parameters:
+        username (str): The owner of the videos.
+        request (Request): The FastAPI request object.
+
+    Returns:
+        StreamingResponse: The text/event-stream response.
+
+    Raises:
+        HTTPException(403): If the current user is not the owner.
+    """
+    if not is_owner(request, username):
+        raise HTTPException(status_code=403, detail="Not authorized.")
+
+    return StreamingResponse(
+        sse_events(user_topic(username)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@video_router.websocket("/ws/events/{video_id}")
+async def video_events_socket(websocket: WebSocket, video_id: str):
+    """
+    Push the processing stages of a video over a WebSocket, as JSON
+    messages shaped like the Server-Sent Events of `/events/{video_id}`.
+
+    Parameters:
+        websocket (WebSocket): The WebSocket connection.
+        video_id (str): The ID of the video.
+    """
+    video = await run_in_threadpool(load_video, video_id)
+
+    if not video or (
+        not video.is_public and not is_owner(websocket, video.username)
+    ):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    await websocket_events(
+        websocket,
+        video_topic(video_id),
+        partial(read_video_snapshot, video_id),
+    )
+
+
+@video_router.websocket("/ws/events/user/{username}")
+async def user_events_socket(websocket: WebSocket, username: str):
+    """
+    Push the processing stages of all of a user's videos over a WebSocket.
+
+    Parameters:
+        websocket (WebSocket): The WebSocket connection.
+        username (str): The owner of the videos.
+    """
+    if not is_owner(websocket, username):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    await websocket_events(websocket, user_topic(username))
+
+
 @video_router.get("/download/{video_id}")
-def download_video(video_id: str, db: Session = Depends(get_db)):
+def download_video(
+    video_id: str, request: Request, db: Session = Depends(get_db)
+):
     """
-    Triggers download of a video by its video ID.
+    Triggers download of a video by its video ID. Recordings that are still
+    being uploaded are streamed straight from their chunk files, without
+    merging them first.
 
     Parameters:
         video_id (str): The ID of the video to be streamed.
+        request (Request): The FastAPI request object.
         db (Session, optional): The database session. Defaults to the
             result of the get_db function.
 
     Returns:
-        FileResponse: The file response containing the video file.
+        FileResponse | StreamingResponse: The response containing the video
+            file.
 
     Raises:
         HTTPException: If the video is not found.
     """
     video = db.query(Video).filter(Video.id == video_id).first()
+    db.close()
 
     if not video:
         raise HTTPException(status_code=404, detail="Video not found.")
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
 
     if video.status == "processing":
-        video.original_location = merge_blobs(video.username, video_id)
-        if not video.original_location:
-            db.close()
+        blob_files = list_blob_files(video.username, video_id)
+        if not blob_files:
             raise HTTPException(status_code=404, detail="No blobs found.")
-        video.status = "completed"
-        db.commit()
-        db.close()
 
-    return FileResponse(
+        return stream_files_response(
+            request,
+            blob_files,
+            media_type=f"video/{VIDEO_MIME_TYPE}",
+            filename=f"{video.title}.{VIDEO_MIME_TYPE}",
+        )
+
+    record_access(video_id)
+    return _media_response(
+        request,
         video.original_location,
-        media_type=f"video/{VIDEO_MIME_TYPE}",
+        f"video/{VIDEO_MIME_TYPE}",
         filename=f"{video.title}.{VIDEO_MIME_TYPE}",
+        published_key=video.published_key,
     )
 
 
 @video_router.get("/transcript/{video_id}")
-def get_transcript(video_id: str, db: Session = Depends(get_db)):
+def get_transcript(
+    video_id: str,
+    request: Request,
+    start: float | None = Query(default=None, ge=0),
+    end: float | None = Query(default=None, ge=0),
+    db: Session = Depends(get_db),
+):
     """
-    Get the transcript for a video by its video ID.
+    Get the transcript for a video by its video ID. Without a time range
+    the whole transcript is exported as JSON; with one, only the words and
+    utterances overlapping the range are returned. Private videos need a
+    media token or the owner's session.
 
     Parameters:
         video_id (str): The ID of the video to be streamed.
+        request (Request): The FastAPI request object.
+        start (float, optional): The start of the time range, in seconds.
+        end (float, optional): The end of the time range, in seconds.
         db (Session, optional): The database session. Defaults to the
             result of the get_db function.
 
     Returns:
-        FileResponse: The file response containing the video stream.
+        FileResponse | dict: The file response containing the transcript,
+            or the words and utterances in the requested time range.
 
     Raises:
-        HTTPException: If the video is not found.
+        HTTPException(403): If the video is private and not authorized.
+        HTTPException(404): If the video or its transcript is not found.
     """
     video = db.query(Video).filter(Video.id == video_id).first()
 
     if not video:
         raise HTTPException(status_code=404, detail="Video not found.")
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
     if video.status == "processing":
         raise HTTPException(status_code=404, detail="Video not processed yet.")
 
     db.close()
-    return FileResponse(video.transcript_location, media_type="text/plain")
+
+    # Serve the export from its precompressed siblings when possible
+    if start is None and end is None:
+        return negotiated_file_response(
+            request,
+            video.transcript_location,
+            media_type="text/plain",
+            private=not video.is_public,
+        )
+
+    if not video.transcript_location:
+        raise HTTPException(status_code=404, detail="Transcript not found.")
+
+    start = start or 0.0
+    end = math.inf if end is None else end
+    transcript = open_compact_transcript(video.transcript_location)
+
+    return {
+        "video_id": video_id,
+        "start": start,
+        "end": None if math.isinf(end) else end,
+        "words": transcript.words_between(start, end),
+        "utterances": transcript.utterances_between(start, end),
+    }
+
+
+@video_router.get("/captions/{video_id}")
+def get_captions(
+    video_id: str,
+    request: Request,
+    caption_format: str = Query(default="vtt", alias="format"),
+    db: Session = Depends(get_db),
+):
+    """
+    Get the captions for a video by its video ID. Each format is rendered
+    from the stored transcript the first time it is requested and cached
+    on disk.
+
+    Parameters:
+        video_id (str): The ID of the video.
+        request (Request): The FastAPI request object.
+        caption_format (str, optional): Either "vtt" or "srt". Defaults to
+            "vtt".
+        db (Session, optional): The database session. Defaults to the
+            result of the get_db function.
+
+    Returns:
+        Response: The caption file, or an empty response if the client's
+            cached copy is still valid.
+
+    Raises:
+        HTTPException(400): If the format is not supported.
+        HTTPException(403): If the video is private and not authorized.
+        HTTPException(404): If the video or its transcript is not found.
+    """
+    if caption_format not in CAPTION_FORMATS:
+        raise HTTPException(
+            status_code=400, detail="Unsupported caption format."
+        )
+
+    video = db.query(Video).filter(Video.id == video_id).first()
+    db.close()
+
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found.")
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
+    if not video.transcript_location:
+        raise HTTPException(status_code=404, detail="Video not processed yet.")
+
+    return negotiated_file_response(
+        request,
+        get_captions_path(video.transcript_location, caption_format),
+        media_type=CAPTION_FORMATS[caption_format],
+        private=not video.is_public,
+        filename=f"{video.title}.{caption_format}",
+        content_disposition_type="inline",
+    )
 
 
 @video_router.get("/thumbnail/{video_id}")
-def get_thumbnail(video_id: str, db: Session = Depends(get_db)):
+def get_thumbnail(
+    video_id: str,
+    request: Request,
+    w: int | None = Query(default=None, ge=1),
+    image_format: str = Query(default="jpg", alias="format"),
+    db: Session = Depends(get_db),
+):
     """
-    Get the thumbnail for a video by its video ID.
+    Get the thumbnail for a video by its video ID. When a width or a format
+    is requested, a resized variant is generated on first request and
+    served from a bounded disk cache afterwards. Private videos need a
+    media token or the owner's session.
 
     Parameters:
         video_id (str): The ID of the video to be streamed.
+        request (Request): The FastAPI request object.
+        w (int, optional): The width of the variant in pixels, rounded up to
+            a supported width. Defaults to the full size.
+        image_format (str, optional): Either "jpg" or "webp". Defaults to
+            "jpg".
         db (Session, optional): The database session. Defaults to the
             result of the get_db function.
 
     Returns:
-        FileResponse: The file response containing the video stream.
+        Response: The file response containing the thumbnail, or an empty
+            response if the client's cached copy is still valid.
 
     Raises:
-        HTTPException: If the video is not found.
+        HTTPException(400): If the format is not supported.
+        HTTPException(403): If the video is private and not authorized.
+        HTTPException(404): If the video is not found.
     """
+    if image_format not in THUMBNAIL_FORMATS:
+        raise HTTPException(
+            status_code=400, detail="Unsupported thumbnail format."
+        )
+
     video = db.query(Video).filter(Video.id == video_id).first()
 
     if not video:
         raise HTTPException(status_code=404, detail="Video not found.")
-    if video.status == "processing":
+    if not can_access_media(
+        request, video_id, video.is_public, video.username
+    ):
+        raise HTTPException(status_code=403, detail="Video is not public.")
+    if video.status == "processing" or not video.thumbnail_location:
         raise HTTPException(status_code=404, detail="Video not processed yet.")
     db.close()
 
-    return FileResponse(video.thumbnail_location, media_type="image/jpeg")
+    private = not video.is_public
+    if w is None and image_format == "jpg":
+        return cached_file_response(
+            request,
+            video.thumbnail_location,
+            media_type="image/jpeg",
+            private=private,
+        )
+
+    try:
+        variant = get_thumbnail_variant(
+            video_id,
+            video.thumbnail_location,
+            w or THUMBNAIL_WIDTHS[-1],
+            image_format,
+        )
+    except (OSError, subprocess.CalledProcessError) as err:
+        print(f"Thumbnail variant failed for {video_id}: {err}")
+        return cached_file_response(
+            request,
+            video.thumbnail_location,
+            media_type="image/jpeg",
+            private=private,
+        )
+
+    return cached_file_response(
+        request,
+        variant,
+        media_type=THUMBNAIL_FORMATS[image_format],
+        max_age=86400,
+        private=private,
+    )
 
 
 @video_router.patch("/video/{video_id}")
@@ -522,6 +1479,8 @@ def update_title(video_id: str, title: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Video not found.")
 
     video.title = title
+    db.flush()
+    index_video_title(db, video)
     db.commit()
     db.close()
     return {"msg": "Title updated successfully!"}
@@ -557,8 +1516,13 @@ def transfer_videos(
         raise HTTPException(status_code=404, detail="User not found.")
 
     videos = db.query(Video).filter(Video.username == username1).all()
+    transfer_user_stats(db, username1, username2, videos)
     for video in videos:
         video.username = username2
+    db.flush()
+    for video in videos:
+        index_video_title(db, video)
+        update_transcript_owner(db, video)
 
     db.commit()
     db.close()
@@ -568,8 +1532,8 @@ def transfer_videos(
 @video_router.delete("/video/{video_id}")
 def delete_video(video_id: str, db: Session = Depends(get_db)):
     """
-    Deletes a video from the database and removes its associated files
-    from the file system.
+    Deletes a video from the database and removes its directory, with
+    the chunks, audio, transcript and captions, and its other files.
 
     Parameters:
         video_id (str): The ID of the video to be deleted.
@@ -585,14 +1549,7 @@ def delete_video(video_id: str, db: Session = Depends(get_db)):
             in the database.
     """
     if video := db.query(Video).filter(Video.id == video_id).first():
-        if os.path.exists(str(video.original_location)):
-            os.remove(str(video.original_location))
-        if os.path.exists(str(video.thumbnail_location)):
-            os.remove(str(video.thumbnail_location))
-        if os.path.exists(str(video.compressed_location)):
-            os.remove(str(video.compressed_location))
-
-        db.delete(video)
+        remove_video(db, video)
         db.commit()
         db.close()
 
@@ -611,7 +1568,8 @@ def send_email(
     db: Session = Depends(get_db),
 ):
     """
-    Sends an email to the user with the video embedded in the email.
+    Queues an email to the user with the video embedded in the email. The
+    mail worker sends it.
 
     Parameters:
         video_id (str): The id of the video to be sent to the user.
@@ -632,14 +1590,11 @@ def send_email(
 
     if video.status == "processing":
         raise HTTPException(status_code=404, detail="Video not processed yet.")
-    try:
-        # If sender is anonymous, change sender's name to 'A user'
-        username = sender or "A user"
-        send_video(username, video_id, recipient)
-        db.close()
-    except Exception as e:
-        print(e)
-        return {"message": "Email not sent!"}, 500
+
+    # If sender is anonymous, change sender's name to 'A user'
+    username = sender or "A user"
+    queue_video_mail(db, username, video_id, recipient)
+    db.close()
 
     return {"message": "Email sent successfully!"}
 
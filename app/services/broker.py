@@ -0,0 +1,255 @@
+""" An in-process publish/subscribe broker for video events. """
+import asyncio
+import json
+import threading
+import uuid
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+from app.settings import EVENT_BROKER_URL
+
+# Events queued for a slow subscriber before older ones are dropped
+SUBSCRIPTION_QUEUE_SIZE = 256
+
+# Prefix of the Redis channels carrying the topics between processes
+CHANNEL_PREFIX = "helpmeout:"
+
+
+class Subscription:
+    """A subscriber's queue of messages published on a topic"""
+
+    def __init__(self, topic: str, loop: asyncio.AbstractEventLoop):
+        self.topic = topic
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE)
+
+    def deliver(self, message: dict) -> None:
+        """
+        Queues a message, dropping the oldest one if the queue is full.
+        Must run on the subscriber's event loop.
+
+        Args:
+            message (dict): The message to queue.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout: float | None = None) -> dict | None:
+        """
+        Waits for the next message.
+
+        Args:
+            timeout (float | None, optional): The number of seconds to
+                wait. Defaults to waiting forever.
+
+        Returns:
+            dict | None: The message, or None if the timeout expired.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    """
+    Fans messages out to the subscribers of a topic.
+
+    Publishing is thread-safe, so the sync routes and background tasks
+    running in the threadpool can publish to subscribers living on the
+    event loop.
+    """
+
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._lock = threading.Lock()
+        self.backend: "RedisBackend | None" = None
+
+    def subscribe(self, topic: str) -> Subscription:
+        """
+        Subscribes the running event loop to a topic.
+
+        Args:
+            topic (str): The topic to subscribe to.
+
+        Returns:
+            Subscription: The new subscription.
+        """
+        subscription = Subscription(topic, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(topic, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Removes a subscription.
+
+        Args:
+            subscription (Subscription): The subscription to remove.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.topic, None)
+
+    def publish(self, topic: str, message: dict) -> None:
+        """
+        Publishes a message to every subscriber of a topic, including the
+        subscribers of other processes when a backend is connected.
+
+        Args:
+            topic (str): The topic to publish to.
+            message (dict): The message to publish.
+        """
+        self.deliver(topic, message)
+        if self.backend:
+            self.backend.publish(topic, message)
+
+    def deliver(self, topic: str, message: dict) -> None:
+        """
+        Delivers a message to the subscribers of a topic in this process.
+
+        Args:
+            topic (str): The topic of the message.
+            message (dict): The message to deliver.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(topic, ()))
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(
+                    subscription.deliver, message
+                )
+            except RuntimeError:
+                # The subscriber's event loop is closed
+                self.unsubscribe(subscription)
+
+
+class RedisBackend:
+    """
+    Relays broker messages between processes over Redis pub/sub.
+
+    Every process publishes on the channel of the topic and listens on all
+    of them in a daemon thread, skipping the messages it sent itself since
+    those were already delivered locally.
+    """
+
+    def __init__(self, url: str, target: Broker):
+        self.origin = uuid.uuid4().hex
+        self.target = target
+        self.client = redis.Redis.from_url(url)
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+        self.thread = threading.Thread(
+            target=self._listen, name="broker-redis", daemon=True
+        )
+        self.thread.start()
+
+    def publish(self, topic: str, message: dict) -> None:
+        """
+        Sends a message to the other processes.
+
+        Args:
+            topic (str): The topic of the message.
+            message (dict): The message to send.
+        """
+        payload = json.dumps({"origin": self.origin, "message": message})
+        try:
+            self.client.publish(f"{CHANNEL_PREFIX}{topic}", payload)
+        except redis.RedisError as err:
+            print(f"Failed to relay event on {topic}: {err}")
+
+    def _listen(self) -> None:
+        """Delivers the messages sent by the other processes."""
+        try:
+            for item in self.pubsub.listen():
+                payload = json.loads(item["data"])
+                if payload["origin"] == self.origin:
+                    continue
+                channel = item["channel"].decode()
+                self.target.deliver(
+                    channel[len(CHANNEL_PREFIX):], payload["message"]
+                )
+        except (redis.RedisError, ValueError) as err:
+            print(f"Stopped relaying events: {err}")
+
+    def close(self) -> None:
+        """Stops listening and closes the connection."""
+        self.pubsub.close()
+        self.client.close()
+
+
+broker = Broker()
+
+
+def connect_broker() -> None:
+    """
+    Connects the broker to Redis when `EVENT_BROKER_URL` is set, so events
+    reach subscribers served by other worker processes.
+    """
+    if not EVENT_BROKER_URL or broker.backend:
+        return
+    if redis is None:
+        print("EVENT_BROKER_URL is set but redis is not installed.")
+        return
+
+    broker.backend = RedisBackend(EVENT_BROKER_URL, broker)
+
+
+def disconnect_broker() -> None:
+    """Disconnects the broker from Redis."""
+    if broker.backend:
+        broker.backend.close()
+        broker.backend = None
+
+
+def video_topic(video_id: str) -> str:
+    """
+    Returns the topic the events of a video are published on.
+
+    Args:
+        video_id (str): The ID of the video.
+
+    Returns:
+        str: The topic.
+    """
+    return f"video:{video_id}"
+
+
+def user_topic(username: str) -> str:
+    """
+    Returns the topic the events of all of a user's videos are published on.
+
+    Args:
+        username (str): The name of the user.
+
+    Returns:
+        str: The topic.
+    """
+    return f"user:{username}"
+
+
+def publish_video_event(
+    video_id: str, event: str, username: str | None = None, **data
+) -> None:
+    """
+    Publishes an event about a video, and about its owner's videos when
+    the owner is given.
+
+    Args:
+        video_id (str): The ID of the video.
+        event (str): The name of the event.
+        username (str | None, optional): The owner of the video.
+        **data: Extra fields of the event.
+    """
+    message = {"event": event, "video_id": video_id, **data}
+    broker.publish(video_topic(video_id), message)
+    if username:
+        broker.publish(user_topic(username), message)
@@ -0,0 +1,153 @@
+""" This module builds SRT and WebVTT captions from transcripts. """
+import os
+import textwrap
+import threading
+from typing import Iterable
+
+from app.services.compression import precompress
+from app.services.transcript_store import (
+    get_compact_path,
+    open_compact_transcript,
+)
+
+CAPTION_FORMATS = {
+    "srt": "application/x-subrip",
+    "vtt": "text/vtt",
+}
+
+# Readability budgets for a single cue
+MAX_CUE_DURATION = 6.0
+MAX_CUE_CHARS = 84
+MAX_LINE_CHARS = 42
+MAX_WORD_GAP = 1.0
+
+Cue = tuple[float, float, str]
+
+
+def build_cues(words: Iterable[tuple[float, float, str]]) -> list[Cue]:
+    """
+    Groups words into readable caption cues.
+
+    A cue ends after a sentence, before a long pause, or when adding the
+    next word would exceed the duration or character budget.
+
+    Args:
+        words (Iterable[tuple[float, float, str]]): The start time, end
+            time and punctuated text of every word, in order.
+
+    Returns:
+        list[Cue]: The start time, end time and text of every cue.
+    """
+    cues: list[Cue] = []
+    cue_words: list[str] = []
+    cue_start = cue_end = 0.0
+
+    for start, end, word in words:
+        if cue_words:
+            text = " ".join(cue_words)
+            if (
+                start - cue_end > MAX_WORD_GAP
+                or end - cue_start > MAX_CUE_DURATION
+                or len(text) + 1 + len(word) > MAX_CUE_CHARS
+                or text.endswith((".", "?", "!"))
+            ):
+                cues.append((cue_start, cue_end, text))
+                cue_words = []
+
+        if not cue_words:
+            cue_start = start
+        cue_words.append(word)
+        cue_end = end
+
+    if cue_words:
+        cues.append((cue_start, cue_end, " ".join(cue_words)))
+
+    return cues
+
+
+def format_timestamp(seconds: float, separator: str = ",") -> str:
+    """
+    Formats a time as a caption timestamp.
+
+    Args:
+        seconds (float): The time in seconds.
+        separator (str, optional): The separator between seconds and
+            milliseconds; "," for SRT and "." for WebVTT. Defaults to ",".
+
+    Returns:
+        str: The timestamp, as `HH:MM:SS,mmm`.
+    """
+    milliseconds = max(0, round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+
+    return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{milliseconds:03}"
+
+
+def render_captions(cues: list[Cue], caption_format: str) -> str:
+    """
+    Renders caption cues as an SRT or WebVTT document.
+
+    Args:
+        cues (list[Cue]): The cues to render.
+        caption_format (str): Either "srt" or "vtt".
+
+    Returns:
+        str: The caption document.
+    """
+    separator = "," if caption_format == "srt" else "."
+    blocks = ["WEBVTT\n"] if caption_format == "vtt" else []
+
+    for index, (start, end, text) in enumerate(cues, start=1):
+        lines = "\n".join(textwrap.wrap(text, MAX_LINE_CHARS))
+        timing = (
+            f"{format_timestamp(start, separator)} --> "
+            f"{format_timestamp(end, separator)}"
+        )
+        if caption_format == "srt":
+            blocks.append(f"{index}\n{timing}\n{lines}\n")
+        else:
+            blocks.append(f"{timing}\n{lines}\n")
+
+    return "\n".join(blocks)
+
+
+def get_captions_path(transcript_location: str, caption_format: str) -> str:
+    """
+    Returns the path where a caption rendition of a transcript is cached,
+    rendering it first if it is missing or older than the transcript.
+
+    Args:
+        transcript_location (str): The path to the JSON transcript.
+        caption_format (str): Either "srt" or "vtt".
+
+    Returns:
+        str: The path to the caption file.
+    """
+    base, _ = os.path.splitext(transcript_location)
+    captions_path = f"{base}.{caption_format}"
+
+    transcript = open_compact_transcript(transcript_location)
+    if os.path.isfile(captions_path) and os.path.getmtime(
+        captions_path
+    ) >= os.path.getmtime(get_compact_path(transcript_location)):
+        return captions_path
+
+    cues = build_cues(
+        (
+            transcript.word_starts[index],
+            transcript.word_ends[index],
+            transcript.word(index),
+        )
+        for index in range(len(transcript))
+    )
+
+    # Write to a temporary file so concurrent readers never see half a file
+    temp_path = f"{captions_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(render_captions(cues, caption_format))
+    os.replace(temp_path, captions_path)
+    precompress(captions_path)
+
+    return captions_path
@@ -0,0 +1,138 @@
+""" This module precompresses static artifacts and negotiates encodings. """
+import gzip
+import os
+import threading
+
+from fastapi import Request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+# Preferred encodings first, with the file extension of their siblings
+ENCODINGS = {"br": "br", "gzip": "gz"}
+
+
+def compress_data(
+    data: bytes, encoding: str, level: int | None = None
+) -> bytes:
+    """
+    Compresses data with the given content encoding.
+
+    Args:
+        data (bytes): The data to compress.
+        encoding (str): Either "br" or "gzip".
+        level (int | None, optional): The compression level. Defaults to
+            the maximum, which suits data compressed once and served many
+            times.
+
+    Returns:
+        bytes: The compressed data.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if level is None else level)
+
+    return gzip.compress(data, compresslevel=9 if level is None else level)
+
+
+def available_encodings() -> list[str]:
+    """
+    Returns the content encodings this server can produce.
+
+    Returns:
+        list[str]: The encodings, preferred first.
+    """
+    return [
+        encoding
+        for encoding in ENCODINGS
+        if encoding != "br" or brotli is not None
+    ]
+
+
+def precompress(path: str) -> list[str]:
+    """
+    Writes compressed siblings of a file (`path.br`, `path.gz`) so they
+    can be served without compressing on every request.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        list[str]: The paths to the compressed siblings.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    siblings = []
+    for encoding in available_encodings():
+        sibling = f"{path}.{ENCODINGS[encoding]}"
+        temp_path = f"{sibling}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(compress_data(data, encoding))
+        os.replace(temp_path, sibling)
+        siblings.append(sibling)
+
+    return siblings
+
+
+def get_compressed_siblings(path: str) -> list[str]:
+    """
+    Returns the paths the compressed siblings of a file would have.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        list[str]: The paths to the possible siblings.
+    """
+    return [f"{path}.{extension}" for extension in ENCODINGS.values()]
+
+
+def parse_accept_encoding(accept_encoding: str) -> set[str]:
+    """
+    Parses the value of an Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): The value of the header.
+
+    Returns:
+        set[str]: The encodings the client accepts.
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        encoding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if encoding and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(encoding.lower())
+
+    return accepted
+
+
+def negotiate_file(request: Request, path: str) -> tuple[str, str | None]:
+    """
+    Picks the best precompressed sibling of a file the client accepts.
+
+    Args:
+        request (Request): The request object.
+        path (str): The path to the uncompressed file.
+
+    Returns:
+        tuple[str, str | None]: The path to serve and its content encoding,
+            or None when serving the uncompressed file.
+    """
+    accepted = parse_accept_encoding(
+        request.headers.get("accept-encoding", "")
+    )
+    for encoding, extension in ENCODINGS.items():
+        if encoding not in accepted and "*" not in accepted:
+            continue
+
+        sibling = f"{path}.{extension}"
+        # A sibling older than the file is stale
+        if os.path.isfile(sibling) and os.path.getmtime(
+            sibling
+        ) >= os.path.getmtime(path):
+            return sibling, encoding
+
+    return path, None
@@ -0,0 +1,177 @@
+""" This module pushes video processing events to clients. """
+import json
+from typing import AsyncIterator, Callable
+
+from fastapi import WebSocket
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketDisconnect
+
+from app.database import get_db
+from app.models.video_models import Video
+from app.services.broker import broker
+from app.settings import EVENT_KEEPALIVE_INTERVAL
+
+# Events after which nothing more happens to a video
+FINAL_EVENTS = {"processed", "failed"}
+
+SSE_HEADERS = {
+    "cache-control": "no-store",
+    # Stop reverse proxies from buffering the stream
+    "x-accel-buffering": "no",
+}
+
+
+def video_snapshot(video: Video) -> dict:
+    """
+    Describes the current state of a video as an event, so a client that
+    subscribes late doesn't miss the stages already reached.
+
+    Args:
+        video (Video): The video.
+
+    Returns:
+        dict: The event.
+    """
+    if video.status == "failed":
+        event = "failed"
+    elif video.thumbnail_location and video.transcript_location:
+        event = "processed"
+    else:
+        event = "status"
+
+    return {
+        "event": event,
+        "video_id": video.id,
+        "status": video.status,
+        "thumbnail_ready": bool(video.thumbnail_location),
+        "transcript_ready": bool(video.transcript_location),
+    }
+
+
+def format_event(message: dict) -> str:
+    """
+    Formats an event as a Server-Sent Event.
+
+    Args:
+        message (dict): The event.
+
+    Returns:
+        str: The event in the text/event-stream format.
+    """
+    return f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+
+
+def load_video(video_id: str) -> Video | None:
+    """
+    Reads a video in a session of its own. Blocking, so async callers run
+    it in the threadpool.
+
+    Args:
+        video_id (str): The ID of the video.
+
+    Returns:
+        Video | None: The video, detached from the session, or None.
+    """
+    db = next(get_db())
+    try:
+        return db.query(Video).filter(Video.id == video_id).first()
+    finally:
+        db.close()
+
+
+def read_video_snapshot(video_id: str) -> dict | None:
+    """
+    Reads the current state of a video as an event, see `video_snapshot`.
+
+    Args:
+        video_id (str): The ID of the video.
+
+    Returns:
+        dict | None: The event, or None if the video is gone.
+    """
+    video = load_video(video_id)
+
+    return video_snapshot(video) if video else None
+
+
+async def iter_events(
+    topic: str, snapshot: Callable[[], dict | None] | None = None
+) -> AsyncIterator[dict | None]:
+    """
+    Yields the events of a topic, and None every
+    `EVENT_KEEPALIVE_INTERVAL` seconds without one so the caller can keep
+    its connection open. Events on a video topic end after a final event.
+
+    The topic is only subscribed to once the iteration starts, and
+    unsubscribed from when it stops, so a client that goes away before
+    leaves nothing behind.
+
+    Args:
+        topic (str): The topic to subscribe to.
+        snapshot (Callable[[], dict | None], optional): Reads the current
+            state once subscribed, so no event falls in between. It runs
+            in the threadpool, and its event is sent first.
+
+    Yields:
+        dict | None: The next event, or None to keep the connection alive.
+    """
+    subscription = broker.subscribe(topic)
+    ends = topic.startswith("video:")
+    try:
+        initial = await run_in_threadpool(snapshot) if snapshot else None
+        if initial:
+            yield initial
+            if ends and initial["event"] in FINAL_EVENTS:
+                return
+
+        while True:
+            message = await subscription.get(EVENT_KEEPALIVE_INTERVAL)
+            yield message
+            if ends and message and message["event"] in FINAL_EVENTS:
+                return
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def sse_events(
+    topic: str, snapshot: Callable[[], dict | None] | None = None
+) -> AsyncIterator[str]:
+    """
+    Yields the events of a topic as Server-Sent Events.
+
+    Args:
+        topic (str): The topic to subscribe to.
+        snapshot (Callable[[], dict | None], optional): Reads the event to
+            send first, see `iter_events`.
+
+    Yields:
+        str: The next event, or a keep-alive comment.
+    """
+    async for message in iter_events(topic, snapshot):
+        yield format_event(message) if message else ": keepalive\n\n"
+
+
+async def websocket_events(
+    websocket: WebSocket,
+    topic: str,
+    snapshot: Callable[[], dict | None] | None = None,
+) -> None:
+    """
+    Sends the events of a topic over a WebSocket as JSON messages, then
+    closes it once the events end.
+
+    Args:
+        websocket (WebSocket): The accepted WebSocket.
+        topic (str): The topic to subscribe to.
+        snapshot (Callable[[], dict | None], optional): Reads the event to
+            send first, see `iter_events`.
+    """
+    events = iter_events(topic, snapshot)
+    try:
+        async for message in events:
+            await websocket.send_json(message or {"event": "ping"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await events.aclose()
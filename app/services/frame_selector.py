@@ -0,0 +1,125 @@
+""" This module picks a representative frame of a video for its thumbnail. """
+import math
+import subprocess
+
+# Candidate frames are scored at this size; enough to spot blank frames
+SAMPLE_WIDTH = 64
+SAMPLE_HEIGHT = 36
+SAMPLE_SIZE = SAMPLE_WIDTH * SAMPLE_HEIGHT
+
+# How many candidates to score, spread over the opening seconds
+CANDIDATE_COUNT = 8
+SEARCH_WINDOW = 10.0
+
+# Frames darker or flatter than this are black or blank (0-255 luma)
+BLACK_LUMA = 24
+BLANK_DEVIATION = 6
+
+# A scene change is worth this much detail when scoring a candidate
+SCENE_CHANGE_WEIGHT = 0.5
+
+
+def sample_frames(
+    video_path: str, duration: float | None
+) -> list[tuple[float, bytes]]:
+    """
+    Decodes evenly spaced low-resolution grayscale frames from the start of
+    a video, in a single ffmpeg run.
+
+    Args:
+        video_path (str): The path to the video.
+        duration (float | None): The length of the video in seconds, or
+            None if unknown.
+
+    Returns:
+        list[tuple[float, bytes]]: The timestamp and the raw luma plane of
+            every sampled frame.
+    """
+    window = SEARCH_WINDOW
+    if duration and duration > 0:
+        window = min(window, duration)
+    rate = CANDIDATE_COUNT / window
+
+    command = [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-t",
+        f"{window:.3f}",
+        "-i",
+        video_path,
+        "-an",
+        "-vf",
+        f"fps={rate:.6f},scale={SAMPLE_WIDTH}:{SAMPLE_HEIGHT},format=gray",
+        "-f",
+        "rawvideo",
+        "-",
+    ]
+    result = subprocess.run(command, capture_output=True, check=False)
+
+    frames = []
+    data = result.stdout
+    for index in range(len(data) // SAMPLE_SIZE):
+        frame = data[index * SAMPLE_SIZE:(index + 1) * SAMPLE_SIZE]
+        frames.append((min(index / rate, window), frame))
+
+    return frames
+
+
+def score_frame(frame: bytes, previous: bytes | None) -> float:
+    """
+    Scores a candidate frame; detailed frames that differ from the one
+    before score higher, black or blank frames score far lower.
+
+    Args:
+        frame (bytes): The luma plane of the frame.
+        previous (bytes | None): The luma plane of the previous candidate.
+
+    Returns:
+        float: The score of the frame.
+    """
+    mean = sum(frame) / len(frame)
+    deviation = math.sqrt(
+        max(sum(value * value for value in frame) / len(frame) - mean**2, 0)
+    )
+
+    change = 0.0
+    if previous is not None:
+        change = sum(
+            abs(value - before) for value, before in zip(frame, previous)
+        ) / len(frame)
+
+    score = deviation + SCENE_CHANGE_WEIGHT * change
+    if mean < BLACK_LUMA or deviation < BLANK_DEVIATION:
+        score -= 1000
+
+    return score
+
+
+def select_thumbnail_time(video_path: str, duration: float | None) -> float:
+    """
+    Picks the timestamp of the best thumbnail frame among a few candidates
+    from the start of a video.
+
+    Args:
+        video_path (str): The path to the video.
+        duration (float | None): The length of the video in seconds, or
+            None if unknown.
+
+    Returns:
+        float: The timestamp in seconds, within the video. Falls back to the
+            first frame when no candidate could be decoded.
+    """
+    best_time, best_score = 0.0, -math.inf
+    previous = None
+    for timestamp, frame in sample_frames(video_path, duration):
+        score = score_frame(frame, previous)
+        if score > best_score:
+            best_time, best_score = timestamp, score
+        previous = frame
+
+    if duration and duration > 0:
+        # Seeking to the very end of a clip yields no frame
+        best_time = min(best_time, max(duration - 0.1, 0.0))
+
+    return best_time
@@ -1,127 +1,223 @@
-""" This module contains the functions for sending emails to users. """
-import smtplib
-import ssl
+""" This module renders emails and queues them in the outbox. """
+import datetime
+import json
+import os
+import threading
 from email.message import EmailMessage
 from email.utils import formataddr
 
 import pystache
 from mjml import mjml_to_html
-
-from app.settings import (
-    EMAIL_NAME,
-    EMAIL_ADDRESS,
-    EMAIL_PASSWORD,
-    EMAIL_HOST,
-    EMAIL_PORT,
-)
-
-
-def send_video(username: str, video_id: str, recipient_address: str):
+from pystache.parsed import ParsedTemplate
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from app.models.mail_models import OutboxMail
+from app.settings import DB_TYPE, EMAIL_ADDRESS, EMAIL_NAME
+
+VIDEO_MAIL_TEMPLATE = "app/services/video_mail.mjml"
+OTP_MAIL_TEMPLATE = "app/services/forgot_password.mjml"
+WELCOME_MAIL_TEMPLATE = "app/services/welcome.mjml"
+# The templates by the name stored in the outbox
+MAIL_TEMPLATES = {
+    "video": VIDEO_MAIL_TEMPLATE,
+    "otp": OTP_MAIL_TEMPLATE,
+    "welcome": WELCOME_MAIL_TEMPLATE,
+}
+
+# Compiled templates: path -> (modification time, parsed mustache template)
+_compiled_templates: dict[str, tuple[int, ParsedTemplate]] = {}
+_compiled_templates_lock = threading.Lock()
+_renderer = pystache.Renderer()
+
+
+def get_mail_template(path: str) -> ParsedTemplate:
     """
-    Sends an email to the user with the video embedded in the email.
+    Returns an MJML template compiled to HTML and parsed as a mustache
+    template. Templates are compiled once and again only when their file
+    changes.
 
     Parameters:
-        username (str): The username of the sender.
-        video_id (str): The ID of the video to be sent to the user.
-        recipient_address (str): The email address where video will be sent.
+        path (str): The path of the MJML template.
 
     Returns:
-        message (str): A message indicating whether the email was sent
-            successfully.
+        ParsedTemplate: The parsed template.
     """
-    msg = EmailMessage()
-    msg["Subject"] = "HelpMeOut Screen Recorder"
-    msg["From"] = formataddr((EMAIL_NAME, EMAIL_ADDRESS))
-    msg["To"] = recipient_address
-
-    with open("app/services/video_mail.mjml", "rb") as f:
-        mail = mjml_to_html(f)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _compiled_templates.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-    mail = mail.html
-    context = {
-        "username": username,
-        "video_id": video_id,
-    }
-    mail = pystache.render(mail, context)
+    # Compile outside of the lock, a concurrent compile only wastes time
+    with open(path, "rb") as file:
+        html = mjml_to_html(file).html
+    template = pystache.parse(html)
 
-    msg.set_content(mail, subtype="html")
+    with _compiled_templates_lock:
+        _compiled_templates[path] = (mtime, template)
 
-    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as smtp:
-        smtp.starttls(context=ssl.create_default_context())
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    return template
 
 
-def send_otp(recipient_address: str, otp: str, subject: str) -> None:
+def render_mail(path: str, context: dict) -> str:
     """
-    Sends an email to the user with the video embedded in the email.
+    Renders an MJML template to HTML.
 
     Parameters:
-        recipient_address (str): The email address of the user.
-        otp (str): The OTP to be sent to the user.
+        path (str): The path of the MJML template.
+        context (dict): The values of the template variables.
 
     Returns:
-        message (str): A message indicating whether the email was sent
-            successfully.
+        str: The HTML of the email.
     """
+    return _renderer.render(get_mail_template(path), context)
 
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = formataddr((EMAIL_NAME, EMAIL_ADDRESS))
-    msg["To"] = recipient_address
-
-    with open("app/services/forgot_password.mjml", "rb") as file:
-        mail = mjml_to_html(file)
-
-    mail = mail.html
-    context = {
-        "verification_code": otp,
-    }
-    mail = pystache.render(mail, context)
-
-    msg.set_content(mail, subtype="html")
 
-    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as smtp:
-        smtp.starttls(context=ssl.create_default_context())
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
-
-    return None
+def warm_mail_templates() -> None:
+    """
+    Compiles the mail templates, so the first emails don't wait for MJML.
+    """
+    for path in MAIL_TEMPLATES.values():
+        try:
+            get_mail_template(path)
+        except (OSError, ValueError) as err:
+            print(f"Could not compile mail template {path}: {err}")
 
 
-def send_welcome_mail(recipient_address: str, username: str) -> None:
+def build_message(mail: OutboxMail) -> EmailMessage:
     """
-    Sends a welcome email to a new user.
+    Renders a queued email.
 
     Parameters:
-        recipient_address (str): The email address of the recipient.
-        username (str): The username of the sender.
+        mail (OutboxMail): The queued email.
 
     Returns:
-        message (str): A message indicating whether the email was sent
-        successfully.
+        EmailMessage: The message, ready to be sent.
     """
-
     msg = EmailMessage()
-    msg["Subject"] = "Welcome, welcome, welcome!"
+    msg["Subject"] = mail.subject
     msg["From"] = formataddr((EMAIL_NAME, EMAIL_ADDRESS))
-    msg["To"] = recipient_address
+    msg["To"] = mail.recipient
+
+    context = json.loads(mail.context)
+    msg.set_content(
+        render_mail(MAIL_TEMPLATES[mail.template], context), subtype="html"
+    )
+
+    return msg
 
-    with open("app/services/welcome.mjml", "rb") as file:
-        mail = mjml_to_html(file)
 
-    mail = mail.html
-    context = {
-        "username": username,
-        "link": "https://helpmeout.tech"
+def queue_mail(
+    db: Session,
+    dedupe_key: str,
+    recipient: str,
+    subject: str,
+    template: str,
+    context: dict,
+) -> None:
+    """
+    Adds an email to the outbox, unless one with the same key is already
+    there, and wakes up the mail worker.
+
+    Parameters:
+        db (Session): The database session.
+        dedupe_key (str): Identifies the message.
+        recipient (str): The email address of the recipient.
+        subject (str): The subject of the email.
+        template (str): The name of the template, a key of MAIL_TEMPLATES.
+        context (dict): The values of the template variables.
+    """
+    values = {
+        "dedupe_key": dedupe_key,
+        "recipient": recipient,
+        "subject": subject,
+        "template": template,
+        "context": json.dumps(context),
     }
-    mail = pystache.render(mail, context)
+    if DB_TYPE == "mysql":
+        statement = (
+            mysql.insert(OutboxMail).values(**values).prefix_with("IGNORE")
+        )
+    else:
+        statement = (
+            sqlite.insert(OutboxMail)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["dedupe_key"])
+        )
+    db.execute(statement)
+    db.commit()
+
+    # Imported here, the worker imports this module to render messages
+    from app.services.mail_worker import wake_mail_worker
+
+    wake_mail_worker()
+
+
+def queue_video_mail(
+    db: Session, username: str, video_id: str, recipient_address: str
+) -> None:
+    """
+    Queues an email to the user with the video embedded in the email.
+    Sharing the same video with the same address twice in a day sends one
+    email.
 
-    msg.set_content(mail, subtype="html")
+    Parameters:
+        db (Session): The database session.
+        username (str): The username of the sender.
+        video_id (str): The ID of the video to be sent to the user.
+        recipient_address (str): The email address where video will be sent.
+    """
+    today = datetime.date.today().isoformat()
+    queue_mail(
+        db,
+        f"video:{video_id}:{recipient_address.lower()}:{today}",
+        recipient_address,
+        "HelpMeOut Screen Recorder",
+        "video",
+        {"username": username, "video_id": video_id},
+    )
+
+
+def queue_otp(
+    db: Session, recipient_address: str, otp: str, subject: str
+) -> None:
+    """
+    Queues an email with a one-time code. Every call sends one, even when
+    a code is issued again.
 
-    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as smtp:
-        smtp.starttls(context=ssl.create_default_context())
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    Parameters:
+        db (Session): The database session.
+        recipient_address (str): The email address of the user.
+        otp (str): The OTP to be sent to the user.
+        subject (str): The subject of the email.
+    """
+    queue_mail(
+        db,
+        f"otp:{recipient_address.lower()}:{otp}:"
+        f"{datetime.datetime.utcnow().isoformat()}",
+        recipient_address,
+        subject,
+        "otp",
+        {"verification_code": otp},
+    )
+
+
+def queue_welcome_mail(
+    db: Session, recipient_address: str, username: str
+) -> None:
+    """
+    Queues the welcome email of a new user, once per username.
 
-    return None
+    Parameters:
+        db (Session): The database session.
+        recipient_address (str): The email address of the recipient.
+        username (str): The username of the new user.
+    """
+    queue_mail(
+        db,
+        f"welcome:{username.lower()}",
+        recipient_address,
+        "Welcome, welcome, welcome!",
+        "welcome",
+        {"username": username, "link": "https://helpmeout.tech"},
+    )
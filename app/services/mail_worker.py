@@ -0,0 +1,301 @@
+""" A background worker sending the outbox over a reused SMTP connection. """
+import datetime
+import smtplib
+import ssl
+import threading
+import time
+from email.message import EmailMessage
+
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app.models.mail_models import OutboxMail
+from app.services.mail_service import build_message
+from app.settings import (
+    EMAIL_ADDRESS,
+    EMAIL_HOST,
+    EMAIL_PASSWORD,
+    EMAIL_PORT,
+    EMAIL_STARTTLS,
+    MAIL_BATCH_SIZE,
+    MAIL_MAX_ATTEMPTS,
+    MAIL_POLL_INTERVAL,
+    MAIL_RETENTION_DAYS,
+    MAIL_RETRY_DELAY,
+    MAIL_SMTP_IDLE_TIMEOUT,
+)
+
+# How long a claimed message is hidden from other workers, so it is retried
+# if the worker holding it dies
+CLAIM_TIMEOUT = 300
+# The longest wait between two attempts
+MAX_RETRY_DELAY = 6 * 3600
+
+_wake_event = threading.Event()
+_stop_event = threading.Event()
+_thread: threading.Thread | None = None
+
+
+class SmtpConnection:
+    """
+    An authenticated SMTP connection, opened on first use and reused for
+    the following messages until it has been idle for `idle_timeout`.
+    """
+
+    def __init__(self, idle_timeout: float = MAIL_SMTP_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._smtp: smtplib.SMTP | None = None
+        self._last_used = 0.0
+
+    def _open(self) -> smtplib.SMTP:
+        """Connects, upgrades to TLS and logs in."""
+        smtp = smtplib.SMTP(EMAIL_HOST, int(EMAIL_PORT or 25), timeout=30)
+        try:
+            if EMAIL_STARTTLS:
+                smtp.starttls(context=ssl.create_default_context())
+            if EMAIL_PASSWORD:
+                smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        except (OSError, smtplib.SMTPException):
+            smtp.close()
+            raise
+
+        return smtp
+
+    def send(self, message: EmailMessage) -> None:
+        """
+        Sends a message, reconnecting once if the server hung up.
+
+        Args:
+            message (EmailMessage): The message.
+
+        Raises:
+            OSError | smtplib.SMTPException: If the message was not sent.
+        """
+        self.close_if_idle()
+        if self._smtp is None:
+            self._smtp = self._open()
+
+        try:
+            self._smtp.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self._smtp = self._open()
+            self._smtp.send_message(message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # The server rejected this message, the session is still usable
+            self._last_used = time.monotonic()
+            raise
+        except (OSError, smtplib.SMTPException):
+            # Don't reuse a connection in an unknown state
+            self.close()
+            raise
+
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self) -> None:
+        """Closes the connection if it has not been used for a while."""
+        if time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+
+    def close(self) -> None:
+        """Closes the connection."""
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            self._smtp.close()
+        self._smtp = None
+
+
+def is_permanent_failure(err: Exception) -> bool:
+    """
+    Checks if an error will happen again on retry, like an invalid
+    recipient or a message that can't be rendered.
+
+    Args:
+        err (Exception): The error raised while rendering or sending.
+
+    Returns:
+        bool: True if the message should not be retried.
+    """
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return True
+
+    # Like a message that can't be rendered, it won't render on retry
+    if not isinstance(err, (OSError, smtplib.SMTPException)):
+        return True
+
+    return isinstance(err, smtplib.SMTPResponseException) and (
+        500 <= err.smtp_code < 600
+    )
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Returns the wait before the next attempt, doubling after every failure.
+
+    Args:
+        attempts (int): The number of failed attempts.
+
+    Returns:
+        float: The delay, in seconds.
+    """
+    return min(MAIL_RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def deliver_outbox(
+    connection: SmtpConnection, limit: int = MAIL_BATCH_SIZE
+) -> int:
+    """
+    Sends a batch of due messages from the outbox over one connection.
+
+    Every message is claimed before it is sent, so several workers can
+    share the outbox without sending a message twice.
+
+    Args:
+        connection (SmtpConnection): The SMTP connection.
+        limit (int, optional): The size of the batch.
+
+    Returns:
+        int: The number of messages attempted.
+    """
+    db = next(get_db())
+    try:
+        now = datetime.datetime.utcnow()
+        # Plain values, the commit after every claim expires ORM objects and
+        # reloading them would compare against another worker's claim
+        due = (
+            db.query(OutboxMail.id, OutboxMail.next_attempt_at)
+            .filter(
+                OutboxMail.status == "pending",
+                OutboxMail.next_attempt_at <= now,
+            )
+            .order_by(OutboxMail.id)
+            .limit(limit)
+            .all()
+        )
+
+        attempted = 0
+        for mail_id, next_attempt_at in due:
+            claimed = (
+                db.query(OutboxMail)
+                .filter(
+                    OutboxMail.id == mail_id,
+                    OutboxMail.status == "pending",
+                    OutboxMail.next_attempt_at == next_attempt_at,
+                )
+                .update(
+                    {
+                        "next_attempt_at": now
+                        + datetime.timedelta(seconds=CLAIM_TIMEOUT)
+                    },
+                    synchronize_session=False,
+                )
+            )
+            db.commit()
+            if not claimed:
+                continue
+
+            mail = db.get(OutboxMail, mail_id)
+            attempted += 1
+            # Any error only fails this message, so the claim is released
+            try:
+                connection.send(build_message(mail))
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"Failed to send mail {mail.dedupe_key}: {err}")
+                mail.attempts += 1
+                mail.last_error = str(err)
+                if (
+                    is_permanent_failure(err)
+                    or mail.attempts >= MAIL_MAX_ATTEMPTS
+                ):
+                    mail.status = "failed"
+                else:
+                    mail.next_attempt_at = datetime.datetime.utcnow() + (
+                        datetime.timedelta(seconds=retry_delay(mail.attempts))
+                    )
+            else:
+                mail.status = "sent"
+                mail.sent_date = datetime.datetime.utcnow()
+            db.commit()
+
+        return attempted
+    finally:
+        db.close()
+
+
+def prune_sent_mail(
+    db: Session,
+    retention_days: int = MAIL_RETENTION_DAYS,
+    dry_run: bool = False,
+) -> int:
+    """
+    Deletes the messages sent more than `retention_days` ago from the
+    outbox. The caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        retention_days (int, optional): How long sent messages are kept.
+        dry_run (bool, optional): Only count the messages. Defaults to
+            False.
+
+    Returns:
+        int: The number of messages deleted, or that would be.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=retention_days
+    )
+    expired = db.query(OutboxMail).filter(
+        OutboxMail.status == "sent", OutboxMail.sent_date < cutoff
+    )
+    if dry_run:
+        return expired.count()
+
+    return expired.delete(synchronize_session=False)
+
+
+def _run_mail_worker():
+    """Sends the outbox until the worker is stopped."""
+    connection = SmtpConnection()
+    while not _stop_event.is_set():
+        try:
+            attempted = deliver_outbox(connection)
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"Mail worker failed: {err}")
+            attempted = 0
+
+        # Keep going while there is a backlog, otherwise sleep until a
+        # message is queued or retries are due
+        if attempted < MAIL_BATCH_SIZE:
+            _wake_event.wait(min(MAIL_POLL_INTERVAL, connection.idle_timeout))
+            _wake_event.clear()
+
+    connection.close()
+
+
+def wake_mail_worker():
+    """Makes the mail worker check the outbox now."""
+    _wake_event.set()
+
+
+def start_mail_worker():
+    """Starts the mail worker thread."""
+    global _thread  # pylint: disable=global-statement
+
+    _stop_event.clear()
+    _thread = threading.Thread(
+        target=_run_mail_worker, name="mail-worker", daemon=True
+    )
+    _thread.start()
+
+
+def stop_mail_worker():
+    """Stops the mail worker after its current message."""
+    global _thread  # pylint: disable=global-statement
+
+    _stop_event.set()
+    _wake_event.set()
+    if _thread:
+        _thread.join(timeout=30)
+        _thread = None
@@ -0,0 +1,98 @@
+""" This module issues and verifies the signed tokens of media URLs. """
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Request
+from jose import JWTError, jwt
+
+from app.services.services import is_owner
+from app.settings import MEDIA_TOKEN_TTL, SECRET_KEY
+
+MEDIA_TOKEN_ALGORITHM = "HS256"
+
+# Verified tokens, so the range requests of a playback skip the signature
+# check: token -> (video ID, expiry timestamp)
+VERIFIED_TOKENS_SIZE = 4096
+_verified_tokens: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
+
+def issue_media_token(video_id: str, ttl: int = MEDIA_TOKEN_TTL) -> str:
+    """
+    Issues a token granting access to the media of a video.
+
+    Args:
+        video_id (str): The ID of the video.
+        ttl (int, optional): The lifetime of the token, in seconds.
+
+    Returns:
+        str: The signed token.
+    """
+    claims = {"sub": video_id, "exp": int(time.time()) + ttl}
+    return jwt.encode(claims, SECRET_KEY, algorithm=MEDIA_TOKEN_ALGORITHM)
+
+
+def verify_media_token(token: str, video_id: str) -> bool:
+    """
+    Checks that a token grants access to the media of a video.
+
+    Args:
+        token (str): The token from the media URL.
+        video_id (str): The ID of the requested video.
+
+    Returns:
+        bool: True if the token is valid for the video and not expired.
+    """
+    now = time.time()
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(token)
+        if cached:
+            _verified_tokens.move_to_end(token)
+
+    if cached:
+        return cached[0] == video_id and now < cached[1]
+
+    try:
+        claims = jwt.decode(
+            token, SECRET_KEY, algorithms=[MEDIA_TOKEN_ALGORITHM]
+        )
+    except JWTError:
+        return False
+
+    subject, expiry = claims.get("sub"), claims.get("exp")
+    if not isinstance(subject, str) or not isinstance(expiry, (int, float)):
+        return False
+
+    with _verified_tokens_lock:
+        _verified_tokens[token] = (subject, expiry)
+        if len(_verified_tokens) > VERIFIED_TOKENS_SIZE:
+            _verified_tokens.popitem(last=False)
+
+    return subject == video_id and now < expiry
+
+
+def can_access_media(
+    request: Request, video_id: str, is_public: bool, owner: str
+) -> bool:
+    """
+    Checks if a request may read the media of a video: public videos are
+    open, private ones need a media token or the owner's session.
+
+    Args:
+        request (Request): The FastAPI request object.
+        video_id (str): The ID of the video.
+        is_public (bool): Whether the video is public.
+        owner (str): The username of the video owner.
+
+    Returns:
+        bool: True if access is granted.
+    """
+    if is_public:
+        return True
+
+    token = request.query_params.get("token")
+    if token:
+        return verify_media_token(token, video_id)
+
+    return is_owner(request, owner)
@@ -0,0 +1,200 @@
+""" This module moves videos from the per-user to the sharded layout.
+
+It runs while the app serves requests: every video is moved with one
+rename and its stored locations are updated right after, in batches.
+Videos still uploading or processing are skipped, run it again later to
+move them.
+
+Usage: python -m app.services.migrate_layout [--batch-size N] [--dry-run]
+"""
+import argparse
+import os
+
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app.models.video_models import Video
+from app.services.paths import get_sharded_video_dir
+from app.services.stats_service import get_video_directory
+from app.services.storage import (
+    get_storage,
+    is_remote_storage,
+    media_key,
+    publish_files,
+)
+
+LOCATION_COLUMNS = (
+    "original_location",
+    "compressed_location",
+    "thumbnail_location",
+    "transcript_location",
+)
+
+
+def is_settled(video: Video) -> bool:
+    """
+    Checks that no upload or processing is writing to a video directory.
+
+    Args:
+        video (Video): The video.
+
+    Returns:
+        bool: True if the video can be moved.
+    """
+    if video.status == "failed":
+        return True
+
+    return video.status == "completed" and bool(video.thumbnail_location)
+
+
+def relocate(path: str | None, old_dir: str, new_dir: str) -> str | None:
+    """
+    Returns the path of a file once its directory has moved.
+
+    Args:
+        path (str | None): The stored path of the file.
+        old_dir (str): The previous directory of the video.
+        new_dir (str): The new directory of the video.
+
+    Returns:
+        str | None: The new path, or None if the file is elsewhere.
+    """
+    if not path:
+        return None
+
+    old_dir = os.path.abspath(old_dir)
+    absolute = os.path.abspath(path)
+    if not absolute.startswith(old_dir + os.sep):
+        return None
+
+    return os.path.join(new_dir, os.path.relpath(absolute, old_dir))
+
+
+def migrate_video(db: Session, video: Video, dry_run: bool = False) -> bool:
+    """
+    Moves the directory of a video to the sharded layout and updates its
+    stored locations. The caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video.
+        dry_run (bool, optional): Only check if the video would move.
+
+    Returns:
+        bool: True if the video was (or would be) moved.
+    """
+    old_dir = os.path.abspath(get_video_directory(video))
+    new_dir = os.path.abspath(get_sharded_video_dir(video.id))
+    if old_dir == new_dir:
+        return False
+
+    if os.path.isdir(old_dir):
+        if os.path.exists(new_dir):
+            print(f"Skipping {video.id}: {new_dir} already exists.")
+            return False
+        if dry_run:
+            return True
+        os.makedirs(os.path.dirname(new_dir), exist_ok=True)
+        os.rename(old_dir, new_dir)
+
+        # Drop the user directory once its last video moved
+        try:
+            os.rmdir(os.path.dirname(old_dir))
+        except OSError:
+            pass
+    elif not os.path.isdir(new_dir):
+        # Nothing on disk to move, like a recording without chunks yet
+        return False
+    elif dry_run:
+        return True
+
+    # Also repairs the rows of a previous run interrupted after the rename
+    for column in LOCATION_COLUMNS:
+        location = relocate(getattr(video, column), old_dir, new_dir)
+        if location:
+            setattr(video, column, location)
+    db.flush()
+
+    # Move the published copies along
+    if is_remote_storage():
+        publish_files(
+            [
+                os.path.join(root, name)
+                for root, _, files in os.walk(new_dir)
+                for name in files
+            ],
+            video,
+        )
+        if old_key := media_key(old_dir):
+            get_storage().delete_prefix(f"{old_key}/")
+
+    return True
+
+
+def migrate_layout(
+    db: Session, batch_size: int = 100, dry_run: bool = False
+) -> int:
+    """
+    Moves every settled video to the sharded layout, committing after
+    every batch.
+
+    Args:
+        db (Session): The database session.
+        batch_size (int, optional): The number of videos per batch.
+        dry_run (bool, optional): Only count the videos to move.
+
+    Returns:
+        int: The number of videos moved, or to move on a dry run.
+    """
+    moved = 0
+    last_id = ""
+    while True:
+        batch = (
+            db.query(Video)
+            .filter(Video.id > last_id)
+            .order_by(Video.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        for video in batch:
+            if is_settled(video):
+                try:
+                    moved += migrate_video(db, video, dry_run)
+                except OSError as err:
+                    print(f"Failed to move video {video.id}: {err}")
+        db.commit()
+
+        last_id = batch[-1].id
+        print(f"{moved} videos {'to move' if dry_run else 'moved'} so far")
+
+    return moved
+
+
+def main():
+    """ The main function """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="the number of videos updated per transaction",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="count the videos to move without moving anything",
+    )
+    args = parser.parse_args()
+
+    db = next(get_db())
+    try:
+        migrate_layout(db, args.batch_size, args.dry_run)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+""" This module hashes and checks passwords off the event loop. """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from app.settings import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS
+
+# bcrypt releases the GIL, so a few threads hash in parallel; the bound
+# keeps a burst of logins from starving the rest of the worker
+_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt"
+)
+
+
+def _as_bytes(value: str | bytes) -> bytes:
+    """Returns a stored hash as bytes, whatever the column returned."""
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+def hash_password(password: str) -> bytes:
+    """
+    Hashes a password with the configured cost factor.
+
+    Args:
+        password (str): The password to be hashed.
+
+    Returns:
+        bytes: The hashed password.
+    """
+    return bcrypt.hashpw(
+        password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    )
+
+
+def check_password(password: str, hashed_password: str | bytes) -> bool:
+    """
+    Checks a password against its hash.
+
+    Args:
+        password (str): The password to check.
+        hashed_password (str | bytes): The stored hash.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    try:
+        return bcrypt.checkpw(
+            password.encode("utf-8"), _as_bytes(hashed_password)
+        )
+    except ValueError:
+        # Not a bcrypt hash, so no password can match it
+        return False
+
+
+def needs_rehash(hashed_password: str | bytes) -> bool:
+    """
+    Checks if a hash was made with a different cost factor than the
+    configured one.
+
+    Args:
+        hashed_password (str | bytes): The stored hash, like
+            "$2b$12$<salt and hash>".
+
+    Returns:
+        bool: True if the password should be hashed again.
+    """
+    parts = _as_bytes(hashed_password).split(b"$")
+    return len(parts) < 4 or parts[2] != b"%02d" % BCRYPT_ROUNDS
+
+
+async def hash_password_async(password: str) -> bytes:
+    """
+    Hashes a password in the hashing pool.
+
+    Args:
+        password (str): The password to be hashed.
+
+    Returns:
+        bytes: The hashed password.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, hash_password, password)
+
+
+async def check_password_async(
+    password: str, hashed_password: str | bytes
+) -> bool:
+    """
+    Checks a password against its hash in the hashing pool.
+
+    Args:
+        password (str): The password to check.
+        hashed_password (str | bytes): The stored hash.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, check_password, password, hashed_password
+    )
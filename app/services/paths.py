@@ -0,0 +1,116 @@
+""" This module resolves where the files of a video are stored.
+
+New videos live in a sharded directory, `SHARDED_VIDEO_DIR/ab/cd/<video_id>`
+where "abcd" starts the SHA-1 of the video ID, so no directory grows with
+the number of users or videos. Videos stored before the sharded layout
+stay in `VIDEO_DIR/<username>/<video_id>` until they are migrated with
+`python -m app.services.migrate_layout`. Videos demoted by the tiering
+job move to the same sharded layout under `COLD_VIDEO_DIR`.
+"""
+import hashlib
+import os
+
+from app.settings import (
+    COLD_VIDEO_DIR,
+    MEDIA_LAYOUT,
+    SHARDED_VIDEO_DIR,
+    VIDEO_DIR,
+    VIDEO_MIME_TYPE,
+)
+
+
+def get_sharded_video_dir(video_id: str) -> str:
+    """
+    Returns the directory of a video in the sharded layout.
+
+    Args:
+        video_id: The ID of the video.
+
+    Returns:
+        The path to the video directory.
+    """
+    return _shard(SHARDED_VIDEO_DIR, video_id)
+
+
+def get_cold_video_dir(video_id: str) -> str:
+    """
+    Returns the directory of a video once moved to cold storage.
+
+    Args:
+        video_id: The ID of the video.
+
+    Returns:
+        The path to the video directory.
+    """
+    return _shard(COLD_VIDEO_DIR, video_id)
+
+
+def _shard(root: str, video_id: str) -> str:
+    """
+    Returns the sharded directory of a video under a storage root.
+
+    Args:
+        root: The storage root.
+        video_id: The ID of the video.
+
+    Returns:
+        The path to the video directory.
+    """
+    digest = hashlib.sha1(video_id.encode("utf-8")).hexdigest()
+
+    return os.path.join(root, digest[:2], digest[2:4], video_id)
+
+
+def get_legacy_video_dir(username: str, video_id: str) -> str:
+    """
+    Returns the directory of a video in the per-user layout.
+
+    Args:
+        username: The user associated with the video.
+        video_id: The ID of the video.
+
+    Returns:
+        The path to the video directory.
+    """
+    return os.path.join(VIDEO_DIR, username, video_id)
+
+
+def get_video_dir(username: str, video_id: str) -> str:
+    """
+    Returns the directory holding the files of a video: the sharded one,
+    unless the video still lives in the per-user layout.
+
+    Args:
+        username: The user associated with the video.
+        video_id: The ID of the video.
+
+    Returns:
+        The path to the video directory.
+    """
+    sharded_dir = get_sharded_video_dir(video_id)
+    legacy_dir = get_legacy_video_dir(username, video_id)
+
+    if MEDIA_LAYOUT == "legacy":
+        return sharded_dir if os.path.isdir(sharded_dir) else legacy_dir
+
+    if not os.path.isdir(sharded_dir) and os.path.isdir(legacy_dir):
+        return legacy_dir
+
+    return sharded_dir
+
+
+def get_blob_path(username: str, video_id: str, blob_index: int) -> str:
+    """
+    Returns the path where a video blob/chunk is stored.
+
+    Args:
+        username: The user associated with the blob.
+        video_id: The ID of the video associated with the blob.
+        blob_index: The index of the blob.
+
+    Returns:
+        The path to the blob.
+    """
+    blob_filename = f"{blob_index}.{VIDEO_MIME_TYPE}"
+
+    return os.path.join(get_video_dir(username, video_id), blob_filename)
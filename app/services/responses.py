@@ -0,0 +1,122 @@
+""" This module contains helpers for building HTTP responses. """
+import os
+from email.utils import parsedate_to_datetime
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+from app.services.compression import negotiate_file
+
+
+def is_not_modified(request: Request, response: Response) -> bool:
+    """
+    Checks the conditional headers of a request against the validators of
+    a response.
+
+    Args:
+        request (Request): The request object.
+        response (Response): The response carrying `etag` and
+            `last-modified` headers.
+
+    Returns:
+        bool: True if the client's cached copy is still valid.
+    """
+    if if_none_match := request.headers.get("if-none-match"):
+        etags = {tag.strip() for tag in if_none_match.split(",")}
+        etag = response.headers.get("etag")
+        return "*" in etags or (etag is not None and etag in etags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    last_modified = response.headers.get("last-modified")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(
+                last_modified
+            ) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def cached_file_response(
+    request: Request,
+    path: str,
+    media_type: str,
+    max_age: int = 0,
+    private: bool = False,
+    **kwargs,
+) -> Response:
+    """
+    Returns a file response with validators, or an empty `304 Not Modified`
+    response when the client's cached copy is still valid.
+
+    Args:
+        request (Request): The request object.
+        path (str): The path to the file.
+        media_type (str): The media type of the file.
+        max_age (int, optional): How long clients may reuse the file
+            without revalidating, in seconds. Defaults to 0.
+        private (bool, optional): Whether only the client may cache the
+            file, not shared caches. Defaults to False.
+        **kwargs: Extra arguments for the `FileResponse`.
+
+    Returns:
+        Response: The file response or the `304` response.
+
+    Raises:
+        HTTPException: If the file doesn't exist.
+    """
+    if not path or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found.")
+
+    response = FileResponse(
+        path, media_type=media_type, stat_result=os.stat(path), **kwargs
+    )
+    scope = "private" if private else "public"
+    response.headers["cache-control"] = f"{scope}, max-age={max_age}"
+
+    if is_not_modified(request, response):
+        return Response(
+            status_code=304,
+            headers={
+                key: value
+                for key, value in response.headers.items()
+                if key in ("etag", "last-modified", "cache-control")
+            },
+        )
+
+    return response
+
+
+def negotiated_file_response(
+    request: Request, path: str, media_type: str, **kwargs
+) -> Response:
+    """
+    Returns a file response, served from its best precompressed sibling
+    the client accepts.
+
+    Args:
+        request (Request): The request object.
+        path (str): The path to the uncompressed file.
+        media_type (str): The media type of the uncompressed file.
+        **kwargs: Extra arguments for `cached_file_response`.
+
+    Returns:
+        Response: The file response or the `304` response.
+    """
+    if not path or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found.")
+
+    path, encoding = negotiate_file(request, path)
+    headers = kwargs.pop("headers", {})
+    if encoding:
+        headers["content-encoding"] = encoding
+
+    response = cached_file_response(
+        request, path, media_type, headers=headers, **kwargs
+    )
+    # Intermediaries must keep the encodings apart
+    response.headers["vary"] = "Accept-Encoding"
+
+    return response
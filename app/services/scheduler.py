@@ -0,0 +1,60 @@
+""" A minimal in-process scheduler for periodic maintenance jobs. """
+import logging
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+_jobs: dict[str, tuple[float, Callable[[], None]]] = {}
+_threads: list[threading.Thread] = []
+_stop_event = threading.Event()
+
+
+def register_job(name: str, interval: float, job: Callable[[], None]):
+    """
+    Registers a job to be run periodically once the scheduler starts.
+
+    Args:
+        name (str): A unique name for the job.
+        interval (float): The number of seconds between two runs. Jobs with
+            a non-positive interval are disabled.
+        job (Callable[[], None]): The function to run.
+    """
+    if interval > 0:
+        _jobs[name] = (interval, job)
+
+
+def _run_periodically(name: str, interval: float, job: Callable[[], None]):
+    """
+    Runs a job every `interval` seconds until the scheduler is stopped.
+
+    Args:
+        name (str): The name of the job.
+        interval (float): The number of seconds between two runs.
+        job (Callable[[], None]): The function to run.
+    """
+    while not _stop_event.wait(interval):
+        try:
+            job()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Scheduled job %s failed", name)
+
+
+def start_scheduler():
+    """Starts a daemon thread for every registered job."""
+    _stop_event.clear()
+    for name, (interval, job) in _jobs.items():
+        thread = threading.Thread(
+            target=_run_periodically,
+            args=(name, interval, job),
+            name=f"scheduler-{name}",
+            daemon=True,
+        )
+        thread.start()
+        _threads.append(thread)
+
+
+def stop_scheduler():
+    """Signals every job thread to stop after its current run."""
+    _stop_event.set()
+    _threads.clear()
@@ -0,0 +1,666 @@
+""" This module maintains the full-text indexes over videos. """
+import re
+import threading
+from array import array
+from contextlib import nullcontext
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, desc, func, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import Session
+
+from app.database import Base, engine
+from app.models.video_models import (
+    SearchDocument,
+    TranscriptIndex,
+    Video,
+)
+from app.settings import DB_TYPE
+
+TITLE_INDEX = "video_titles_fts"
+MYSQL_TITLE_INDEX = "ix_videos_title_fulltext"
+TRANSCRIPT_INDEX = "video_transcripts_fts"
+LEGACY_TRANSCRIPT_INDEX = "video_transcripts_fts_rowid"
+TRANSCRIPT_WORDS = "video_transcript_words"
+MAX_HITS_PER_VIDEO = 50
+# The rowid of a video in the FTS tables, which are only searched
+# efficiently by rowid
+DOCUMENT_ROWID = "(SELECT id FROM search_documents WHERE video_id = :video_id)"
+
+_index_lock = threading.Lock()
+_index_ready = False
+
+
+def _owner_token(username: str) -> str:
+    """
+    Returns the single FTS token used to scope the index to a user.
+
+    Usernames may contain characters the tokenizer splits on, so they are
+    hex encoded into one alphanumeric token.
+
+    Args:
+        username (str): The username of the video owner.
+
+    Returns:
+        str: The owner token.
+    """
+    return f"u{username.lower().encode('utf-8').hex()}"
+
+
+def _search_terms(query: str) -> list[str]:
+    """
+    Splits a search query into the terms understood by the index.
+
+    Args:
+        query (str): The search query.
+
+    Returns:
+        list[str]: The lowercase terms of the query.
+    """
+    return re.findall(r"\w+", query.lower())
+
+
+def init_search_index(db: Session | None = None) -> None:
+    """
+    Creates the title and transcript indexes if they don't exist yet and
+    fills the title index with the existing videos. This runs at startup;
+    the other functions of this module call it again with their session as
+    a safety net.
+
+    Args:
+        db (Session | None, optional): A session whose connection should be
+            used, so that SQLite doesn't wait on its own write lock.
+            Defaults to a new connection.
+    """
+    global _index_ready  # pylint: disable=global-statement
+
+    if _index_ready:
+        return
+
+    with _index_lock:
+        if _index_ready:
+            return
+
+        if db is None:
+            Base.metadata.create_all(bind=engine)
+            connection = engine.begin()
+        else:
+            connection = nullcontext(db.connection())
+
+        with connection as conn:
+            if DB_TYPE == "mysql":
+                exists = conn.execute(
+                    text(
+                        "SELECT 1 FROM information_schema.statistics "
+                        "WHERE table_schema = DATABASE() "
+                        "AND table_name = 'videos' AND index_name = :name"
+                    ),
+                    {"name": MYSQL_TITLE_INDEX},
+                ).first()
+                if not exists:
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE videos ADD FULLTEXT INDEX "
+                            f"{MYSQL_TITLE_INDEX} (title)"
+                        )
+                    )
+            else:
+                existing = set(
+                    conn.execute(
+                        text(
+                            "SELECT name FROM sqlite_master "
+                            "WHERE type = 'table'"
+                        )
+                    ).scalars()
+                )
+                _upgrade_legacy_indexes(conn, existing)
+                if TITLE_INDEX not in existing:
+                    conn.execute(
+                        text(
+                            f"CREATE VIRTUAL TABLE {TITLE_INDEX} USING "
+                            f"fts5(video_id UNINDEXED, title, owner, "
+                            f"tokenize='unicode61 remove_diacritics 2')"
+                        )
+                    )
+                    conn.execute(
+                        text(
+                            "INSERT OR IGNORE INTO search_documents(video_id) "
+                            "SELECT id FROM videos"
+                        )
+                    )
+                    rows = conn.execute(
+                        text(
+                            "SELECT search_documents.id, videos.id, "
+                            "videos.title, videos.username FROM videos "
+                            "JOIN search_documents "
+                            "ON search_documents.video_id = videos.id"
+                        )
+                    ).all()
+                    if rows:
+                        conn.execute(
+                            text(
+                                f"INSERT INTO {TITLE_INDEX}"
+                                f"(rowid, video_id, title, owner) "
+                                f"VALUES (:rowid, :video_id, :title, :owner)"
+                            ),
+                            [
+                                {
+                                    "rowid": rowid,
+                                    "video_id": video_id,
+                                    "title": title,
+                                    "owner": _owner_token(username),
+                                }
+                                for rowid, video_id, title, username in rows
+                            ],
+                        )
+                if TRANSCRIPT_INDEX not in existing:
+                    # Diacritics are kept so that the indexed terms are
+                    # exactly the normalized words of the transcript
+                    conn.execute(
+                        text(
+                            f"CREATE VIRTUAL TABLE {TRANSCRIPT_INDEX} USING "
+                            f"fts5(video_id UNINDEXED, body, owner, "
+                            f"tokenize='unicode61 remove_diacritics 0')"
+                        )
+                    )
+                    if LEGACY_TRANSCRIPT_INDEX in existing:
+                        _copy_legacy_transcripts(conn)
+                if TRANSCRIPT_WORDS not in existing:
+                    conn.execute(
+                        text(
+                            f"CREATE VIRTUAL TABLE {TRANSCRIPT_WORDS} USING "
+                            f"fts5vocab({TRANSCRIPT_INDEX}, instance)"
+                        )
+                    )
+
+        _index_ready = True
+
+
+def _upgrade_legacy_indexes(conn, existing: set[str]) -> None:
+    """
+    Drops the indexes whose entries aren't keyed on `search_documents.id`,
+    so that they are rebuilt. Older indexes were keyed on `videos.rowid`,
+    which isn't stable since `videos.id` is a string primary key, or on
+    arbitrary rowids next to an unindexed video ID, which every update had
+    to scan for. The transcript index is renamed instead, to copy its
+    entries over.
+
+    Args:
+        conn (Connection): The connection to the SQLite database.
+        existing (set[str]): The names of the existing tables, updated.
+    """
+    for table in (TITLE_INDEX, TRANSCRIPT_INDEX):
+        if table not in existing:
+            continue
+        columns = conn.execute(text(f"PRAGMA table_info({table})")).all()
+        if "video_id" in {column.name for column in columns}:
+            mismatch = conn.execute(
+                text(
+                    f"SELECT 1 FROM {table} "
+                    f"LEFT JOIN search_documents "
+                    f"ON search_documents.id = {table}.rowid "
+                    f"WHERE search_documents.video_id "
+                    f"IS NOT {table}.video_id LIMIT 1"
+                )
+            ).first()
+            if not mismatch:
+                continue
+
+        if TRANSCRIPT_WORDS in existing:
+            conn.execute(text(f"DROP TABLE {TRANSCRIPT_WORDS}"))
+            existing.discard(TRANSCRIPT_WORDS)
+        if table == TRANSCRIPT_INDEX:
+            conn.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    f"RENAME TO {LEGACY_TRANSCRIPT_INDEX}"
+                )
+            )
+            existing.add(LEGACY_TRANSCRIPT_INDEX)
+        else:
+            conn.execute(text(f"DROP TABLE {table}"))
+        existing.discard(table)
+
+
+def _copy_legacy_transcripts(conn) -> None:
+    """
+    Copies the entries of a renamed transcript index into the new one,
+    keyed on `search_documents.id`, and drops it.
+
+    Args:
+        conn (Connection): The connection to the SQLite database.
+    """
+    columns = conn.execute(
+        text(f"PRAGMA table_info({LEGACY_TRANSCRIPT_INDEX})")
+    ).all()
+    if "video_id" in {column.name for column in columns}:
+        join = "JOIN videos ON videos.id = legacy.video_id"
+    else:
+        join = "JOIN videos ON videos.rowid = legacy.rowid"
+
+    conn.execute(
+        text(
+            f"INSERT OR IGNORE INTO search_documents(video_id) "
+            f"SELECT videos.id FROM {LEGACY_TRANSCRIPT_INDEX} AS legacy "
+            f"{join}"
+        )
+    )
+    conn.execute(
+        text(
+            f"INSERT INTO {TRANSCRIPT_INDEX}(rowid, video_id, body, owner) "
+            f"SELECT search_documents.id, videos.id, legacy.body, "
+            f"legacy.owner FROM {LEGACY_TRANSCRIPT_INDEX} AS legacy {join} "
+            f"JOIN search_documents "
+            f"ON search_documents.video_id = videos.id"
+        )
+    )
+    conn.execute(text(f"DROP TABLE {LEGACY_TRANSCRIPT_INDEX}"))
+
+
+def _document_rowid(db: Session, video_id: str) -> int:
+    """
+    Returns the rowid of a video in the FTS tables, assigning one the
+    first time the video is indexed.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the video.
+
+    Returns:
+        int: The rowid.
+    """
+    db.execute(
+        sqlite.insert(SearchDocument)
+        .values(video_id=video_id)
+        .on_conflict_do_nothing(index_elements=["video_id"])
+    )
+    return (
+        db.query(SearchDocument.id)
+        .filter(SearchDocument.video_id == video_id)
+        .scalar()
+    )
+
+
+def index_video_title(db: Session, video: Video) -> None:
+    """
+    Adds a video to the title index, replacing its previous entry. The
+    caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video to index. It must already be flushed.
+    """
+    # MySQL maintains FULLTEXT indexes itself
+    if DB_TYPE == "mysql":
+        return
+
+    init_search_index(db)
+    remove_video_title(db, video.id)
+    db.execute(
+        text(
+            f"INSERT INTO {TITLE_INDEX}(rowid, video_id, title, owner) "
+            f"SELECT :rowid, id, title, :owner FROM videos "
+            f"WHERE id = :video_id"
+        ),
+        {
+            "rowid": _document_rowid(db, video.id),
+            "owner": _owner_token(video.username),
+            "video_id": video.id,
+        },
+    )
+
+
+def remove_video_title(db: Session, video_id: str) -> None:
+    """
+    Removes a video from the title index. This must run before the video
+    row itself is deleted.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the video to remove.
+    """
+    if DB_TYPE == "mysql":
+        return
+
+    init_search_index(db)
+    db.execute(
+        text(f"DELETE FROM {TITLE_INDEX} WHERE rowid = {DOCUMENT_ROWID}"),
+        {"video_id": video_id},
+    )
+
+
+def search_video_titles(
+    db: Session, username: str, query: str, limit: int, offset: int
+) -> tuple[list[Video], int]:
+    """
+    Searches the titles of a user's videos, matching every query term as a
+    prefix and ranking the best matches first.
+
+    Args:
+        db (Session): The database session.
+        username (str): The username of the video owner.
+        query (str): The search query.
+        limit (int): The maximum number of videos to return.
+        offset (int): The number of matching videos to skip.
+
+    Returns:
+        tuple[list[Video], int]: The matching videos for the requested page
+            and the total number of matching videos.
+    """
+    terms = _search_terms(query)
+
+    # Queries without any word characters can't use the index
+    if not terms:
+        filters = (
+            func.lower(Video.username) == func.lower(username),
+            func.lower(Video.title).like(f"%{query.lower()}%"),
+        )
+        videos = (
+            db.query(Video)
+            .filter(*filters)
+            .order_by(desc(Video.created_date))
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+        return videos, db.query(Video).filter(*filters).count()
+
+    if DB_TYPE == "mysql":
+        match = text("MATCH (videos.title) AGAINST (:match IN BOOLEAN MODE)")
+        filters = (
+            func.lower(Video.username) == func.lower(username),
+            match,
+        )
+        params = {"match": " ".join(f"+{term}*" for term in terms)}
+        videos = (
+            db.query(Video)
+            .filter(*filters)
+            .params(**params)
+            .order_by(desc(match), desc(Video.created_date))
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+        total = db.query(Video).filter(*filters).params(**params).count()
+        return videos, total
+
+    init_search_index(db)
+    params = {
+        "match": (
+            f"owner:{_owner_token(username)} AND title:("
+            + " ".join(f'"{term}"*' for term in terms)
+            + ")"
+        ),
+        "limit": limit,
+        "offset": offset,
+    }
+    video_ids = db.execute(
+        text(
+            f"SELECT videos.id FROM {TITLE_INDEX} "
+            f"JOIN videos ON videos.id = {TITLE_INDEX}.video_id "
+            f"WHERE {TITLE_INDEX} MATCH :match "
+            f"ORDER BY {TITLE_INDEX}.rank, videos.created_date DESC "
+            f"LIMIT :limit OFFSET :offset"
+        ),
+        params,
+    ).scalars().all()
+    total = db.execute(
+        text(
+            f"SELECT count(*) FROM {TITLE_INDEX} "
+            f"WHERE {TITLE_INDEX} MATCH :match"
+        ),
+        params,
+    ).scalar()
+
+    # Load the videos and keep the ranked order
+    videos = {
+        video.id: video
+        for video in db.query(Video).filter(Video.id.in_(video_ids))
+    }
+
+    return [videos[vid] for vid in video_ids if vid in videos], total
+
+
+def _transcript_terms(words: str) -> list[str]:
+    """
+    Splits text into the normalized terms stored in the transcript index.
+
+    Apostrophes and other punctuation are dropped from inside words, so
+    every transcript word maps to exactly one token of the index.
+
+    Args:
+        words (str): The text to split.
+
+    Returns:
+        list[str]: The lowercase terms of the text.
+    """
+    return [
+        "".join(re.findall(r"[^\W_]+", word))
+        for word in words.lower().split()
+        if re.search(r"[^\W_]", word)
+    ]
+
+
+def index_video_transcript(
+    db: Session, video: Video, words: list[dict]
+) -> None:
+    """
+    Adds the transcript of a video to the transcript index, replacing its
+    previous entry. The caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video the transcript belongs to.
+        words (list[dict]): The words of the transcript as returned by
+            Deepgram, each with a `word`, a `start` and an `end`.
+    """
+    if DB_TYPE == "mysql":
+        return
+
+    init_search_index(db)
+
+    terms = []
+    word_times = array("f")
+    for word in words:
+        for term in _transcript_terms(str(word.get("word", ""))):
+            terms.append(term)
+            word_times.extend((word["start"], word["end"]))
+
+    remove_video_transcript(db, video.id)
+    db.execute(
+        text(
+            f"INSERT INTO {TRANSCRIPT_INDEX}(rowid, video_id, body, owner) "
+            f"VALUES (:rowid, :video_id, :body, :owner)"
+        ),
+        {
+            "rowid": _document_rowid(db, video.id),
+            "body": " ".join(terms),
+            "owner": _owner_token(video.username),
+            "video_id": video.id,
+        },
+    )
+    db.add(
+        TranscriptIndex(video_id=video.id, word_times=word_times.tobytes())
+    )
+
+
+def remove_video_transcript(db: Session, video_id: str) -> None:
+    """
+    Removes the transcript of a video from the transcript index. This must
+    run before the video row itself is deleted.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the video to remove.
+    """
+    if DB_TYPE == "mysql":
+        return
+
+    init_search_index(db)
+    db.execute(
+        text(
+            f"DELETE FROM {TRANSCRIPT_INDEX} WHERE rowid = {DOCUMENT_ROWID}"
+        ),
+        {"video_id": video_id},
+    )
+    db.query(TranscriptIndex).filter(
+        TranscriptIndex.video_id == video_id
+    ).delete()
+
+
+def update_transcript_owner(db: Session, video: Video) -> None:
+    """
+    Moves the indexed transcript of a video to its current owner.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video whose owner changed. It must already be
+            flushed.
+    """
+    if DB_TYPE == "mysql":
+        return
+
+    init_search_index(db)
+    db.execute(
+        text(
+            f"UPDATE {TRANSCRIPT_INDEX} SET owner = :owner "
+            f"WHERE rowid = {DOCUMENT_ROWID}"
+        ),
+        {"owner": _owner_token(video.username), "video_id": video.id},
+    )
+
+
+def _term_offsets(
+    db: Session, term: str, prefix: bool, docs: list[int]
+) -> dict[int, set[int]]:
+    """
+    Returns the word positions of a term in the given indexed transcripts.
+
+    Args:
+        db (Session): The database session.
+        term (str): The term to look up.
+        prefix (bool): Whether to also match terms starting with `term`.
+        docs (list[int]): The index rows to look in.
+
+    Returns:
+        dict[int, set[int]]: The positions of the term per index row.
+    """
+    if prefix:
+        condition = "term >= :low AND term < :high"
+        params = {"low": term, "high": term[:-1] + chr(ord(term[-1]) + 1)}
+    else:
+        condition = "term = :low"
+        params = {"low": term}
+
+    statement = text(
+        f"SELECT doc, offset FROM {TRANSCRIPT_WORDS} "
+        f"WHERE {condition} AND col = 'body' AND doc IN :docs"
+    ).bindparams(bindparam("docs", expanding=True))
+
+    offsets: dict[int, set[int]] = {}
+    for doc, offset in db.execute(statement, {**params, "docs": docs}):
+        offsets.setdefault(doc, set()).add(offset)
+
+    return offsets
+
+
+def search_transcripts(
+    db: Session, username: str, query: str, limit: int, offset: int
+) -> tuple[list[dict], int]:
+    """
+    Searches the transcripts of a user's videos for a phrase, the last word
+    of which is matched as a prefix.
+
+    Args:
+        db (Session): The database session.
+        username (str): The username of the video owner.
+        query (str): The phrase to search for.
+        limit (int): The maximum number of videos to return.
+        offset (int): The number of matching videos to skip.
+
+    Returns:
+        tuple[list[dict], int]: The matching videos for the requested page,
+            each with the start and end times of its hits, and the total
+            number of matching videos.
+
+    Raises:
+        HTTPException: If the database has no transcript index.
+    """
+    if DB_TYPE == "mysql":
+        raise HTTPException(
+            status_code=501, detail="Transcript search is not available."
+        )
+
+    terms = _transcript_terms(query)
+    if not terms:
+        return [], 0
+
+    init_search_index(db)
+    params = {
+        "match": (
+            f"owner:{_owner_token(username)} AND "
+            f'body:("{" ".join(terms)}" *)'
+        ),
+        "limit": limit,
+        "offset": offset,
+    }
+    rows = db.execute(
+        text(
+            f"SELECT {TRANSCRIPT_INDEX}.rowid, videos.id, videos.title "
+            f"FROM {TRANSCRIPT_INDEX} "
+            f"JOIN videos ON videos.id = {TRANSCRIPT_INDEX}.video_id "
+            f"WHERE {TRANSCRIPT_INDEX} MATCH :match "
+            f"ORDER BY {TRANSCRIPT_INDEX}.rank "
+            f"LIMIT :limit OFFSET :offset"
+        ),
+        params,
+    ).all()
+    total = db.execute(
+        text(
+            f"SELECT count(*) FROM {TRANSCRIPT_INDEX} "
+            f"WHERE {TRANSCRIPT_INDEX} MATCH :match"
+        ),
+        params,
+    ).scalar()
+
+    if not rows:
+        return [], total
+
+    # Find where the phrase starts in every matching transcript
+    docs = [row.rowid for row in rows]
+    term_offsets = [
+        _term_offsets(db, term, index == len(terms) - 1, docs)
+        for index, term in enumerate(terms)
+    ]
+    word_times = {
+        video_id: array("f", times)
+        for video_id, times in db.query(
+            TranscriptIndex.video_id, TranscriptIndex.word_times
+        ).filter(TranscriptIndex.video_id.in_([row.id for row in rows]))
+    }
+
+    results = []
+    for doc, video_id, title in rows:
+        times = word_times.get(video_id, array("f"))
+        hits = []
+        for start in sorted(term_offsets[0].get(doc, ())):
+            if not all(
+                start + index in term_offsets[index].get(doc, ())
+                for index in range(1, len(terms))
+            ):
+                continue
+            end = start + len(terms) - 1
+            if 2 * end + 1 >= len(times):
+                break
+            hits.append(
+                {
+                    "start": round(times[2 * start], 3),
+                    "end": round(times[2 * end + 1], 3),
+                }
+            )
+            if len(hits) == MAX_HITS_PER_VIDEO:
+                break
+
+        results.append({"video_id": video_id, "title": title, "hits": hits})
+
+    return results, total
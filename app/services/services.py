@@ -1,14 +1,13 @@
 """ This module contains helper functions for the application. """
 import asyncio
-import glob
 import json
 import os
 import re
 import subprocess
+import threading
 from typing import Match
 import random
 
-import bcrypt
 import nanoid
 from deepgram import Deepgram
 from fastapi import HTTPException
@@ -16,8 +15,29 @@ from fastapi import Request
 
 from app.database import get_db
 from app.models.video_models import Video
+from app.services.broker import publish_video_event
+from app.services.captions import build_cues, render_captions
+from app.services.compression import get_compressed_siblings, precompress
+from app.services.frame_selector import select_thumbnail_time
+from app.services.paths import get_blob_path, get_video_dir
+from app.services.search_service import index_video_transcript
+from app.services.storage import (
+    get_storage,
+    is_remote_storage,
+    media_key,
+    publish_files,
+)
+from app.services.streaming import list_blob_files, list_published_blobs
+from app.services.stats_service import (
+    add_video_bytes,
+    file_size,
+    set_video_status,
+)
+from app.services.transcript_store import (
+    get_compact_path,
+    write_compact_transcript,
+)
 from app.settings import (
-    VIDEO_DIR,
     DEEPGRAM_API_KEY,
     EMAIL_REGEX,
     PASSWORD_REGEX,
@@ -51,21 +71,30 @@ def process_video(
     # Query the video by ID
     video = db.query(Video).filter(Video.id == video_id).first()
 
-    # Generate file paths for audio, transcript, and thumbnail
+    # Generate file paths for audio, transcript, and thumbnail, next to the
+    # merged video
+    video_dir = os.path.dirname(file_location)
     audio_filename = f"audio_{video_id}"
-    audio_location = os.path.join(
-        VIDEO_DIR, username, video_id, audio_filename
-    )
+    audio_location = os.path.join(video_dir, audio_filename)
 
     transcript_filename = f"transcript_{video_id}"
-    transcript_location = os.path.join(
-        VIDEO_DIR, username, video_id, transcript_filename
-    )
+    transcript_location = os.path.join(video_dir, transcript_filename)
 
     thumbnail_filename = f"thumbnail_{video_id}"
-    thumbnail_location = os.path.join(
-        VIDEO_DIR, username, video_id, thumbnail_filename
-    )
+    thumbnail_location = os.path.join(video_dir, thumbnail_filename)
+
+    # Artifacts left by a previous run are already accounted for
+    existing_artifacts = {
+        path
+        for path in (
+            f"{audio_location}.{AUDIO_MIME_TYPE}",
+            f"{transcript_location}.json",
+            get_compact_path(f"{transcript_location}.json"),
+            *get_compressed_siblings(f"{transcript_location}.json"),
+            f"{thumbnail_location}.jpg",
+        )
+        if os.path.isfile(path)
+    }
 
     try:
         # Get the length of the video
@@ -91,28 +120,75 @@ def process_video(
             )
         else:
             transcript_location = f"{transcript_location}.json"
+        publish_video_event(video_id, "transcript", username=username)
 
         # Extract thumbnail from compressed video
         if not os.path.isfile(f"{thumbnail_location}.jpg"):
             thumbnail_location = extract_thumbnail(
-                file_location, thumbnail_location, "jpg"
+                file_location, thumbnail_location, "jpg", video_length
             )
         else:
             thumbnail_location = f"{thumbnail_location}.jpg"
+        publish_video_event(video_id, "thumbnail", username=username)
 
     except Exception as err:
         # Update the video status to `failed` if an error occurs
-        video.status = "failed"
+        set_video_status(db, video, "failed")
+        db.commit()
+        db.close()
+        publish_video_event(
+            video_id, "failed", username=username, detail=str(err)
+        )
         raise HTTPException(status_code=500, detail=str(err)) from err
 
+    # Account for the artifacts generated by this run
+    artifacts = (
+        audio_location,
+        transcript_location,
+        get_compact_path(transcript_location),
+        *get_compressed_siblings(transcript_location),
+        thumbnail_location,
+    )
+    add_video_bytes(
+        db,
+        video,
+        sum(
+            file_size(path)
+            for path in artifacts
+            if path not in existing_artifacts
+        ),
+    )
+
+    # Let every node serve the video and its artifacts, the merge already
+    # uploaded the video itself
+    published = video.published_key == media_key(file_location)
+    try:
+        publish_files(
+            [*artifacts] if published else [file_location, *artifacts],
+            video,
+        )
+    except Exception as err:  # pylint: disable=broad-except
+        print(f"Failed to publish the files of video {video_id}: {err}")
+
     # Update the video status and save the transcript location
     video.video_length = video_length
     video.transcript_location = transcript_location
     video.thumbnail_location = thumbnail_location
-    video.status = "completed"
-
-    # Commit changes to the database and close the connection
+    set_video_status(db, video, "completed")
     db.commit()
+    publish_video_event(video_id, "processed", username=username)
+
+    # Index the transcript words for search, as the last stage
+    try:
+        with open(transcript_location, "r", encoding="utf-8") as file:
+            words = json.load(file)["words"]
+        index_video_transcript(db, video, words)
+        db.commit()
+    except (OSError, KeyError, ValueError) as err:
+        db.rollback()
+        print(f"Failed to index transcript of video {video_id}: {err}")
+
+    # Close the connection
     db.close()
 
 
@@ -160,26 +236,34 @@ def compress_video(
     input_path: str, output_path: str, extension: str = "webm"
 ) -> str:
     """
-    Compresses a video using ffmpeg.
+    Compresses a video using ffmpeg, to VP9 and Opus in a WebM container
+    or to H.264 and AAC otherwise.
 
     Args:
         input_path: The path to the input video.
-        output_path: The path to the output video.
+        output_path: The path to the output video, without extension.
         extension: The extension of the output video.
 
     Returns:
-        None
+        str: The path to the compressed video.
 
     """
     output_path = f"{output_path}.{extension}"
+    if extension == "webm":
+        # Constant quality, the bitrate follows the content
+        codecs = ["-c:v", "libvpx-vp9", "-crf", "36", "-b:v", "0"]
+        codecs += ["-row-mt", "1", "-c:a", "libopus", "-b:a", "64k"]
+    else:
+        codecs = ["-c:v", "libx264", "-crf", "28", "-c:a", "aac"]
     command = [
         "ffmpeg",
+        "-nostdin",
+        "-y",
+        "-loglevel",
+        "error",
         "-i",
         input_path,
-        "-vcodec",
-        "libx264",
-        "-crf",
-        "28",  # Lower values will have better quality but larger size.
+        *codecs,  # Lower CRF values give better quality but larger files
         output_path,
     ]
     subprocess.run(command, check=True)
@@ -209,32 +293,56 @@ def get_video_length(video_path: str) -> float:
 
 
 def extract_thumbnail(
-    video_path: str, thumbnail_path: str, extension: str = "jpg"
+    video_path: str,
+    thumbnail_path: str,
+    extension: str = "jpg",
+    duration: float | None = None,
 ) -> str:
     """
-    Extracts a thumbnail from a video using ffmpeg.
+    Extracts a thumbnail from a video using ffmpeg. The frame is picked
+    by `select_thumbnail_time`, which skips black and blank frames and
+    stays within the video, so short clips get a thumbnail too. If no
+    frame is found there, the first frame is used.
 
     Args:
         video_path: The path to the input video.
         thumbnail_path: The path to the output thumbnail.
         extension: The extension of the output thumbnail.
+        duration: The length of the video in seconds, if known.
 
     Returns:
-        None
+        str: The path to the thumbnail.
 
+    Raises:
+        ValueError: If the video has no frame at all.
     """
     thumbnail_path = f"{thumbnail_path}.{extension}"
-    command = [
-        "ffmpeg",
-        "-i",
-        video_path,
-        "-ss",
-        "00:00:02.000",  # Grab a frame at the 2-second mark
-        "-vframes",
-        "1",
-        thumbnail_path,
-    ]
-    subprocess.run(command, check=True)
+    timestamp = select_thumbnail_time(video_path, duration)
+
+    # Render to a temporary file so a failed run leaves no thumbnail behind
+    temp_path = (
+        f"{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.{extension}"
+    )
+    # ffmpeg writes no frame when seeking past the end, which can happen
+    # when the duration is unknown, so fall back to the first frame
+    for seek in dict.fromkeys([timestamp, 0.0]):
+        command = [
+            "ffmpeg",
+            "-y",
+            "-ss",
+            f"{seek:.3f}",
+            "-i",
+            video_path,
+            "-vframes",
+            "1",
+            temp_path,
+        ]
+        subprocess.run(command, check=True)
+        if os.path.isfile(temp_path):
+            break
+    else:
+        raise ValueError(f"No frame could be extracted from {video_path}")
+    os.replace(temp_path, thumbnail_path)
 
     return thumbnail_path
 
@@ -304,51 +412,105 @@ def save_blob(
         The path to the saved blob.
     """
     # Create the directory structure if it doesn't exist
-    user_dir = os.path.join(VIDEO_DIR, username)
-    video_dir = os.path.join(user_dir, video_id)
-    create_directory(user_dir, video_dir)
-
-    # Save the blob
-    blob_filename = f"{blob_index}.{VIDEO_MIME_TYPE}"
-    blob_path = os.path.join(video_dir, blob_filename)
-    with open(blob_path, "wb") as f:
+    create_directory(get_video_dir(username, video_id))
+
+    # Save the blob under a temporary name so readers tailing the
+    # recording never see a partially written chunk
+    blob_path = get_blob_path(username, video_id, blob_index)
+    temp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
         f.write(blob)
 
+    return save_blob_file(username, video_id, blob_index, temp_path)
+
+
+def save_blob_file(
+    username: str, video_id: str, blob_index: int, source_path: str
+) -> str:
+    """
+    Saves a video blob/chunk that was already written to a file, by moving
+    the file into place.
+
+    Args:
+        username: The user associated with the blob.
+        video_id: The ID of the video associated with the blob.
+        blob_index: The index of the blob.
+        source_path: The path to the file, on the same filesystem.
+
+    Returns:
+        The path to the saved blob.
+    """
+    create_directory(get_video_dir(username, video_id))
+
+    blob_path = get_blob_path(username, video_id, blob_index)
+    os.replace(source_path, blob_path)
+
+    # Upload the chunk, so the node finalizing the recording can merge it
+    publish_files([blob_path])
+
+    # Notify live viewers of the recording
+    publish_video_event(video_id, "blob", blob_index=blob_index)
+
     return blob_path
 
 
-def merge_blobs(username: str, video_id: str) -> str | None:
+def merge_blobs(username: str, video_id: str, digest=None) -> str | None:
     """
-    Merges video blobs/chunks to form the complete video.
+    Merges video blobs/chunks to form the complete video. With a remote
+    storage backend, the published chunks are merged in the backend, so
+    chunks received by any node are included, and the result is copied
+    to the local disk for processing.
 
     Args:
         username: The user associated with the blobs.
         video_id: The ID of the video associated with the blobs.
+        digest: An optional hashlib object updated with the merged bytes,
+            so the video is hashed without reading it again.
 
     Returns:
     - The path to the merged video.
     """
-    user_dir = os.path.join(VIDEO_DIR, username)
-    user_dir = os.path.abspath(user_dir)
-    video_dir = os.path.join(user_dir, video_id)
-    video_dir = os.path.abspath(video_dir)
+    video_dir = os.path.abspath(get_video_dir(username, video_id))
+    merged_video = os.path.join(video_dir, f"{video_id}.{VIDEO_MIME_TYPE}")
+
+    if is_remote_storage():
+        storage = get_storage()
+        blobs = list_published_blobs(storage, video_dir)
+        if blobs:
+            merged_key = media_key(merged_video)
+            storage.compose(merged_key, [blob.key for blob in blobs])
+
+            create_directory(video_dir)
+            temp_path = (
+                f"{merged_video}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            with open(temp_path, "wb") as merged_file:
+                for data in storage.stream(merged_key):
+                    if digest is not None:
+                        digest.update(data)
+                    merged_file.write(data)
+            os.replace(temp_path, merged_video)
+
+            return merged_video
 
     # List all blob files and sort them by their sequence ID
-    blob_files = sorted(
-        glob.glob(os.path.join(video_dir, f"*.{VIDEO_MIME_TYPE}")),
-        key=lambda x: int(os.path.splitext(os.path.basename(x))[0]),
-    )
+    blob_files = list_blob_files(username, video_id)
 
     # Check if no blobs were found
     if not blob_files:
         return None
 
     # Merge the blobs
-    merged_video = os.path.join(video_dir, f"{video_id}.{VIDEO_MIME_TYPE}")
     with open(merged_video, "wb") as merged_file:
         for blob_file in blob_files:
             with open(blob_file, "rb") as f:
-                merged_file.write(f.read())
+                data = f.read()
+            if digest is not None:
+                digest.update(data)
+            merged_file.write(data)
+
+    # Chunks received before they were published are merged here
+    publish_files([merged_video])
 
     return merged_video
 
@@ -413,7 +575,17 @@ async def generate_transcript(
         if file_format == "srt":
             return convert_to_srt(response, transcript_file)
         elif file_format == "json":
-            return convert_to_json(response, transcript_file)
+            # Keep the JSON as the export format next to the compact one
+            transcript_file = convert_to_json(response, transcript_file)
+            write_compact_transcript(
+                response["results"]["channels"][0]["alternatives"][0][
+                    "words"
+                ],
+                get_compact_path(transcript_file),
+                response["results"].get("utterances"),
+            )
+            precompress(transcript_file)
+            return transcript_file
 
 
 def convert_to_srt(transcript_data: dict, output_path: str) -> str:
@@ -429,24 +601,22 @@ def convert_to_srt(transcript_data: dict, output_path: str) -> str:
     """
     data = transcript_data
 
-    # Extract transcript and word-level information
-    _ = data["results"]["channels"][0]["alternatives"][0]["transcript"]
+    # Extract word-level information
     words = data["results"]["channels"][0]["alternatives"][0]["words"]
 
-    # Create SRT caption file
-    srt_file = []
-
-    for i, word_info in enumerate(words):
-        start_time = round(word_info["start"], 3)
-        end_time = round(word_info["end"], 3)
-        word_text = word_info["punctuated_word"]
-
-        srt_entry = f"{i + 1}\n{start_time} --> {end_time}\n{word_text}\n"
-        srt_file.append(srt_entry)
+    # Group the words into readable cues
+    cues = build_cues(
+        (
+            word_info["start"],
+            word_info["end"],
+            word_info.get("punctuated_word") or word_info["word"],
+        )
+        for word_info in words
+    )
 
     # Save SRT caption file
     with open(output_path, "w", encoding="utf-8") as file:
-        file.writelines(srt_file)
+        file.write(render_captions(cues, "srt"))
 
     return output_path
 
@@ -483,25 +653,6 @@ def convert_to_json(transcript_data: dict, output_path: str) -> str:
     return output_path
 
 
-def hash_password(password: str) -> str:
-    """
-    Hashes a password.
-
-    Args:
-        password (str): The password to be hashed.
-
-    Returns:
-        str: The hashed password.
-    """
-    pw_bytes = password.encode("utf-8")
-
-    # generating the salt
-    salt = bcrypt.gensalt()
-
-    # Hashing the password
-    return bcrypt.hashpw(pw_bytes, salt)
-
-
 def get_current_user(request: Request) -> dict:
     """
     Parameters:
@@ -0,0 +1,332 @@
+""" This module maintains the denormalized per-user video statistics. """
+import os
+
+from sqlalchemy import case, func
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app.models.user_models import User, UserStats
+from app.models.video_models import Video
+from app.services.paths import get_video_dir
+from app.settings import DB_TYPE, STATS_RESCAN_EVERY
+
+_reconcile_runs = 0
+
+
+def get_user_stats(db: Session, username: str) -> UserStats | None:
+    """
+    Returns the stats row of a user.
+
+    Args:
+        db (Session): The database session.
+        username (str): The username of the user.
+
+    Returns:
+        UserStats | None: The stats row, or None if the user has none yet.
+    """
+    return db.query(UserStats).filter(UserStats.username == username).first()
+
+
+def count_user_videos(db: Session, username: str) -> int | None:
+    """
+    Returns the number of videos of a user from the stats, matching the
+    username case-insensitively like the video listing does.
+
+    Args:
+        db (Session): The database session.
+        username (str): The username of the user.
+
+    Returns:
+        int | None: The number of videos, or None if a user matching the
+            username has no stats yet.
+    """
+    users, rows, total = (
+        db.query(
+            func.count(User.username),
+            func.count(UserStats.username),
+            func.sum(UserStats.video_count),
+        )
+        .outerjoin(UserStats, UserStats.username == User.username)
+        .filter(func.lower(User.username) == func.lower(username))
+        .one()
+    )
+    return total if users and rows == users else None
+
+
+def _stats_for_update(db: Session, username: str) -> UserStats:
+    """
+    Returns the stats row of a user, inserting an empty one if the user
+    has none yet. The caller is responsible for committing.
+
+    Counters are updated with SQL expressions and flushed right away, so
+    concurrent requests don't lose increments and several updates can be
+    made in the same transaction.
+
+    Args:
+        db (Session): The database session.
+        username (str): The username of the user.
+
+    Returns:
+        UserStats: The stats row.
+    """
+    stats = db.get(UserStats, username)
+    if not stats:
+        # Insert in one statement so concurrent first writes don't conflict
+        values = {
+            "username": username,
+            "video_count": 0,
+            "bytes_stored": 0,
+            "processing_count": 0,
+        }
+        if DB_TYPE == "mysql":
+            statement = (
+                mysql.insert(UserStats).values(**values).prefix_with("IGNORE")
+            )
+        else:
+            statement = (
+                sqlite.insert(UserStats)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=["username"])
+            )
+        db.execute(statement)
+        stats = db.get(UserStats, username)
+
+    return stats
+
+
+def record_video_created(db: Session, video: Video) -> None:
+    """
+    Accounts for a newly created video.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The new video.
+    """
+    stats = _stats_for_update(db, video.username)
+
+    # Increment in SQL so concurrent requests don't lose updates
+    stats.video_count = UserStats.video_count + 1
+    if (video.status or "processing") == "processing":
+        stats.processing_count = UserStats.processing_count + 1
+    db.flush()
+
+
+def add_video_bytes(db: Session, video: Video, delta: int) -> None:
+    """
+    Accounts for bytes written to (or removed from) the storage of a video.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video whose storage changed.
+        delta (int): The number of bytes added; negative when removed.
+    """
+    if not delta:
+        return
+
+    stats = _stats_for_update(db, video.username)
+    video.storage_bytes = Video.storage_bytes + delta
+    stats.bytes_stored = UserStats.bytes_stored + delta
+    db.flush()
+
+
+def set_video_status(db: Session, video: Video, status: str) -> None:
+    """
+    Updates the status of a video, keeping the processing count in sync.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video to update.
+        status (str): The new status of the video.
+    """
+    previous = video.status
+    video.status = status
+
+    if previous == status:
+        return
+
+    stats = _stats_for_update(db, video.username)
+    if previous == "processing":
+        stats.processing_count = UserStats.processing_count - 1
+    elif status == "processing":
+        stats.processing_count = UserStats.processing_count + 1
+    db.flush()
+
+
+def record_video_deleted(db: Session, video: Video) -> None:
+    """
+    Accounts for a video that is being deleted.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video being deleted.
+    """
+    stats = _stats_for_update(db, video.username)
+    stats.video_count = UserStats.video_count - 1
+    stats.bytes_stored = UserStats.bytes_stored - (video.storage_bytes or 0)
+    if video.status == "processing":
+        stats.processing_count = UserStats.processing_count - 1
+    db.flush()
+
+
+def transfer_user_stats(
+    db: Session, username1: str, username2: str, videos: list[Video]
+) -> None:
+    """
+    Moves the counters of the given videos from one user to another.
+
+    Args:
+        db (Session): The database session.
+        username1 (str): The username the videos are transferred from.
+        username2 (str): The username the videos are transferred to.
+        videos (list[Video]): The videos being transferred.
+    """
+    if not videos or username1 == username2:
+        return
+
+    count = len(videos)
+    total_bytes = sum(video.storage_bytes or 0 for video in videos)
+    processing = sum(video.status == "processing" for video in videos)
+
+    source = _stats_for_update(db, username1)
+    target = _stats_for_update(db, username2)
+
+    source.video_count = UserStats.video_count - count
+    source.bytes_stored = UserStats.bytes_stored - total_bytes
+    source.processing_count = UserStats.processing_count - processing
+
+    target.video_count = UserStats.video_count + count
+    target.bytes_stored = UserStats.bytes_stored + total_bytes
+    target.processing_count = UserStats.processing_count + processing
+    db.flush()
+
+
+def file_size(path: str | None) -> int:
+    """
+    Returns the size of a file, or 0 if it doesn't exist.
+
+    Args:
+        path (str | None): The path to the file.
+
+    Returns:
+        int: The size of the file in bytes.
+    """
+    if path and os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return 0
+
+
+def directory_size(path: str) -> int:
+    """
+    Returns the total size of the files in a directory tree.
+
+    Args:
+        path (str): The path to the directory.
+
+    Returns:
+        int: The total size in bytes.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += file_size(os.path.join(root, name))
+
+    return total
+
+
+def get_video_directory(video: Video) -> str:
+    """
+    Returns the directory holding the files of a video.
+
+    Transferred videos keep their files under the original owner, so the
+    merged file location is preferred when it is known.
+
+    Args:
+        video (Video): The video.
+
+    Returns:
+        str: The path to the video directory.
+    """
+    if video.original_location:
+        return os.path.dirname(video.original_location)
+
+    return get_video_dir(video.username, video.id)
+
+
+def reconcile_user_stats(db: Session, rescan_disk: bool = False) -> int:
+    """
+    Recomputes every stats row from the videos table and repairs drift.
+
+    Args:
+        db (Session): The database session.
+        rescan_disk (bool, optional): Whether to also recompute the storage
+            size of every video from the filesystem. Defaults to False.
+
+    Returns:
+        int: The number of stats rows that were repaired.
+    """
+    if rescan_disk:
+        for video in db.query(Video).yield_per(500):
+            size = directory_size(get_video_directory(video))
+            if size != video.storage_bytes:
+                video.storage_bytes = size
+        db.flush()
+
+    totals = {
+        username: (count, total_bytes or 0, processing or 0)
+        for username, count, total_bytes, processing in db.query(
+            Video.username,
+            func.count(Video.id),
+            func.sum(Video.storage_bytes),
+            func.sum(case((Video.status == "processing", 1), else_=0)),
+        ).group_by(Video.username)
+    }
+
+    repaired = 0
+    for stats in db.query(UserStats).all():
+        expected = totals.pop(stats.username, (0, 0, 0))
+        actual = (
+            stats.video_count,
+            stats.bytes_stored,
+            stats.processing_count,
+        )
+        if actual != expected:
+            (
+                stats.video_count,
+                stats.bytes_stored,
+                stats.processing_count,
+            ) = expected
+            repaired += 1
+
+    # Users that have videos but no stats row yet
+    for username, (count, total_bytes, processing) in totals.items():
+        db.add(
+            UserStats(
+                username=username,
+                video_count=count,
+                bytes_stored=total_bytes,
+                processing_count=processing,
+            )
+        )
+        repaired += 1
+
+    db.commit()
+
+    return repaired
+
+
+def reconcile_user_stats_job() -> None:
+    """
+    Scheduled entry point that repairs drift in the stats rows. The first
+    run, then every STATS_RESCAN_EVERY runs, also rescans the disk.
+    """
+    global _reconcile_runs  # pylint: disable=global-statement
+    rescan_disk = _reconcile_runs % max(STATS_RESCAN_EVERY, 1) == 0
+    _reconcile_runs += 1
+
+    db = next(get_db())
+    try:
+        reconcile_user_stats(db, rescan_disk=rescan_disk)
+    finally:
+        db.close()
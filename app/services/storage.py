@@ -0,0 +1,506 @@
+""" This module stores media files on local disk or in an S3 bucket. """
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Iterator
+
+from app.settings import (
+    MEDIA_DIR,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_PREFIX,
+    S3_REGION,
+    STORAGE_BACKEND,
+    STORAGE_PRESIGN_TTL,
+)
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover - boto3 is optional
+    boto3 = None
+
+READ_SIZE = 64 * 1024
+
+# S3 rejects multipart parts under 5 MB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class StoredObject:
+    """A stored file"""
+
+    key: str
+    size: int
+
+
+class Storage(ABC):
+    """
+    A store of media files. Keys are '/'-separated paths relative to the
+    media root, like "uploads/<username>/<video_id>/<video_id>.webm".
+    """
+
+    @abstractmethod
+    def put(self, key: str, source: str | bytes) -> int:
+        """
+        Stores a file, replacing any previous one.
+
+        Args:
+            key (str): The key of the file.
+            source (str | bytes): The path of a local file, or the content.
+
+        Returns:
+            int: The size of the stored file.
+        """
+        raise NotImplementedError
+
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> bytes:
+        """
+        Reads part of a file.
+
+        Args:
+            key (str): The key of the file.
+            start (int, optional): The first byte. Defaults to 0.
+            end (int, optional): The last byte, included, or -1 for the
+                end of the file.
+
+        Returns:
+            bytes: The content.
+        """
+        return b"".join(self.stream(key, start, end))
+
+    @abstractmethod
+    def stream(
+        self, key: str, start: int = 0, end: int = -1
+    ) -> Iterator[bytes]:
+        """
+        Reads part of a file in blocks.
+
+        Args:
+            key (str): The key of the file.
+            start (int, optional): The first byte. Defaults to 0.
+            end (int, optional): The last byte, included, or -1 for the
+                end of the file.
+
+        Yields:
+            bytes: The next block.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def size(self, key: str) -> int | None:
+        """
+        Returns the size of a file.
+
+        Args:
+            key (str): The key of the file.
+
+        Returns:
+            int | None: The size in bytes, or None if there is no file.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """
+        Deletes a file, if it exists.
+
+        Args:
+            key (str): The key of the file.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_files(self, prefix: str) -> list[StoredObject]:
+        """
+        Lists the files under a prefix.
+
+        Args:
+            prefix (str): The prefix, like "uploads/<username>/<video_id>/".
+
+        Returns:
+            list[StoredObject]: The files, ordered by key.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def compose(self, key: str, part_keys: list[str]) -> int:
+        """
+        Stores the concatenation of other files, like the chunks of a
+        recording, without going through the local disk.
+
+        Args:
+            key (str): The key of the new file.
+            part_keys (list[str]): The keys of the parts, in order.
+
+        Returns:
+            int: The size of the new file.
+        """
+        raise NotImplementedError
+
+    def presign(
+        self,
+        key: str,
+        expires: int = STORAGE_PRESIGN_TTL,
+        filename: str | None = None,
+    ) -> str | None:
+        """
+        Returns a URL clients can download a file from directly.
+
+        Args:
+            key (str): The key of the file.
+            expires (int, optional): The lifetime of the URL, in seconds.
+            filename (str | None, optional): The name to download the file
+                as. Defaults to displaying it inline.
+
+        Returns:
+            str | None: The URL, or None if the backend serves no URLs.
+        """
+        return None
+
+    def delete_prefix(self, prefix: str) -> None:
+        """
+        Deletes every file under a prefix.
+
+        Args:
+            prefix (str): The prefix.
+        """
+        for stored in self.list_files(prefix):
+            self.delete(stored.key)
+
+
+class LocalStorage(Storage):
+    """Files in a directory of the local filesystem"""
+
+    def __init__(self, root: str = MEDIA_DIR):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        """Returns the local path of a key."""
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key: str, source: str | bytes) -> int:
+        path = self.path(key)
+        if isinstance(source, str) and os.path.abspath(
+            source
+        ) == os.path.abspath(path):
+            return os.path.getsize(path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if isinstance(source, str):
+            shutil.copyfile(source, temp_path)
+        else:
+            with open(temp_path, "wb") as file:
+                file.write(source)
+        os.replace(temp_path, path)
+
+        return os.path.getsize(path)
+
+    def stream(
+        self, key: str, start: int = 0, end: int = -1
+    ) -> Iterator[bytes]:
+        with open(self.path(key), "rb") as file:
+            file.seek(start)
+            remaining = None if end < 0 else end - start + 1
+            while remaining is None or remaining > 0:
+                size = READ_SIZE if remaining is None else min(
+                    READ_SIZE, remaining
+                )
+                data = file.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+    def size(self, key: str) -> int | None:
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_files(self, prefix: str) -> list[StoredObject]:
+        directory = self.path(prefix.rstrip("/")) if prefix else self.root
+        objects = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                objects.append(StoredObject(key, os.path.getsize(path)))
+
+        return sorted(objects, key=lambda stored: stored.key)
+
+    def compose(self, key: str, part_keys: list[str]) -> int:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as output:
+            for part_key in part_keys:
+                with open(self.path(part_key), "rb") as part:
+                    shutil.copyfileobj(part, output, READ_SIZE)
+        os.replace(temp_path, path)
+
+        return os.path.getsize(path)
+
+
+class S3Storage(Storage):
+    """
+    Objects in an S3 bucket, or any S3-compatible server like MinIO when
+    `endpoint_url` is set. Large files are uploaded in multipart uploads.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: str | None = None,
+        region: str | None = None,
+        prefix: str = "",
+    ):
+        if boto3 is None:
+            raise RuntimeError("The S3 storage backend requires boto3.")
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE
+        )
+
+    def _key(self, key: str) -> str:
+        """Returns the object key of a storage key."""
+        return self.prefix + key
+
+    def put(self, key: str, source: str | bytes) -> int:
+        if isinstance(source, str):
+            self.client.upload_file(
+                source,
+                self.bucket,
+                self._key(key),
+                Config=self.transfer_config,
+            )
+            return os.path.getsize(source)
+
+        self.client.put_object(
+            Bucket=self.bucket, Key=self._key(key), Body=source
+        )
+        return len(source)
+
+    def stream(
+        self, key: str, start: int = 0, end: int = -1
+    ) -> Iterator[bytes]:
+        byte_range = f"bytes={start}-" if end < 0 else f"bytes={start}-{end}"
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self._key(key), Range=byte_range
+        )
+        yield from response["Body"].iter_chunks(READ_SIZE)
+
+    def size(self, key: str) -> int | None:
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self._key(key)
+            )
+        except ClientError as err:
+            code = err.response.get("Error", {}).get("Code")
+            if code in ("404", "NoSuchKey"):
+                return None
+            raise
+
+        return response["ContentLength"]
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list_files(self, prefix: str) -> list[StoredObject]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        objects = []
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self._key(prefix)
+        ):
+            for item in page.get("Contents", []):
+                objects.append(
+                    StoredObject(item["Key"][len(self.prefix):], item["Size"])
+                )
+
+        return objects
+
+    def compose(self, key: str, part_keys: list[str]) -> int:
+        """
+        Concatenates objects with one multipart upload. Parts of at least
+        5 MB are copied within the bucket; smaller ones, like most
+        recording chunks, are buffered together into parts of 8 MB.
+        """
+        upload = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self._key(key)
+        )
+        upload_id = upload["UploadId"]
+        parts = []
+        buffer = bytearray()
+        total = 0
+
+        def upload_buffer():
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self._key(key),
+                UploadId=upload_id,
+                PartNumber=len(parts) + 1,
+                Body=bytes(buffer),
+            )
+            parts.append(
+                {"ETag": response["ETag"], "PartNumber": len(parts) + 1}
+            )
+            buffer.clear()
+
+        try:
+            for part_key in part_keys:
+                size = self.size(part_key)
+                if size is None:
+                    raise FileNotFoundError(part_key)
+                total += size
+                if not buffer and size >= MIN_PART_SIZE:
+                    response = self.client.upload_part_copy(
+                        Bucket=self.bucket,
+                        Key=self._key(key),
+                        UploadId=upload_id,
+                        PartNumber=len(parts) + 1,
+                        CopySource={
+                            "Bucket": self.bucket,
+                            "Key": self._key(part_key),
+                        },
+                    )
+                    parts.append(
+                        {
+                            "ETag": response["CopyPartResult"]["ETag"],
+                            "PartNumber": len(parts) + 1,
+                        }
+                    )
+                    continue
+
+                for data in self.stream(part_key):
+                    buffer += data
+                    if len(buffer) >= PART_SIZE:
+                        upload_buffer()
+
+            if buffer or not parts:
+                upload_buffer()
+
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self._key(key),
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self._key(key), UploadId=upload_id
+            )
+            raise
+
+        return total
+
+    def presign(
+        self,
+        key: str,
+        expires: int = STORAGE_PRESIGN_TTL,
+        filename: str | None = None,
+    ) -> str | None:
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if filename:
+            params["ResponseContentDisposition"] = (
+                f'attachment; filename="{filename}"'
+            )
+
+        return self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=expires
+        )
+
+
+def media_key(path: str | None) -> str | None:
+    """
+    Returns the storage key of a file under the media directory.
+
+    Args:
+        path (str | None): The local path of the file.
+
+    Returns:
+        str | None: The key, or None if the file is outside of MEDIA_DIR.
+    """
+    if not path:
+        return None
+
+    relative = os.path.relpath(
+        os.path.abspath(path), os.path.abspath(MEDIA_DIR)
+    )
+    if relative.startswith(os.pardir):
+        return None
+
+    return relative.replace(os.sep, "/")
+
+
+_storage: Storage | None = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    """
+    Returns the configured storage backend.
+
+    Returns:
+        Storage: The S3 storage if STORAGE_BACKEND is "s3", otherwise the
+            local storage of MEDIA_DIR.
+    """
+    global _storage  # pylint: disable=global-statement
+
+    with _storage_lock:
+        if _storage is None:
+            if STORAGE_BACKEND == "s3":
+                _storage = S3Storage(
+                    S3_BUCKET, S3_ENDPOINT_URL, S3_REGION, S3_PREFIX
+                )
+            else:
+                _storage = LocalStorage(MEDIA_DIR)
+
+    return _storage
+
+
+def is_remote_storage() -> bool:
+    """Checks if media is stored away from the local media directory."""
+    return not isinstance(get_storage(), LocalStorage)
+
+
+def publish_files(paths: list[str | None], video=None) -> None:
+    """
+    Copies local files to a remote storage backend, so any node can serve
+    them. Nothing is copied with the local backend.
+
+    Args:
+        paths (list[str | None]): The local paths of the files.
+        video (Video, optional): The video the files belong to. Its
+            `published_key` is set when its original file is copied, so
+            it is served from the backend without checking the object
+            first. The caller is responsible for committing.
+    """
+    if not is_remote_storage():
+        return
+
+    storage = get_storage()
+    for path in paths:
+        key = media_key(path)
+        if key and os.path.isfile(path):
+            storage.put(key, path)
+            if video is not None and key == media_key(
+                video.original_location
+            ):
+                video.published_key = key
@@ -0,0 +1,496 @@
+""" This module reclaims the disk space of chunks and orphaned files.
+
+Sent emails past their retention are pruned from the outbox too.
+
+Usage: python -m app.services.storage_gc [--dry-run]
+"""
+import argparse
+import datetime
+import glob
+import hashlib
+import os
+import shutil
+import time
+from dataclasses import dataclass
+
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app.models.video_models import Video, VideoChunk
+from app.services.mail_worker import prune_sent_mail
+from app.services.search_service import (
+    remove_video_title,
+    remove_video_transcript,
+)
+from app.services.stats_service import (
+    add_video_bytes,
+    directory_size,
+    file_size,
+    get_video_directory,
+    record_video_deleted,
+)
+from app.services.storage import get_storage, is_remote_storage, media_key
+from app.services.streaming import get_blob_index, list_published_blobs
+from app.services.thumbnails import delete_thumbnail_variants
+from app.settings import (
+    COLD_VIDEO_DIR,
+    GC_GRACE_PERIOD,
+    SHARDED_VIDEO_DIR,
+    UPLOAD_TTL,
+    VIDEO_DIR,
+    VIDEO_MIME_TYPE,
+)
+
+READ_SIZE = 1024 * 1024
+
+
+@dataclass
+class GcReport:
+    """What a collection removed, or would remove on a dry run"""
+
+    dry_run: bool = False
+    chunk_videos: int = 0
+    chunk_bytes: int = 0
+    stale_uploads: int = 0
+    stale_bytes: int = 0
+    orphan_dirs: int = 0
+    orphan_bytes: int = 0
+    temp_files: int = 0
+    temp_bytes: int = 0
+    sent_mails: int = 0
+
+    @property
+    def total_bytes(self) -> int:
+        """The bytes reclaimed, or reclaimable on a dry run."""
+        return (
+            self.chunk_bytes
+            + self.stale_bytes
+            + self.orphan_bytes
+            + self.temp_bytes
+        )
+
+    def __str__(self) -> str:
+        verb = "Reclaimable" if self.dry_run else "Reclaimed"
+        return "\n".join(
+            (
+                f"Merged chunks: {self.chunk_videos} videos, "
+                f"{self.chunk_bytes} bytes",
+                f"Stale uploads: {self.stale_uploads} videos, "
+                f"{self.stale_bytes} bytes",
+                f"Orphaned directories: {self.orphan_dirs}, "
+                f"{self.orphan_bytes} bytes",
+                f"Temporary files: {self.temp_files}, "
+                f"{self.temp_bytes} bytes",
+                f"Sent emails: {self.sent_mails}",
+                f"{verb}: {self.total_bytes} bytes",
+            )
+        )
+
+
+def list_chunk_files(directory: str) -> list[str]:
+    """
+    Lists the numbered chunk files in a video directory, by blob index.
+
+    Args:
+        directory (str): The video directory.
+
+    Returns:
+        list[str]: The paths to the chunk files.
+    """
+    return sorted(
+        (
+            path
+            for path in glob.glob(
+                os.path.join(directory, f"*.{VIDEO_MIME_TYPE}")
+            )
+            if os.path.splitext(os.path.basename(path))[0].isdigit()
+        ),
+        key=get_blob_index,
+    )
+
+
+def is_verified_merge(video: Video, chunk_sizes: list[int]) -> bool:
+    """
+    Checks that the merged video holds exactly the bytes of its chunks, so
+    the chunks can go.
+
+    Args:
+        video (Video): The merged video.
+        chunk_sizes (list[int]): The sizes of the chunks of the video.
+
+    Returns:
+        bool: True if the merged file matches its size and digest.
+    """
+    merged = video.original_location
+    if not merged or not os.path.isfile(merged):
+        return False
+
+    if file_size(merged) != sum(chunk_sizes):
+        return False
+
+    # Merges from before digests were stored are checked on size only
+    if not video.content_digest:
+        return True
+
+    digest = hashlib.sha256()
+    with open(merged, "rb") as file:
+        while data := file.read(READ_SIZE):
+            digest.update(data)
+
+    return digest.hexdigest() == video.content_digest
+
+
+def delete_merged_chunks(
+    db: Session, video: Video, dry_run: bool = False
+) -> int:
+    """
+    Deletes the chunk files of a video once its merge is verified, and
+    their copies in a remote storage backend. The published chunks are
+    the ones merged with a remote backend, so the merge is verified
+    against them when there are any. The video is then flagged with
+    `chunks_reclaimed`. The caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video.
+        dry_run (bool, optional): Only count the bytes. Defaults to False.
+
+    Returns:
+        int: The bytes of the chunks, or 0 if the merge isn't verified.
+    """
+    if not video.original_location:
+        return 0
+
+    directory = get_video_directory(video)
+    chunk_files = list_chunk_files(directory)
+    chunk_sizes = [file_size(path) for path in chunk_files]
+    published = []
+    if is_remote_storage():
+        storage = get_storage()
+        published = list_published_blobs(storage, directory)
+        if published:
+            chunk_sizes = [stored.size for stored in published]
+
+    if not chunk_sizes:
+        if not dry_run:
+            video.chunks_reclaimed = True
+        return 0
+    if not is_verified_merge(video, chunk_sizes):
+        return 0
+
+    local = sum(file_size(path) for path in chunk_files)
+    freed = local + sum(chunk_sizes) if published else local
+    if dry_run:
+        return freed
+
+    for stored in published:
+        storage.delete(stored.key)
+    for path in chunk_files:
+        os.remove(path)
+    add_video_bytes(db, video, -local)
+    video.chunks_reclaimed = True
+
+    return freed
+
+
+def reclaim_merged_chunks(video_id: str) -> None:
+    """
+    Background task deleting the chunks of a freshly merged video.
+
+    Args:
+        video_id (str): The ID of the video.
+    """
+    db = next(get_db())
+    try:
+        video = db.query(Video).filter(Video.id == video_id).first()
+        if video and delete_merged_chunks(db, video):
+            db.commit()
+    except OSError as err:
+        print(f"Could not delete the chunks of {video_id}: {err}")
+    finally:
+        db.close()
+
+
+def delete_video_files(video: Video) -> int:
+    """
+    Deletes every file of a video: its directory with the chunks, audio,
+    transcript and captions, its compressed copy and thumbnail variants.
+
+    Args:
+        video (Video): The video.
+
+    Returns:
+        int: The bytes removed.
+    """
+    removed = 0
+    directory = get_video_directory(video)
+
+    # Only ever remove a whole directory named after the video
+    if os.path.basename(os.path.normpath(directory)) == video.id:
+        removed += directory_size(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+    else:
+        for path in (video.original_location, video.thumbnail_location):
+            if path and os.path.isfile(path):
+                removed += file_size(path)
+                os.remove(path)
+
+    if video.compressed_location and os.path.isfile(
+        video.compressed_location
+    ):
+        removed += file_size(video.compressed_location)
+        os.remove(video.compressed_location)
+    delete_thumbnail_variants(video.id)
+
+    # Published copies go too
+    if is_remote_storage() and (key := media_key(directory)):
+        get_storage().delete_prefix(f"{key}/")
+
+    return removed
+
+
+def remove_video(db: Session, video: Video) -> int:
+    """
+    Deletes a video, its files, index entries and chunk manifest, and
+    updates the stats of its owner. The caller is responsible for
+    committing.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video.
+
+    Returns:
+        int: The bytes removed from disk.
+    """
+    removed = delete_video_files(video)
+
+    record_video_deleted(db, video)
+    remove_video_title(db, video.id)
+    remove_video_transcript(db, video.id)
+    db.query(VideoChunk).filter(VideoChunk.video_id == video.id).delete()
+    db.delete(video)
+
+    return removed
+
+
+def last_activity(video: Video) -> float:
+    """
+    Returns when an unfinished upload last received a chunk, or a merge
+    last wrote to it.
+
+    Args:
+        video (Video): The video.
+
+    Returns:
+        float: A timestamp, the creation date if no chunk was received.
+    """
+    created = video.created_date or datetime.datetime.utcnow()
+    latest = created.replace(tzinfo=datetime.timezone.utc).timestamp()
+    directory = get_video_directory(video)
+    merged = os.path.join(directory, f"{video.id}.{VIDEO_MIME_TYPE}")
+    for path in list_chunk_files(directory) + [merged]:
+        try:
+            latest = max(latest, os.path.getmtime(path))
+        except OSError:
+            continue
+
+    return latest
+
+
+def expire_stale_uploads(
+    db: Session, report: GcReport, ttl: float = UPLOAD_TTL
+) -> None:
+    """
+    Deletes the recordings that never got their last chunk and received
+    nothing for `ttl` seconds.
+
+    Args:
+        db (Session): The database session.
+        report (GcReport): Receives the counts.
+        ttl (float, optional): The lifetime of an idle upload, in seconds.
+    """
+    cutoff = time.time() - ttl
+    stale = (
+        db.query(Video)
+        .filter(
+            Video.status == "processing",
+            Video.original_location.is_(None),
+        )
+        .all()
+    )
+    for video in stale:
+        if last_activity(video) > cutoff:
+            continue
+
+        report.stale_uploads += 1
+        if report.dry_run:
+            report.stale_bytes += directory_size(get_video_directory(video))
+        else:
+            report.stale_bytes += remove_video(db, video)
+            db.commit()
+
+
+def sweep_orphans(
+    db: Session, report: GcReport, grace: float = GC_GRACE_PERIOD
+) -> None:
+    """
+    Deletes the video directories without a video row, the copies left
+    by interrupted moves next to the directory a merged video row points
+    to, the temporary files of interrupted writes, and with a remote
+    storage backend the chunks this node received of a video whose chunks
+    were reclaimed by another node, once older than `grace` seconds.
+
+    Args:
+        db (Session): The database session.
+        report (GcReport): Receives the counts.
+        grace (float, optional): The age under which files are kept, so
+            work in progress isn't swept.
+    """
+    cutoff = time.time() - grace
+    now = datetime.datetime.utcnow()
+    # The current directory of the videos, None when it isn't settled: still
+    # recording, or claimed by a tiering run that may be moving it
+    current_dirs: dict[str, str | None] = {}
+    reclaimed: dict[str, Video] = {}
+    for video in db.query(Video):
+        settled = video.original_location and not (
+            video.tier_claimed_until and video.tier_claimed_until > now
+        )
+        current_dirs[video.id] = (
+            os.path.abspath(get_video_directory(video)) if settled else None
+        )
+        if video.chunks_reclaimed:
+            reclaimed[video.id] = video
+
+    def is_old(path: str) -> bool:
+        try:
+            return os.path.getmtime(path) < cutoff
+        except OSError:
+            return False
+
+    # Bodies of legacy uploads that were being decoded
+    temp_files = glob.glob(os.path.join(VIDEO_DIR, ".incoming.*.tmp"))
+    remote = is_remote_storage()
+    leftover_chunks: list[tuple[Video, str]] = []
+
+    # Video directories of the per-user and the sharded layouts, and the
+    # copies of interrupted moves to cold storage
+    video_dirs = glob.glob(os.path.join(VIDEO_DIR, "*", "*", ""))
+    for root in (SHARDED_VIDEO_DIR, COLD_VIDEO_DIR):
+        video_dirs += glob.glob(os.path.join(root, "*", "*", "*", ""))
+    for video_dir in video_dirs:
+        video_dir = os.path.abspath(video_dir)
+        video_id = os.path.basename(video_dir)
+        current_dir = current_dirs.get(video_id)
+        if video_id not in current_dirs or (
+            current_dir
+            and current_dir != video_dir
+            and os.path.isdir(current_dir)
+        ):
+            if is_old(video_dir):
+                report.orphan_dirs += 1
+                report.orphan_bytes += directory_size(video_dir)
+                if not report.dry_run:
+                    shutil.rmtree(video_dir, ignore_errors=True)
+            continue
+
+        # Atomic writes leave `<path>.<pid>.<thread>.tmp` when killed
+        temp_files += glob.glob(os.path.join(video_dir, "*.tmp"))
+
+        # The chunks this node received stay when another node reclaims
+        if remote and video_id in reclaimed and current_dir == video_dir:
+            leftover_chunks += [
+                (reclaimed[video_id], path)
+                for path in list_chunk_files(video_dir)
+            ]
+
+    for path in temp_files:
+        if not is_old(path):
+            continue
+        report.temp_files += 1
+        report.temp_bytes += file_size(path)
+        if not report.dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    for video, path in leftover_chunks:
+        if not is_old(path):
+            continue
+        size = file_size(path)
+        report.chunk_bytes += size
+        if not report.dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            add_video_bytes(db, video, -size)
+    db.commit()
+
+
+def collect_garbage(db: Session, dry_run: bool = False) -> GcReport:
+    """
+    Deletes the chunks of verified merges, expires stale uploads, sweeps
+    orphaned files and prunes the sent emails of the outbox.
+
+    Args:
+        db (Session): The database session.
+        dry_run (bool, optional): Only report what would be deleted.
+            Defaults to False.
+
+    Returns:
+        GcReport: The counts of what was (or would be) deleted.
+    """
+    report = GcReport(dry_run=dry_run)
+
+    merged = db.query(Video).filter(
+        Video.original_location.isnot(None),
+        Video.chunks_reclaimed.is_(False),
+    )
+    for video in merged.all():
+        freed = delete_merged_chunks(db, video, dry_run)
+        if freed:
+            report.chunk_videos += 1
+            report.chunk_bytes += freed
+    db.commit()
+
+    expire_stale_uploads(db, report)
+    sweep_orphans(db, report)
+
+    report.sent_mails = prune_sent_mail(db, dry_run=dry_run)
+    db.commit()
+
+    return report
+
+
+def collect_garbage_job() -> None:
+    """Scheduled entry point that reclaims disk space."""
+    db = next(get_db())
+    try:
+        report = collect_garbage(db)
+        if report.total_bytes or report.sent_mails:
+            print(report)
+    finally:
+        db.close()
+
+
+def main():
+    """ The main function """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="report the reclaimable bytes without deleting anything",
+    )
+    args = parser.parse_args()
+
+    db = next(get_db())
+    try:
+        print(collect_garbage(db, dry_run=args.dry_run))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
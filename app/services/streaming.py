@@ -0,0 +1,323 @@
+""" This module streams the chunk files of a recording as one file. """
+import glob
+import os
+from bisect import bisect_right
+from itertools import accumulate
+from typing import AsyncIterator, Iterator
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.services.broker import broker, video_topic
+from app.services.paths import get_blob_path, get_video_dir
+from app.services.storage import Storage, StoredObject, media_key
+from app.settings import VIDEO_MIME_TYPE
+
+READ_SIZE = 64 * 1024
+
+# Clients number the chunks of a recording from 1
+FIRST_BLOB_INDEX = 1
+
+
+def list_blob_files(username: str, video_id: str) -> list[str]:
+    """
+    Lists the chunk files of a recording, ordered by blob index.
+
+    Args:
+        username: The user associated with the blobs.
+        video_id: The ID of the video associated with the blobs.
+
+    Returns:
+        list[str]: The paths to the chunk files.
+    """
+    video_dir = os.path.abspath(get_video_dir(username, video_id))
+
+    # The merged video lives in the same directory, so keep numbered files
+    blob_files = [
+        path
+        for path in glob.glob(os.path.join(video_dir, f"*.{VIDEO_MIME_TYPE}"))
+        if os.path.splitext(os.path.basename(path))[0].isdigit()
+    ]
+
+    return sorted(blob_files, key=get_blob_index)
+
+
+def list_published_blobs(
+    storage: Storage, video_dir: str
+) -> list[StoredObject]:
+    """
+    Lists the published chunks of a recording, ordered by blob index.
+
+    Args:
+        storage (Storage): The storage backend.
+        video_dir (str): The local directory of the recording.
+
+    Returns:
+        list[StoredObject]: The chunks.
+    """
+    prefix = media_key(video_dir)
+    if not prefix:
+        return []
+
+    return sorted(
+        (
+            stored
+            for stored in storage.list_files(f"{prefix}/")
+            if stored.key.endswith(f".{VIDEO_MIME_TYPE}")
+            and os.path.splitext(os.path.basename(stored.key))[0].isdigit()
+        ),
+        key=lambda stored: get_blob_index(stored.key),
+    )
+
+
+def get_blob_index(blob_path: str) -> int:
+    """
+    Returns the index of a chunk file from its name.
+
+    Args:
+        blob_path (str): The path to the chunk file.
+
+    Returns:
+        int: The blob index.
+    """
+    return int(os.path.splitext(os.path.basename(blob_path))[0])
+
+
+def parse_range(
+    range_header: str | None, size: int
+) -> tuple[int, int] | None:
+    """
+    Parses a single byte range of a Range header.
+
+    Args:
+        range_header (str | None): The value of the Range header.
+        size (int): The total size of the resource.
+
+    Returns:
+        tuple[int, int] | None: The first and last byte of the range, both
+            inclusive, or None to send the whole resource.
+
+    Raises:
+        HTTPException: If the range can't be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+
+    # Multiple ranges are rare for media; serve the whole resource instead
+    ranges = range_header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        return None
+
+    first, _, last = ranges[0].strip().partition("-")
+    try:
+        if not first:
+            # A suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable.",
+            headers={"content-range": f"bytes */{size}"},
+        )
+
+    return start, end
+
+
+def iter_files(
+    files: list[str], sizes: list[int], start: int, end: int
+) -> Iterator[bytes]:
+    """
+    Yields the bytes `start..end` (inclusive) of files read back to back.
+
+    Args:
+        files (list[str]): The paths to the files, in order.
+        sizes (list[int]): The sizes of the files when the response began;
+            bytes appended afterwards are not sent.
+        start (int): The first byte to send.
+        end (int): The last byte to send.
+
+    Yields:
+        bytes: The next block of data.
+    """
+    offsets = [0, *accumulate(sizes)]
+    index = bisect_right(offsets, start) - 1
+    remaining = end - start + 1
+    position = start - offsets[index]
+
+    while remaining > 0 and index < len(files):
+        with open(files[index], "rb") as file:
+            file.seek(position)
+            left_in_file = sizes[index] - position
+            while remaining > 0 and left_in_file > 0:
+                block = file.read(min(READ_SIZE, remaining, left_in_file))
+                if not block:
+                    break
+                remaining -= len(block)
+                left_in_file -= len(block)
+                yield block
+        index += 1
+        position = 0
+
+
+def stream_files_response(
+    request: Request,
+    files: list[str],
+    media_type: str,
+    filename: str | None = None,
+) -> StreamingResponse:
+    """
+    Streams files back to back as a single resource, with Range support
+    mapped across file boundaries.
+
+    Args:
+        request (Request): The request object.
+        files (list[str]): The paths to the files, in order.
+        media_type (str): The media type of the resource.
+        filename (str | None, optional): The name to download the resource
+            as. Defaults to displaying it inline.
+
+    Returns:
+        StreamingResponse: The response streaming the files.
+    """
+    sizes = [os.path.getsize(path) for path in files]
+    size = sum(sizes)
+
+    headers = {"accept-ranges": "bytes"}
+    if filename:
+        headers["content-disposition"] = (
+            f"attachment; filename*=utf-8''{quote(filename)}"
+        )
+
+    byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+    else:
+        start, end = 0, size - 1
+        status_code = 200
+    headers["content-length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        iter_files(files, sizes, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def _read_file(path: str) -> bytes:
+    """Reads a whole file."""
+    with open(path, "rb") as file:
+        return file.read()
+
+
+async def tail_blobs(
+    username: str, video_id: str, idle_timeout: float
+) -> AsyncIterator[bytes]:
+    """
+    Yields the chunks of a recording in order as they are uploaded,
+    starting with the first one, `FIRST_BLOB_INDEX`.
+
+    The chunks already on disk are sent first; the stream then waits for
+    the next one until `save_blob` announces it on the broker, so the
+    directory is never polled. The stream ends once the recording is
+    merged or fails, or when no chunk arrives for `idle_timeout` seconds.
+
+    Args:
+        username (str): The user associated with the recording.
+        video_id (str): The ID of the recording.
+        idle_timeout (float): The number of seconds to wait for a chunk.
+
+    Yields:
+        bytes: The next chunk.
+    """
+    # Subscribe before looking for chunks so none falls between the two
+    subscription = broker.subscribe(video_topic(video_id))
+    try:
+        next_index = FIRST_BLOB_INDEX
+        finished = False
+
+        while True:
+            # Send every chunk that continues the stream. Checking on each
+            # event also recovers from events dropped by a full queue, and
+            # waits for the first chunk even if later ones arrive earlier.
+            while True:
+                blob_path = get_blob_path(username, video_id, next_index)
+                if not os.path.isfile(blob_path):
+                    break
+                yield await run_in_threadpool(_read_file, blob_path)
+                next_index += 1
+
+            if finished:
+                break
+
+            message = await subscription.get(idle_timeout)
+            if message is None:
+                break
+            if message["event"] in ("merged", "failed"):
+                finished = True
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def stored_file_response(
+    request: Request,
+    storage: Storage,
+    key: str,
+    media_type: str,
+    filename: str | None = None,
+) -> StreamingResponse:
+    """
+    Streams a file from a storage backend, with Range support, for nodes
+    that don't hold a local copy.
+
+    Args:
+        request (Request): The request object.
+        storage (Storage): The storage backend.
+        key (str): The key of the file.
+        media_type (str): The media type of the file.
+        filename (str | None, optional): The name to download the file as.
+            Defaults to displaying it inline.
+
+    Returns:
+        StreamingResponse: The response streaming the file.
+
+    Raises:
+        HTTPException: If the file is not stored.
+    """
+    size = storage.size(key)
+    if size is None:
+        raise HTTPException(status_code=404, detail="File not found.")
+
+    headers = {"accept-ranges": "bytes"}
+    if filename:
+        headers["content-disposition"] = (
+            f"attachment; filename*=utf-8''{quote(filename)}"
+        )
+
+    byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+    else:
+        start, end = 0, size - 1
+        status_code = 200
+    headers["content-length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        storage.stream(key, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
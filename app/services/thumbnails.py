@@ -0,0 +1,227 @@
+""" This module generates resized thumbnail variants in a bounded cache. """
+import glob
+import os
+import subprocess
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field
+
+from app.services.services import create_directory
+from app.settings import THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_DIR
+
+THUMBNAIL_FORMATS = {
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+# Requested widths are rounded up to one of these so the cache stays small
+THUMBNAIL_WIDTHS = (160, 320, 480, 640, 960, 1280)
+
+
+class VariantCache:
+    """
+    The variant files in a directory, bounded by their total size across
+    every process sharing the directory.
+
+    How recently a variant was used is kept in the access time of its
+    file, set on every use, so any process evicts the least recently used
+    variants first. A variant used in the last `pin_seconds` is pinned,
+    since its response may not have opened it yet, and is never evicted.
+    """
+
+    def __init__(
+        self, directory: str, max_bytes: int, pin_seconds: float = 60.0
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pin_seconds = pin_seconds
+
+    def touch(self, path: str) -> bool:
+        """
+        Marks a variant as recently used, which pins it.
+
+        Args:
+            path (str): The path to the variant.
+
+        Returns:
+            bool: True if the variant is on disk.
+        """
+        try:
+            # Keep the modification time, it tells if the variant is fresh
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def add(self, path: str) -> None:
+        """
+        Adds a new variant, pinned, and evicts the least recently used
+        ones if the directory grew past its bound.
+
+        Args:
+            path (str): The path to the variant.
+        """
+        self.touch(path)
+
+        variants = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                variants.append((stat.st_atime, entry.path, stat.st_size))
+                total += stat.st_size
+
+        pinned_after = time.time() - self.pin_seconds
+        for accessed, evicted, size in sorted(variants):
+            if total <= self.max_bytes or accessed >= pinned_after:
+                break
+            total -= size
+            try:
+                # Another process may have used it since the scan
+                if os.stat(evicted).st_atime < pinned_after:
+                    os.remove(evicted)
+            except FileNotFoundError:
+                pass
+
+    def discard(self, paths: list[str]) -> None:
+        """
+        Removes variants from disk.
+
+        Args:
+            paths (list[str]): The paths to the variants.
+        """
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@dataclass
+class _Generation:
+    """A variant being generated, and the requests waiting for it"""
+
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    waiters: int = 0
+
+
+variant_cache = VariantCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_MAX_BYTES)
+
+_inflight: dict[str, _Generation] = {}
+_inflight_lock = threading.Lock()
+
+
+def snap_width(width: int) -> int:
+    """
+    Rounds a requested width up to the nearest supported width.
+
+    Args:
+        width (int): The requested width in pixels.
+
+    Returns:
+        int: The supported width.
+    """
+    index = bisect_left(THUMBNAIL_WIDTHS, width)
+
+    return THUMBNAIL_WIDTHS[min(index, len(THUMBNAIL_WIDTHS) - 1)]
+
+
+def render_thumbnail_variant(
+    source_path: str, output_path: str, width: int, image_format: str
+) -> str:
+    """
+    Resizes and re-encodes a thumbnail using ffmpeg.
+
+    Args:
+        source_path (str): The path to the full-size thumbnail.
+        output_path (str): The path to the output variant.
+        width (int): The width of the variant in pixels.
+        image_format (str): Either "jpg" or "webp".
+
+    Returns:
+        str: The path to the variant.
+    """
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    quality = ["-quality", "75"] if image_format == "webp" else ["-q:v", "4"]
+    command = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        source_path,
+        "-vf",
+        f"scale='min({width},iw)':-2",
+        *quality,
+        "-f",
+        "webp" if image_format == "webp" else "mjpeg",
+        temp_path,
+    ]
+    subprocess.run(command, check=True, capture_output=True)
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+
+def get_thumbnail_variant(
+    video_id: str, source_path: str, width: int, image_format: str
+) -> str:
+    """
+    Returns a resized variant of a thumbnail, generating it on first
+    request. Concurrent first requests for the same variant wait for a
+    single generation. The variant is pinned in the cache, so it is
+    still there when the response opens it.
+
+    Args:
+        video_id (str): The ID of the video.
+        source_path (str): The path to the full-size thumbnail.
+        width (int): The requested width in pixels.
+        image_format (str): Either "jpg" or "webp".
+
+    Returns:
+        str: The path to the variant.
+    """
+    width = snap_width(width)
+    path = os.path.join(THUMBNAIL_DIR, f"{video_id}_{width}.{image_format}")
+
+    def is_fresh() -> bool:
+        return variant_cache.touch(path) and os.path.getmtime(
+            path
+        ) >= os.path.getmtime(source_path)
+
+    if is_fresh():
+        return path
+
+    # The entry goes once no request holds or waits for its lock
+    with _inflight_lock:
+        generation = _inflight.setdefault(path, _Generation())
+        generation.waiters += 1
+
+    try:
+        with generation.lock:
+            # Another request may have generated it while we waited
+            if not is_fresh():
+                create_directory(THUMBNAIL_DIR)
+                render_thumbnail_variant(
+                    source_path, path, width, image_format
+                )
+                variant_cache.add(path)
+    finally:
+        with _inflight_lock:
+            generation.waiters -= 1
+            if not generation.waiters:
+                _inflight.pop(path, None)
+
+    return path
+
+
+def delete_thumbnail_variants(video_id: str) -> None:
+    """
+    Deletes every cached variant of a video's thumbnail.
+
+    Args:
+        video_id (str): The ID of the video.
+    """
+    variant_cache.discard(
+        glob.glob(os.path.join(THUMBNAIL_DIR, f"{video_id}_*"))
+    )
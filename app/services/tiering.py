@@ -0,0 +1,435 @@
+""" This module moves videos nobody watches any more to cold storage.
+
+The streaming endpoints record accesses in memory, flushed to the videos
+table every ACCESS_FLUSH_INTERVAL. During the off-peak TIER_WINDOW, videos
+not accessed for TIER_COLD_AFTER_DAYS are re-encoded from their capture
+bitrate, moved under COLD_VIDEO_DIR, and the re-encode replaces the
+original in a single commit. Every run stops once TIER_BYTE_BUDGET bytes
+of originals were processed.
+
+Usage: python -m app.services.tiering [--dry-run] [--budget BYTES]
+"""
+import argparse
+import datetime
+import os
+import shutil
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app.models.video_models import Video
+from app.services.migrate_layout import LOCATION_COLUMNS, relocate
+from app.services.paths import get_cold_video_dir
+from app.services.services import compress_video
+from app.services.stats_service import (
+    add_video_bytes,
+    file_size,
+    get_video_directory,
+)
+from app.services.storage import (
+    get_storage,
+    is_remote_storage,
+    media_key,
+    publish_files,
+)
+from app.services.storage_gc import delete_merged_chunks
+from app.settings import (
+    TIER_BYTE_BUDGET,
+    TIER_COLD_AFTER_DAYS,
+    TIER_WINDOW,
+    VIDEO_MIME_TYPE,
+)
+
+# How long a claimed video is hidden from other runs, so it is demoted
+# later if the run holding it dies
+CLAIM_TIMEOUT = 6 * 3600
+
+_accesses: dict[str, float] = {}
+_accesses_lock = threading.Lock()
+
+
+def record_access(video_id: str) -> None:
+    """
+    Remembers that a video was watched. Nothing is written per request,
+    the timestamps reach the database with `flush_accesses`.
+
+    Args:
+        video_id (str): The ID of the video.
+    """
+    with _accesses_lock:
+        _accesses[video_id] = time.time()
+
+
+def flush_accesses(db: Session) -> int:
+    """
+    Writes the recorded access times to the videos table.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        int: The number of videos updated.
+    """
+    global _accesses  # pylint: disable=global-statement
+    with _accesses_lock:
+        accesses, _accesses = _accesses, {}
+
+    for video_id, timestamp in accesses.items():
+        accessed = datetime.datetime.utcfromtimestamp(timestamp)
+        db.query(Video).filter(Video.id == video_id).update(
+            {Video.last_accessed_date: accessed}, synchronize_session=False
+        )
+    db.commit()
+
+    return len(accesses)
+
+
+def flush_accesses_job() -> None:
+    """Scheduled entry point that persists the access times."""
+    db = next(get_db())
+    try:
+        flush_accesses(db)
+    finally:
+        db.close()
+
+
+@dataclass
+class TierReport:
+    """What a tiering run demoted, or would demote on a dry run"""
+
+    dry_run: bool = False
+    videos: int = 0
+    original_bytes: int = 0
+    encoded_bytes: int = 0
+    failed: int = 0
+
+    def __str__(self) -> str:
+        verb = "To demote" if self.dry_run else "Demoted"
+        return (
+            f"{verb}: {self.videos} videos, {self.original_bytes} bytes "
+            f"re-encoded to {self.encoded_bytes} bytes, "
+            f"{self.failed} failed"
+        )
+
+
+def in_window(window: str = TIER_WINDOW, hour: int | None = None) -> bool:
+    """
+    Checks if the current local hour is in an off-peak window.
+
+    Args:
+        window (str, optional): "start-end" hours, wrapping past midnight
+            when start > end. Empty for no restriction.
+        hour (int | None, optional): The hour to check, defaults to now.
+
+    Returns:
+        bool: True if tiering may run.
+    """
+    if not window:
+        return True
+
+    start, end = (int(part) for part in window.split("-"))
+    if hour is None:
+        hour = datetime.datetime.now().hour
+    if start <= end:
+        return start <= hour < end
+
+    return hour >= start or hour < end
+
+
+def find_cold_videos(db: Session, idle_days: int = TIER_COLD_AFTER_DAYS):
+    """
+    Returns a query of the hot videos not accessed for `idle_days`, the
+    longest idle first. Videos never accessed count from their creation,
+    videos claimed by another run are left out.
+
+    Args:
+        db (Session): The database session.
+        idle_days (int, optional): The days without access.
+
+    Returns:
+        Query: The videos to demote.
+    """
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(days=idle_days)
+    last_access = func.coalesce(Video.last_accessed_date, Video.created_date)
+
+    return (
+        db.query(Video)
+        .filter(
+            Video.status == "completed",
+            Video.storage_tier == "hot",
+            Video.original_location.isnot(None),
+            last_access < cutoff,
+            or_(
+                Video.tier_claimed_until.is_(None),
+                Video.tier_claimed_until < now,
+            ),
+        )
+        .order_by(last_access)
+    )
+
+
+def claim_video(db: Session, video: Video) -> bool:
+    """
+    Claims a hot video for this run, unless another run holds it or it
+    changed since it was selected.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video.
+
+    Returns:
+        bool: True if this run may demote the video.
+    """
+    now = datetime.datetime.utcnow()
+    claimed = (
+        db.query(Video)
+        .filter(
+            Video.id == video.id,
+            Video.storage_tier == "hot",
+            Video.original_location == video.original_location,
+            or_(
+                Video.tier_claimed_until.is_(None),
+                Video.tier_claimed_until < now,
+            ),
+        )
+        .update(
+            {
+                Video.tier_claimed_until: now
+                + datetime.timedelta(seconds=CLAIM_TIMEOUT)
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+
+    return bool(claimed)
+
+
+def release_video(db: Session, video_id: str) -> None:
+    """
+    Hands a claimed video back, like after a failed demotion.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the video.
+    """
+    db.query(Video).filter(Video.id == video_id).update(
+        {Video.tier_claimed_until: None}, synchronize_session=False
+    )
+    db.commit()
+
+
+def demote_video(db: Session, video: Video) -> int:
+    """
+    Re-encodes a claimed video and moves its directory to cold storage.
+    The re-encode only replaces the original when it is smaller; both
+    locations are swapped in the same commit that moves the video and
+    releases the claim, and the hot copy is deleted once committed. The
+    compressed copy, superseded by the re-encode, isn't kept.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The video.
+
+    Returns:
+        int: The size of the video file now stored.
+
+    Raises:
+        OSError: If the files could not be moved.
+        subprocess.CalledProcessError: If the re-encode failed.
+    """
+    original = video.original_location
+    compressed = video.compressed_location
+    hot_dir = os.path.abspath(get_video_directory(video))
+    cold_dir = os.path.abspath(get_cold_video_dir(video.id))
+    # The re-encode supersedes the compressed copy, it isn't moved along
+    compressed_in_dir = relocate(compressed, hot_dir, cold_dir) is not None
+    if os.path.exists(cold_dir):
+        # Left by a run that died before its commit, the claim rules out
+        # one still running
+        shutil.rmtree(cold_dir)
+        if is_remote_storage() and (cold_key := media_key(cold_dir)):
+            get_storage().delete_prefix(f"{cold_key}/")
+
+    # Verified chunks would no longer match the re-encode, drop them first
+    if delete_merged_chunks(db, video):
+        db.commit()
+
+    # Encoded next to the original, the hot volume is usually the fastest
+    encoded = compress_video(
+        original, os.path.join(hot_dir, f"{video.id}.cold"), VIDEO_MIME_TYPE
+    )
+    # Copied under a temporary name so a partial copy is never used
+    staging = f"{cold_dir}.{os.getpid()}.tmp"
+    try:
+        if file_size(encoded) >= file_size(original):
+            os.remove(encoded)
+            encoded = original
+
+        skipped = {os.path.basename(original), os.path.basename(encoded)}
+        if compressed_in_dir:
+            skipped.add(os.path.basename(compressed))
+        shutil.copytree(
+            hot_dir,
+            staging,
+            ignore=lambda _, names: [
+                name
+                for name in names
+                if name in skipped or name.endswith(".tmp")
+            ],
+        )
+        shutil.copyfile(
+            encoded, os.path.join(staging, os.path.basename(original))
+        )
+        os.rename(staging, cold_dir)
+    finally:
+        if encoded != original and os.path.exists(encoded):
+            os.remove(encoded)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # The video may have been deleted or moved while encoding
+    current = (
+        db.query(Video.original_location)
+        .filter(Video.id == video.id)
+        .scalar()
+    )
+    if current != original:
+        shutil.rmtree(cold_dir, ignore_errors=True)
+        raise OSError("the video changed while it was re-encoded")
+    db.refresh(video)
+
+    for column in LOCATION_COLUMNS:
+        location = relocate(getattr(video, column), hot_dir, cold_dir)
+        if location:
+            setattr(video, column, location)
+    stored = file_size(video.original_location)
+    dropped = file_size(compressed) if compressed_in_dir else 0
+    add_video_bytes(db, video, stored - file_size(original) - dropped)
+    video.compressed_location = None
+    video.content_digest = None
+    video.storage_tier = "cold"
+    video.tier_claimed_until = None
+    db.commit()
+
+    if compressed and not compressed_in_dir:
+        try:
+            os.remove(compressed)
+        except FileNotFoundError:
+            pass
+        if is_remote_storage() and (compressed_key := media_key(compressed)):
+            get_storage().delete(compressed_key)
+
+    # Republish before dropping the hot copies that are served meanwhile
+    if is_remote_storage():
+        publish_files(
+            [
+                os.path.join(root, name)
+                for root, _, files in os.walk(cold_dir)
+                for name in files
+            ],
+            video,
+        )
+        db.commit()
+        if hot_key := media_key(hot_dir):
+            get_storage().delete_prefix(f"{hot_key}/")
+    shutil.rmtree(hot_dir, ignore_errors=True)
+
+    return stored
+
+
+def demote_cold_videos(
+    db: Session,
+    budget: int = TIER_BYTE_BUDGET,
+    idle_days: int = TIER_COLD_AFTER_DAYS,
+    dry_run: bool = False,
+) -> TierReport:
+    """
+    Demotes the idle videos, longest idle first, until `budget` bytes of
+    originals were processed. The video crossing the budget is still
+    demoted, so a recording larger than the budget isn't stuck forever.
+
+    Args:
+        db (Session): The database session.
+        budget (int, optional): The bytes of originals to process.
+        idle_days (int, optional): The days without access.
+        dry_run (bool, optional): Only report what would be demoted.
+
+    Returns:
+        TierReport: The counts of what was (or would be) demoted.
+    """
+    report = TierReport(dry_run=dry_run)
+    flush_accesses(db)
+
+    for video in find_cold_videos(db, idle_days).all():
+        if report.original_bytes >= budget:
+            break
+
+        size = file_size(video.original_location)
+        if not size:
+            continue
+        if dry_run:
+            report.original_bytes += size
+            report.videos += 1
+            continue
+        if not claim_video(db, video):
+            continue
+        report.original_bytes += size
+
+        video_id = video.id
+        try:
+            report.encoded_bytes += demote_video(db, video)
+            report.videos += 1
+        except (OSError, subprocess.CalledProcessError) as err:
+            db.rollback()
+            release_video(db, video_id)
+            report.failed += 1
+            print(f"Failed to demote video {video_id}: {err}")
+
+    return report
+
+
+def demote_cold_videos_job() -> None:
+    """Scheduled entry point that demotes idle videos off-peak."""
+    if not in_window():
+        return
+
+    db = next(get_db())
+    try:
+        report = demote_cold_videos(db)
+        if report.videos or report.failed:
+            print(report)
+    finally:
+        db.close()
+
+
+def main():
+    """ The main function """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="report the videos to demote without touching them",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=TIER_BYTE_BUDGET,
+        help="the bytes of originals to re-encode in this run",
+    )
+    args = parser.parse_args()
+
+    db = next(get_db())
+    try:
+        print(demote_cold_videos(db, args.budget, dry_run=args.dry_run))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
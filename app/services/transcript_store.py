@@ -0,0 +1,365 @@
+""" This module reads and writes the compact transcript format.
+
+A compact transcript is a memory-mappable file made of a fixed header
+followed by little-endian columns:
+
+    word starts      float32[words]
+    word ends        float32[words]
+    word reach       float32[words]      (running maximum of the ends)
+    word offsets     uint32[words + 1]   (into the text blob)
+    utterance starts float32[utterances]
+    utterance ends   float32[utterances]
+    utterance reach  float32[utterances] (running maximum of the ends)
+    first words      uint32[utterances]
+    last words       uint32[utterances]  (exclusive)
+    text blob        utf-8 bytes of the punctuated words
+
+Time-range queries binary search the start columns in place. End times
+are not sorted, so the reach columns are binary searched instead to find
+the earlier entries still running at the start of a range.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+COMPACT_TRANSCRIPT_EXTENSION = "bin"
+HEADER = struct.Struct("<4sHHIII")
+MAGIC = b"HMOT"
+VERSION = 2
+
+# A pause longer than this splits utterances when Deepgram sent none
+UTTERANCE_GAP = 1.0
+
+
+def get_compact_path(transcript_location: str) -> str:
+    """
+    Returns the path of the compact transcript stored next to a JSON one.
+
+    Args:
+        transcript_location (str): The path to the JSON transcript.
+
+    Returns:
+        str: The path to the compact transcript.
+    """
+    base, _ = os.path.splitext(transcript_location)
+
+    return f"{base}.{COMPACT_TRANSCRIPT_EXTENSION}"
+
+
+def _running_max(ends: array) -> array:
+    """
+    Returns the latest end time of the entries up to every index.
+
+    Args:
+        ends (array): The end times of the entries.
+
+    Returns:
+        array: The running maximum of the end times.
+    """
+    latest = array("f", ends)
+    for index in range(1, len(latest)):
+        if latest[index] < latest[index - 1]:
+            latest[index] = latest[index - 1]
+
+    return latest
+
+
+def _split_utterances(
+    words: list[dict], starts: array
+) -> list[tuple[float, float, int, int]]:
+    """
+    Returns the utterances of a transcript as word index ranges.
+
+    Args:
+        words (list[dict]): The words of the transcript.
+        starts (array): The start times of the words.
+
+    Returns:
+        list[tuple[float, float, int, int]]: The start time, end time,
+            first word and exclusive last word of every utterance.
+    """
+    utterances = []
+    first = 0
+    for index in range(1, len(words) + 1):
+        if (
+            index == len(words)
+            or starts[index] - words[index - 1]["end"] > UTTERANCE_GAP
+        ):
+            utterances.append(
+                (words[first]["start"], words[index - 1]["end"], first, index)
+            )
+            first = index
+
+    return utterances
+
+
+def write_compact_transcript(
+    words: list[dict],
+    output_path: str,
+    utterances: list[dict] | None = None,
+) -> str:
+    """
+    Writes a transcript in the compact format.
+
+    Args:
+        words (list[dict]): The words of the transcript as returned by
+            Deepgram, each with a `word`, a `start` and an `end`.
+        output_path (str): The path to the output file.
+        utterances (list[dict] | None, optional): The utterances returned by
+            Deepgram, each with a `start` and an `end`. Defaults to
+            splitting the words on long pauses.
+
+    Returns:
+        str: The path to the compact transcript.
+    """
+    words = sorted(words, key=lambda word: word["start"])
+    starts = array("f", (word["start"] for word in words))
+    ends = array("f", (word["end"] for word in words))
+
+    # Store the punctuated words back to back in a single text blob
+    text = bytearray()
+    offsets = array("I", [0])
+    for word in words:
+        text += str(word.get("punctuated_word") or word["word"]).encode()
+        offsets.append(len(text))
+
+    if utterances:
+        utterance_rows = [
+            (
+                utterance["start"],
+                utterance["end"],
+                bisect_left(starts, utterance["start"] - 1e-3),
+                bisect_left(starts, utterance["end"]),
+            )
+            for utterance in sorted(utterances, key=lambda u: u["start"])
+        ]
+    else:
+        utterance_rows = _split_utterances(words, starts)
+
+    utterance_ends = array("f", (row[1] for row in utterance_rows))
+    columns = [
+        starts,
+        ends,
+        _running_max(ends),
+        offsets,
+        array("f", (row[0] for row in utterance_rows)),
+        utterance_ends,
+        _running_max(utterance_ends),
+        array("I", (row[2] for row in utterance_rows)),
+        array("I", (row[3] for row in utterance_rows)),
+    ]
+
+    # Write to a temporary file so readers never map a partial transcript
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                0,
+                len(words),
+                len(utterance_rows),
+                len(text),
+            )
+        )
+        for column in columns:
+            if sys.byteorder != "little":
+                column.byteswap()
+            column.tofile(file)
+        file.write(text)
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+
+def compact_from_json(transcript_location: str) -> str:
+    """
+    Writes the compact version of a JSON transcript next to it.
+
+    Args:
+        transcript_location (str): The path to the JSON transcript.
+
+    Returns:
+        str: The path to the compact transcript.
+    """
+    with open(transcript_location, "r", encoding="utf-8") as file:
+        data = json.load(file)
+
+    return write_compact_transcript(
+        data["words"],
+        get_compact_path(transcript_location),
+        data.get("utterances"),
+    )
+
+
+class CompactTranscript:
+    """A read-only, memory-mapped compact transcript"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self._mmap)
+        magic, version, _, words, utterances, text_size = HEADER.unpack_from(
+            view
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a compact transcript")
+
+        position = HEADER.size
+
+        def column(count: int, fmt: str) -> memoryview:
+            nonlocal position
+            section = view[position:position + 4 * count].cast(fmt)
+            position += 4 * count
+            return section
+
+        self.word_starts = column(words, "f")
+        self.word_ends = column(words, "f")
+        self._word_reach = column(words, "f")
+        self._word_offsets = column(words + 1, "I")
+        self.utterance_starts = column(utterances, "f")
+        self.utterance_ends = column(utterances, "f")
+        self._utterance_reach = column(utterances, "f")
+        self._first_words = column(utterances, "I")
+        self._last_words = column(utterances, "I")
+        self._text = view[position:position + text_size]
+
+    def __len__(self) -> int:
+        return len(self.word_starts)
+
+    def word(self, index: int) -> str:
+        """
+        Returns the punctuated text of a word.
+
+        Args:
+            index (int): The index of the word.
+
+        Returns:
+            str: The text of the word.
+        """
+        start = self._word_offsets[index]
+        end = self._word_offsets[index + 1]
+
+        return bytes(self._text[start:end]).decode()
+
+    @staticmethod
+    def _overlapping(
+        starts: memoryview,
+        ends: memoryview,
+        reach: memoryview,
+        t0: float,
+        t1: float,
+    ) -> list[int]:
+        """
+        Returns the indexes of the entries overlapping `[t0, t1]`.
+
+        Args:
+            starts (memoryview): The sorted start times of the entries.
+            ends (memoryview): The end times of the entries.
+            reach (memoryview): The running maximum of `ends`.
+            t0 (float): The start of the time range.
+            t1 (float): The end of the time range.
+
+        Returns:
+            list[int]: The indexes of the overlapping entries.
+        """
+        # Every entry before `low` ended before t0, a long one after it may
+        # still be running at t0 while shorter ones in between are not
+        low = bisect_left(reach, t0)
+
+        return [
+            index
+            for index in range(low, bisect_right(starts, t1))
+            if ends[index] >= t0
+        ]
+
+    def words_between(self, t0: float, t1: float) -> list[dict]:
+        """
+        Returns the words spoken between two times.
+
+        Args:
+            t0 (float): The start of the time range, in seconds.
+            t1 (float): The end of the time range, in seconds.
+
+        Returns:
+            list[dict]: The words with their start and end times.
+        """
+        return [
+            {
+                "word": self.word(index),
+                "start": round(self.word_starts[index], 3),
+                "end": round(self.word_ends[index], 3),
+            }
+            for index in self._overlapping(
+                self.word_starts, self.word_ends, self._word_reach, t0, t1
+            )
+        ]
+
+    def utterances_between(self, t0: float, t1: float) -> list[dict]:
+        """
+        Returns the utterances overlapping two times.
+
+        Args:
+            t0 (float): The start of the time range, in seconds.
+            t1 (float): The end of the time range, in seconds.
+
+        Returns:
+            list[dict]: The utterances with their start and end times.
+        """
+        return [
+            {
+                "transcript": " ".join(
+                    self.word(word)
+                    for word in range(
+                        self._first_words[index], self._last_words[index]
+                    )
+                ),
+                "start": round(self.utterance_starts[index], 3),
+                "end": round(self.utterance_ends[index], 3),
+            }
+            for index in self._overlapping(
+                self.utterance_starts,
+                self.utterance_ends,
+                self._utterance_reach,
+                t0,
+                t1,
+            )
+        ]
+
+
+@lru_cache(maxsize=64)
+def _open_cached(path: str, _mtime_ns: int) -> CompactTranscript:
+    """Opens a compact transcript, keyed on its modification time."""
+    return CompactTranscript(path)
+
+
+def open_compact_transcript(transcript_location: str) -> CompactTranscript:
+    """
+    Opens the compact version of a JSON transcript, creating it first for
+    transcripts generated before the compact format existed and rebuilding
+    it for ones written in an older version of the format. Open
+    transcripts are cached until the file changes.
+
+    Args:
+        transcript_location (str): The path to the JSON transcript.
+
+    Returns:
+        CompactTranscript: The memory-mapped compact transcript.
+    """
+    path = get_compact_path(transcript_location)
+    if not os.path.isfile(path):
+        compact_from_json(transcript_location)
+
+    try:
+        return _open_cached(path, os.stat(path).st_mtime_ns)
+    except ValueError:
+        compact_from_json(transcript_location)
+
+    return _open_cached(path, os.stat(path).st_mtime_ns)
@@ -0,0 +1,554 @@
+""" This module stores the chunks of a recording and finalizes it. """
+import binascii
+import datetime
+import hashlib
+import json
+import re
+import string
+import zlib
+
+from fastapi import HTTPException, Request
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.models.video_models import Video, VideoChunk
+from app.services.broker import publish_video_event
+from app.services.paths import get_blob_path
+from app.services.services import merge_blobs, save_blob, save_blob_file
+from app.services.stats_service import (
+    add_video_bytes,
+    file_size,
+    set_video_status,
+)
+from app.services.storage import is_remote_storage, media_key
+from app.settings import MAX_CHUNK_SIZE
+
+# How long a merge is claimed, so the recording is merged again soon if
+# the process merging it dies
+MERGE_LEASE = 300
+
+
+class Crc32:
+    """A hashlib-style wrapper around `zlib.crc32`"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        """Adds data to the checksum."""
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        """Returns the checksum as 8 hex digits."""
+        return f"{self.value:08x}"
+
+
+# Checksums a client may send with a chunk, as "<algorithm>:<hex digest>"
+CHECKSUM_ALGORITHMS = {"sha256": hashlib.sha256, "crc32": Crc32}
+
+
+class ChunkChecksum:
+    """
+    Verifies a chunk against the checksum sent by the client, hashing it
+    incrementally as it is written. Without a checksum from the client, a
+    CRC32 is computed for the chunk manifest.
+    """
+
+    def __init__(self, checksum: str | None = None):
+        algorithm, _, expected = (checksum or "crc32:").partition(":")
+        self.algorithm = algorithm.lower()
+        if self.algorithm not in CHECKSUM_ALGORITHMS or (
+            checksum and not expected
+        ):
+            raise ValueError(
+                "Checksums must look like sha256:<hex> or crc32:<hex>."
+            )
+        self.expected = expected.strip().lower() or None
+        self.hasher = CHECKSUM_ALGORITHMS[self.algorithm]()
+
+    def update(self, data: bytes) -> None:
+        """Adds data to the checksum."""
+        self.hasher.update(data)
+
+    def verify(self) -> None:
+        """
+        Checks the data hashed so far against the expected checksum.
+
+        Raises:
+            ValueError: If they don't match.
+        """
+        if self.expected and self.hasher.hexdigest() != self.expected:
+            raise ValueError("Checksum mismatch, please resend the chunk.")
+
+    @property
+    def digest(self) -> str:
+        """The checksum of the data, as "<algorithm>:<hex digest>"."""
+        return f"{self.algorithm}:{self.hasher.hexdigest()}"
+
+
+def chunk_digest(blob: bytes, checksum: str | None = None) -> str:
+    """
+    Verifies a chunk against the checksum sent by the client.
+
+    Args:
+        blob (bytes): The chunk data.
+        checksum (str | None, optional): The checksum sent by the client.
+
+    Returns:
+        str: The digest of the chunk for the chunk manifest.
+
+    Raises:
+        ValueError: If the chunk doesn't match its checksum.
+    """
+    verifier = ChunkChecksum(checksum)
+    verifier.update(blob)
+    verifier.verify()
+
+    return verifier.digest
+
+
+def get_chunk_manifest(db: Session, video_id: str) -> dict[int, tuple]:
+    """
+    Returns the chunks recorded for a recording.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the recording.
+
+    Returns:
+        dict[int, tuple]: The size and digest of every chunk, by index.
+    """
+    rows = db.query(
+        VideoChunk.blob_index, VideoChunk.size, VideoChunk.digest
+    ).filter(VideoChunk.video_id == video_id)
+
+    return {row.blob_index: (row.size, row.digest) for row in rows}
+
+
+def is_recorded_chunk(
+    db: Session,
+    video_id: str,
+    blob_index: int,
+    size: int | None,
+    digest: str,
+) -> bool:
+    """
+    Checks if an identical chunk was already stored, so a retry can be
+    acknowledged without writing it again.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the recording.
+        blob_index (int): The index of the chunk.
+        size (int | None): The size of the chunk, None if not known yet.
+        digest (str): The digest of the chunk.
+
+    Returns:
+        bool: True if the same chunk is in the manifest.
+    """
+    chunk = db.get(VideoChunk, (video_id, blob_index))
+    if not chunk or chunk.digest != digest:
+        return False
+
+    return size is None or chunk.size == size
+
+
+def record_chunk(
+    db: Session, video_id: str, blob_index: int, size: int, digest: str
+) -> None:
+    """
+    Adds a stored chunk to the manifest, replacing a previous copy.
+
+    Args:
+        db (Session): The database session.
+        video_id (str): The ID of the recording.
+        blob_index (int): The index of the chunk.
+        size (int): The size of the chunk.
+        digest (str): The digest of the chunk.
+    """
+    db.merge(
+        VideoChunk(
+            video_id=video_id, blob_index=blob_index, size=size, digest=digest
+        )
+    )
+
+
+def write_chunk(
+    username: str, video_id: str, blob_index: int, blob: bytes
+) -> int:
+    """
+    Saves a chunk of a recording through `save_blob`.
+
+    Args:
+        username (str): The user associated with the recording.
+        video_id (str): The ID of the recording.
+        blob_index (int): The index of the chunk.
+        blob (bytes): The chunk data.
+
+    Returns:
+        int: The number of bytes the recording grew by, accounting for a
+            previous copy of a retried chunk.
+    """
+    previous_size = file_size(get_blob_path(username, video_id, blob_index))
+    save_blob(username, video_id, blob_index, blob)
+
+    return len(blob) - previous_size
+
+
+def move_chunk(
+    username: str, video_id: str, blob_index: int, source_path: str
+) -> int:
+    """
+    Saves a chunk of a recording that was already written to a file.
+
+    Args:
+        username (str): The user associated with the recording.
+        video_id (str): The ID of the recording.
+        blob_index (int): The index of the chunk.
+        source_path (str): The path to the file.
+
+    Returns:
+        int: The number of bytes the recording grew by, accounting for a
+            previous copy of a retried chunk.
+    """
+    previous_size = file_size(get_blob_path(username, video_id, blob_index))
+    size = file_size(source_path)
+    save_blob_file(username, video_id, blob_index, source_path)
+
+    return size - previous_size
+
+
+def finalize_recording(db: Session, video: Video) -> tuple[str, bool]:
+    """
+    Merges the chunks of a recording, marks it as completed and announces
+    it. Concurrent and repeated calls for the same recording, from any
+    process, merge it only once: the merge is claimed for `MERGE_LEASE`
+    seconds with a conditional update, and the recording stays
+    "processing" until the merged file is committed. Calls arriving
+    during the merge are answered with a 409, to be retried.
+
+    Args:
+        db (Session): The database session.
+        video (Video): The recording.
+
+    Returns:
+        tuple[str, bool]: The path to the merged video, and whether this
+            call merged it; only then should the caller queue processing.
+
+    Raises:
+        HTTPException: If the recording has no chunks (404), or if another
+            call is merging it (409).
+    """
+    # Keep the chunk that came with the call whatever happens next
+    db.commit()
+
+    now = datetime.datetime.utcnow()
+    claimed = (
+        db.query(Video)
+        .filter(
+            Video.id == video.id,
+            Video.status == "processing",
+            or_(
+                Video.merge_claimed_until.is_(None),
+                Video.merge_claimed_until < now,
+            ),
+        )
+        .update(
+            {
+                Video.merge_claimed_until: now
+                + datetime.timedelta(seconds=MERGE_LEASE)
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    if not claimed:
+        # Another call merged it already, or is merging it
+        if video.status != "processing" and video.original_location:
+            return video.original_location, False
+        raise HTTPException(
+            status_code=409,
+            detail="The recording is being merged. Please retry.",
+            headers={"Retry-After": "1"},
+        )
+
+    previous_size = file_size(video.original_location)
+    digest = hashlib.sha256()
+    try:
+        merged_location = merge_blobs(video.username, video.id, digest)
+        if not merged_location:
+            raise HTTPException(
+                status_code=404,
+                detail="No blobs found. Please start recording again.",
+            )
+    except Exception:
+        db.rollback()
+        video.merge_claimed_until = None
+        db.commit()
+        raise
+
+    video.original_location = merged_location
+    # The merge leaves a copy in a remote backend, ready to be served
+    if is_remote_storage():
+        video.published_key = media_key(merged_location)
+    add_video_bytes(db, video, file_size(merged_location) - previous_size)
+    video.content_digest = digest.hexdigest()
+    video.merge_claimed_until = None
+    set_video_status(db, video, "completed")
+    db.commit()
+
+    publish_video_event(video.id, "merged", username=video.username)
+
+    return video.original_location, True
+
+
+# Bytes kept by the JSON envelope parser outside of the blob itself
+MAX_ENVELOPE_FIELDS_SIZE = 64 * 1024
+
+# Everything but the base64 alphabet, dropped before decoding
+_BASE64_ALPHABET = (string.ascii_letters + string.digits + "+/=").encode()
+_NOT_BASE64 = bytes(set(range(256)) - set(_BASE64_ALPHABET))
+
+_KEY = re.compile(rb'\s*"((?:[^"\\]|\\.)*)"\s*:\s*')
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+_SCALAR = re.compile(rb"[^,}\s]+(?=[,}\s])")
+_SEPARATOR = re.compile(rb"\s*([,}])")
+
+
+class ChunkEnvelopeParser:
+    """
+    Parses the JSON envelope of a legacy chunk upload incrementally.
+
+    The small fields are collected in `fields`; the base64 `blob_object`
+    is decoded in windows as it arrives and handed to `sink`, so the whole
+    chunk is never held in memory. When `skip_blob`, given the fields read
+    before the blob, returns True, the blob is passed over undecoded.
+    """
+
+    def __init__(self, sink, skip_blob=None):
+        self.sink = sink
+        self.skip_blob = skip_blob
+        self.fields: dict = {}
+        self.size = 0
+        self.done = False
+        self.skipped = False
+        self._buffer = b""
+        self._state = "start"
+        self._key = None
+        self._base64 = b""
+        self._escape = False
+
+    def feed(self, data: bytes) -> None:
+        """
+        Parses the next piece of the body.
+
+        Args:
+            data (bytes): The next piece of the body.
+
+        Raises:
+            ValueError: If the body is not a JSON object or the blob is not
+                valid base64.
+        """
+        while data and not self.done:
+            if self._state == "blob":
+                data = self._feed_blob(data)
+                continue
+
+            self._buffer += data
+            data = b""
+            self._parse_fields()
+            if self._state == "blob":
+                data, self._buffer = self._buffer, b""
+            elif len(self._buffer) > MAX_ENVELOPE_FIELDS_SIZE:
+                raise ValueError("Request fields are too large.")
+
+    def close(self) -> None:
+        """
+        Checks that the body was complete.
+
+        Raises:
+            ValueError: If the body ended early.
+        """
+        if not self.done or self._buffer.strip():
+            raise ValueError("Incomplete request body.")
+
+    def _parse_fields(self) -> None:
+        """Consumes the complete tokens at the start of the buffer."""
+        while True:
+            buffer = self._buffer
+            if self._state == "start":
+                stripped = buffer.lstrip()
+                if not stripped:
+                    return
+                if stripped[:1] != b"{":
+                    raise ValueError("Expected a JSON object.")
+                self._buffer = stripped[1:]
+                self._state = "key"
+            elif self._state == "key":
+                if buffer.lstrip()[:1] == b"}":
+                    self._buffer = buffer.lstrip()[1:]
+                    self.done = True
+                    return
+                match = _KEY.match(buffer)
+                if not match:
+                    return
+                self._key = json.loads(b'"' + match.group(1) + b'"')
+                self._buffer = buffer[match.end():]
+                self._state = "value"
+            elif self._state == "value":
+                buffer = self._buffer = buffer.lstrip()
+                if self._key == "blob_object" and buffer[:1] == b'"':
+                    self._buffer = buffer[1:]
+                    self._state = "blob"
+                    self.skipped = bool(
+                        self.skip_blob and self.skip_blob(self.fields)
+                    )
+                    return
+                match = _STRING.match(buffer) or _SCALAR.match(buffer)
+                if not match:
+                    return
+                self.fields[self._key] = json.loads(match.group(0))
+                self._buffer = buffer[match.end():]
+                self._state = "separator"
+            elif self._state == "separator":
+                match = _SEPARATOR.match(buffer)
+                if not match:
+                    return
+                self._buffer = buffer[match.end():]
+                if match.group(1) == b"}":
+                    self.done = True
+                    return
+                self._state = "key"
+
+    def _feed_blob(self, data: bytes) -> bytes:
+        """
+        Decodes the part of the blob string in `data`.
+
+        Args:
+            data (bytes): The next piece of the body.
+
+        Returns:
+            bytes: What follows the end of the blob string, if it ended.
+        """
+        # Base64 has no quotes, so the first one ends the string
+        end = data.find(b'"')
+        text, rest = (data, b"") if end < 0 else (data[:end], data[end + 1:])
+        if self.skipped:
+            if end >= 0:
+                self._end_blob()
+            return rest
+
+        # Dropping backslashes unescapes "\/"; escaped line breaks go too,
+        # including one split across two pieces of the body
+        if self._escape:
+            text = b"\\" + text
+        self._escape = text.endswith(b"\\")
+        if self._escape:
+            text = text[:-1]
+        text = text.replace(b"\\n", b"").replace(b"\\r", b"")
+
+        self._base64 += text.translate(None, _NOT_BASE64)
+        final = end >= 0
+        usable = len(self._base64) if final else len(self._base64) // 4 * 4
+        if usable:
+            try:
+                decoded = binascii.a2b_base64(self._base64[:usable])
+            except binascii.Error as err:
+                raise ValueError("Invalid base64 blob.") from err
+            self._base64 = self._base64[usable:]
+            self.size += len(decoded)
+            self.sink(decoded)
+
+        if final:
+            self._end_blob()
+        return rest
+
+    def _end_blob(self) -> None:
+        """Resumes parsing the fields after the blob string."""
+        # Only marks that the blob was there, its data went to the sink
+        self.fields["blob_object"] = b""
+        self._state = "separator"
+        self._buffer = b""
+
+
+async def receive_chunk_envelope(
+    request: Request, output_path: str, is_recorded=None
+) -> tuple[dict, str, bool]:
+    """
+    Reads a legacy `VideoBlob` JSON body, decoding `blob_object` straight
+    to a file so memory use doesn't grow with the chunk size. When the
+    client sends an `X-Chunk-Checksum` header, the decoded chunk is hashed
+    as it is written and verified at the end.
+
+    With a checksum, `is_recorded` is asked, given the fields before the
+    blob and the announced digest, whether the chunk is already stored; a
+    retried chunk is then acknowledged without decoding or writing it.
+    Parsing, and so the file writes and `is_recorded`, run in the
+    threadpool.
+
+    Args:
+        request (Request): The request carrying the body.
+        output_path (str): The path to write the decoded chunk to.
+        is_recorded (Callable[[dict, str], bool] | None, optional): Checks
+            the chunk manifest. Defaults to decoding every chunk.
+
+    Returns:
+        tuple[dict, str, bool]: The fields of the body, with an empty
+            `blob_object` if it was there, the digest of the chunk for the
+            chunk manifest, and whether the chunk was recognized as
+            already stored and skipped.
+
+    Raises:
+        HTTPException: If the body is malformed or doesn't match its
+            checksum (400), or if the chunk is larger than
+            `MAX_CHUNK_SIZE` (413).
+    """
+    # Base64 needs 4 characters per 3 bytes, plus room for the other fields
+    content_length = request.headers.get("content-length", "")
+    max_body = MAX_CHUNK_SIZE * 4 // 3 + MAX_ENVELOPE_FIELDS_SIZE
+    if content_length.isdigit() and int(content_length) > max_body:
+        raise HTTPException(status_code=413, detail="Chunk is too large.")
+
+    file = None
+    try:
+        verifier = ChunkChecksum(request.headers.get("x-chunk-checksum"))
+        announced = f"{verifier.algorithm}:{verifier.expected}"
+
+        def skip_blob(fields: dict) -> bool:
+            return bool(
+                verifier.expected
+                and is_recorded
+                and is_recorded(fields, announced)
+            )
+
+        def sink(data: bytes) -> None:
+            nonlocal file
+            if file is None:
+                file = open(output_path, "wb")
+            file.write(data)
+            verifier.update(data)
+
+        parser = ChunkEnvelopeParser(sink, skip_blob)
+        async for data in request.stream():
+            await run_in_threadpool(parser.feed, data)
+            if parser.size > MAX_CHUNK_SIZE:
+                raise HTTPException(
+                    status_code=413, detail="Chunk is too large."
+                )
+        parser.close()
+
+        if parser.skipped:
+            return parser.fields, announced, True
+        verifier.verify()
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
+    finally:
+        if file is not None:
+            await run_in_threadpool(file.close)
+
+    # An empty chunk still gets its file
+    if file is None:
+        await run_in_threadpool(lambda: open(output_path, "wb").close())
+
+    return parser.fields, verifier.digest, False
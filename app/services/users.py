@@ -0,0 +1,135 @@
+""" This module provisions the users created on their first recording. """
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from app.models.user_models import User, UserStats
+from app.models.video_models import Video
+from app.settings import DB_TYPE
+
+# Stored instead of a hash for users created by `start_recording`. It is
+# not a bcrypt hash, so no password matches it and nothing is hashed.
+ANONYMOUS_CREDENTIAL = "!anonymous"
+
+# Usernames known to exist, so repeat recordings skip the lookup. Other
+# workers may rename a user, so entries are trusted for a short while
+KNOWN_USERS_SIZE = 10_000
+KNOWN_USERS_TTL = 60.0
+_known_users: OrderedDict[str, float] = OrderedDict()
+_known_users_lock = threading.Lock()
+
+
+def is_anonymous_credential(hashed_password: str | bytes) -> bool:
+    """
+    Checks if a stored credential is the one of a provisioned user, who
+    has no password to log in with.
+
+    Args:
+        hashed_password (str | bytes): The stored credential.
+
+    Returns:
+        bool: True for the anonymous credential.
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode("utf-8", "replace")
+
+    return hashed_password == ANONYMOUS_CREDENTIAL
+
+
+def is_known_user(username: str) -> bool:
+    """
+    Checks if a user was recently seen to exist.
+
+    Args:
+        username (str): The name of the user.
+
+    Returns:
+        bool: True if the user is cached and the entry is still fresh.
+    """
+    with _known_users_lock:
+        seen = _known_users.get(username)
+        if seen is None or time.monotonic() - seen > KNOWN_USERS_TTL:
+            _known_users.pop(username, None)
+            return False
+        _known_users.move_to_end(username)
+
+    return True
+
+
+def ensure_user(db: Session, username: str) -> None:
+    """
+    Creates a user without a password unless it exists, in one statement.
+    The caller is responsible for committing, then for `remember_user`.
+
+    Args:
+        db (Session): The database session.
+        username (str): The name of the user.
+    """
+    if is_known_user(username):
+        return
+
+    values = {"username": username, "hashed_password": ANONYMOUS_CREDENTIAL}
+    if DB_TYPE == "mysql":
+        statement = mysql.insert(User).values(**values).prefix_with("IGNORE")
+    else:
+        statement = (
+            sqlite.insert(User)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["username"])
+        )
+    db.execute(statement)
+
+
+def remember_user(username: str) -> None:
+    """
+    Caches a username once the transaction that ensured it committed.
+
+    Args:
+        username (str): The name of the user.
+    """
+    with _known_users_lock:
+        _known_users[username] = time.monotonic()
+        _known_users.move_to_end(username)
+        if len(_known_users) > KNOWN_USERS_SIZE:
+            _known_users.popitem(last=False)
+
+
+def forget_user(username: str) -> None:
+    """
+    Drops a username from the cache of known users, e.g. once renamed or
+    when an insert shows that it no longer exists.
+
+    Args:
+        username (str): The name of the user.
+    """
+    with _known_users_lock:
+        _known_users.pop(username, None)
+
+
+def rename_user(db: Session, user: User, new_username: str) -> None:
+    """
+    Renames a user, with the videos and stats rows referencing them. The
+    caller is responsible for committing.
+
+    Args:
+        db (Session): The database session.
+        user (User): The user.
+        new_username (str): The new name of the user.
+    """
+    old_username = user.username
+    if DB_TYPE != "mysql":
+        # Tables created before `onupdate` don't cascade, so check their
+        # foreign keys at commit, once every row follows the user
+        db.execute(text("PRAGMA defer_foreign_keys=ON"))
+
+    user.username = new_username
+    db.flush()
+    for model in (Video, UserStats):
+        db.query(model).filter(model.username == old_username).update(
+            {model.username: new_username}, synchronize_session=False
+        )
+    forget_user(old_username)
@@ -14,14 +14,70 @@ VIDEO_MIME_TYPE = "webm"
 AUDIO_MIME_TYPE = "opus"
 MEDIA_DIR = "./media"
 VIDEO_DIR = f"{MEDIA_DIR}/uploads/"
+SHARDED_VIDEO_DIR = f"{MEDIA_DIR}/videos/"
+# "sharded" stores new videos in SHARDED_VIDEO_DIR, "legacy" in VIDEO_DIR
+MEDIA_LAYOUT = os.getenv("MEDIA_LAYOUT", "sharded")
 COMPRESSED_DIR = f"{MEDIA_DIR}/compressed/"
+# Videos nobody watched for a while are re-encoded and moved here, usually
+# a cheaper volume. Only files under MEDIA_DIR are published to S3
+COLD_VIDEO_DIR = os.getenv("COLD_VIDEO_DIR", f"{MEDIA_DIR}/cold/")
 THUMBNAIL_DIR = f"{MEDIA_DIR}/thumbnails/"
+# "local" keeps media in MEDIA_DIR only, "s3" also publishes it to a bucket
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_REDIRECT = os.getenv("STORAGE_REDIRECT", "false") == "true"
+STORAGE_PRESIGN_TTL = int(os.getenv("STORAGE_PRESIGN_TTL", "3600"))
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_REGION = os.getenv("S3_REGION")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+THUMBNAIL_CACHE_MAX_BYTES = int(
+    os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+LIST_THUMBNAIL_WIDTH = 320
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "5"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(min(os.cpu_count() or 1, 4)))
+)
+MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", str(32 * 1024 * 1024)))
+LIVE_TAIL_TIMEOUT = float(os.getenv("LIVE_TAIL_TIMEOUT", "60"))
+EVENT_KEEPALIVE_INTERVAL = float(os.getenv("EVENT_KEEPALIVE_INTERVAL", "15"))
+EVENT_BROKER_URL = os.getenv("EVENT_BROKER_URL")
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true") == "true"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false") == "true"
+# Signs the session cookie and the media tokens, shared by all the workers.
+# The app refuses to start without it
+SECRET_KEY = os.getenv("SECRET_KEY", "")
+MEDIA_TOKEN_TTL = int(os.getenv("MEDIA_TOKEN_TTL", "3600"))
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))
+# Every how many reconciliations the video sizes are rescanned from disk
+STATS_RESCAN_EVERY = int(os.getenv("STATS_RESCAN_EVERY", "24"))
+GC_INTERVAL = int(os.getenv("GC_INTERVAL", "3600"))
+GC_GRACE_PERIOD = int(os.getenv("GC_GRACE_PERIOD", "3600"))
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", str(24 * 3600)))
+ACCESS_FLUSH_INTERVAL = int(os.getenv("ACCESS_FLUSH_INTERVAL", "300"))
+TIER_INTERVAL = int(os.getenv("TIER_INTERVAL", "1800"))
+TIER_COLD_AFTER_DAYS = int(os.getenv("TIER_COLD_AFTER_DAYS", "30"))
+# Local hours, "start-end", during which tiering may run; empty for always
+TIER_WINDOW = os.getenv("TIER_WINDOW", "2-6")
+TIER_BYTE_BUDGET = int(os.getenv("TIER_BYTE_BUDGET", str(20 * 1024**3)))
 DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API")
 EMAIL_NAME = os.getenv("EMAIL_NAME")
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
 EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD")
 EMAIL_HOST = os.environ.get("EMAIL_HOST")
 EMAIL_PORT = os.environ.get("EMAIL_PORT")
+EMAIL_STARTTLS = os.getenv("EMAIL_STARTTLS", "true") == "true"
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "50"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "6"))
+MAIL_RETRY_DELAY = float(os.getenv("MAIL_RETRY_DELAY", "30"))
+MAIL_POLL_INTERVAL = float(os.getenv("MAIL_POLL_INTERVAL", "30"))
+MAIL_SMTP_IDLE_TIMEOUT = float(os.getenv("MAIL_SMTP_IDLE_TIMEOUT", "60"))
+# Sent messages are deleted from the outbox by the GC job after this long
+MAIL_RETENTION_DAYS = int(os.getenv("MAIL_RETENTION_DAYS", "30"))
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URL = "https://cofucan.tech/srce/api/google/callback/"
@@ -0,0 +1,166 @@
+""" This module benchmarks the compression of transcripts and JSON payloads.
+
+It reports, for every encoding and level, the bytes saved and the CPU time
+spent compressing and decompressing a synthetic transcript (precompressed
+once at generation time) and a video list page (compressed per request by
+the JSON compression middleware).
+
+Usage: python tests/bench_compression.py [number_of_words]
+"""
+import gzip
+import json
+import random
+import sys
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Configuration
+WORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+REPEAT = 5
+VOCABULARY = (
+    "so today I want to show you how the new dashboard works and where "
+    "you can find the reports we talked about in the last meeting"
+).split()
+
+
+def make_transcript(word_count: int) -> bytes:
+    """
+    Builds a transcript shaped like the JSON written by `convert_to_json`.
+
+    Args:
+        word_count (int): The number of words in the transcript.
+
+    Returns:
+        bytes: The transcript, indented like the stored file.
+    """
+    words = []
+    current = 0.0
+    for _ in range(word_count):
+        word = random.choice(VOCABULARY)
+        duration = random.uniform(0.1, 0.6)
+        words.append(
+            {
+                "word": word,
+                "start": round(current, 3),
+                "end": round(current + duration, 3),
+                "confidence": round(random.uniform(0.8, 1.0), 6),
+                "punctuated_word": word.capitalize(),
+            }
+        )
+        current += duration + 0.05
+
+    transcript = " ".join(word["word"] for word in words)
+    data = {"transcript": transcript, "words": words}
+    return json.dumps(data, indent=4).encode()
+
+
+def make_video_page() -> bytes:
+    """
+    Builds a payload shaped like a page of `/recording/user/{username}`.
+
+    Returns:
+        bytes: The JSON payload.
+    """
+    base = "https://api.helpmeout.tech"
+    videos = [
+        {
+            "id": f"video{index:010d}",
+            "username": "user13",
+            "title": f"Untitled Video video{index:010d}",
+            "created_date": "2023-10-05T12:00:00",
+            "original_location": f"{base}/stream/video{index:010d}",
+            "thumbnail_location": f"{base}/thumbnail/video{index:010d}",
+            "transcript_location": f"{base}/transcript/video{index:010d}",
+            "video_length": 123.4,
+            "status": "completed",
+            "is_public": True,
+        }
+        for index in range(6)
+    ]
+    page = {
+        "total_items": 42,
+        "items_per_page": 6,
+        "page": 1,
+        "total_pages": 7,
+        "videos": videos,
+    }
+    return json.dumps(page).encode()
+
+
+def codecs() -> list[tuple[str, callable, callable]]:
+    """
+    Returns the encodings to benchmark.
+
+    Returns:
+        list[tuple[str, callable, callable]]: The name, compress and
+            decompress functions of every encoding.
+    """
+    result = [
+        (
+            f"gzip-{level}",
+            lambda data, level=level: gzip.compress(data, level),
+            gzip.decompress,
+        )
+        for level in (1, 5, 9)
+    ]
+    if brotli:
+        result += [
+            (
+                f"br-{quality}",
+                lambda data, quality=quality: brotli.compress(
+                    data, quality=quality
+                ),
+                brotli.decompress,
+            )
+            for quality in (4, 11)
+        ]
+    return result
+
+
+def bench(name: str, payload: bytes):
+    """
+    Prints the compression ratio and timings of a payload.
+
+    Args:
+        name (str): The name of the payload.
+        payload (bytes): The payload to compress.
+    """
+    print(f"\n{name}: {len(payload):,} bytes")
+    print(
+        f"{'encoding':<10}{'bytes':>12}{'saved':>9}"
+        f"{'compress ms':>14}{'decompress ms':>16}"
+    )
+    for codec, compress, decompress in codecs():
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            compressed = compress(payload)
+        compress_ms = (time.perf_counter() - start) * 1000 / REPEAT
+
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            decompress(compressed)
+        decompress_ms = (time.perf_counter() - start) * 1000 / REPEAT
+
+        saved = 100 * (1 - len(compressed) / len(payload))
+        print(
+            f"{codec:<10}{len(compressed):>12,}{saved:>8.1f}%"
+            f"{compress_ms:>14.2f}{decompress_ms:>16.2f}"
+        )
+
+
+def main():
+    """ The main function """
+    random.seed(0)
+    bench(f"transcript ({WORDS:,} words)", make_transcript(WORDS))
+    bench("video list page", make_video_page())
+    if not brotli:
+        print("\nbrotli is not installed; only gzip was measured.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+""" This module benchmarks login throughput and latency under concurrency.
+
+Every level of concurrency sends a batch of logins for an existing user
+while a probe keeps requesting a cheap endpoint. The probe latency shows
+how much password hashing stalls the other requests of the worker.
+
+Usage: python tests/bench_login.py --local|--remote [username] [password]
+"""
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+# Configuration
+LOCAL_URL = "http://127.0.0.1:8000"
+REMOTE_URL = "https://api.helpmeout.tech"
+
+if len(sys.argv) < 2 or sys.argv[1] not in ("--local", "--remote"):
+    print("Invalid argument. Use '--local' or '--remote'")
+    sys.exit()
+
+URL = LOCAL_URL if sys.argv[1] == "--local" else REMOTE_URL
+USERNAME = sys.argv[2] if len(sys.argv) > 2 else "user13"
+PASSWORD = sys.argv[3] if len(sys.argv) > 3 else "Password1!"
+
+LOGIN_URL = f"{URL}/login/"
+PROBE_URL = f"{URL}/usage/user/{USERNAME}"
+
+CONCURRENCY = (1, 4, 16, 32)
+LOGINS_PER_LEVEL = 64
+
+
+def percentile(samples: list[float], percent: float) -> float:
+    """
+    Returns a percentile of latency samples.
+
+    Args:
+        samples (list[float]): The samples, in seconds.
+        percent (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, in milliseconds.
+    """
+    ordered = sorted(samples)
+    index = min(int(len(ordered) * percent / 100), len(ordered) - 1)
+    return ordered[index] * 1000
+
+
+def login(session: requests.Session) -> float:
+    """
+    Logs in once.
+
+    Args:
+        session (requests.Session): The HTTP session.
+
+    Returns:
+        float: The latency of the login, in seconds.
+    """
+    start = time.perf_counter()
+    response = session.post(
+        LOGIN_URL, json={"username": USERNAME, "password": PASSWORD}
+    )
+    latency = time.perf_counter() - start
+    if response.status_code != 200:
+        print(f"Login failed: {response.status_code} {response.text}")
+        sys.exit(1)
+    return latency
+
+
+def probe(stop: threading.Event, samples: list[float]):
+    """
+    Requests a cheap endpoint until stopped.
+
+    Args:
+        stop (threading.Event): Set to stop probing.
+        samples (list[float]): Receives the latencies, in seconds.
+    """
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        session.get(PROBE_URL)
+        samples.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+
+def bench(concurrency: int):
+    """
+    Prints the login throughput and latencies at a level of concurrency.
+
+    Args:
+        concurrency (int): The number of concurrent users.
+    """
+    sessions = [requests.Session() for _ in range(concurrency)]
+    probe_samples: list[float] = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe, args=(stop, probe_samples))
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(
+            executor.map(
+                lambda index: login(sessions[index % concurrency]),
+                range(LOGINS_PER_LEVEL),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    prober.join()
+
+    print(
+        f"{concurrency:>6}{LOGINS_PER_LEVEL / elapsed:>12.1f}"
+        f"{statistics.median(latencies) * 1000:>10.0f}"
+        f"{percentile(latencies, 99):>10.0f}"
+        f"{percentile(probe_samples, 99):>12.0f}"
+    )
+
+
+def main():
+    """ The main function """
+    # Warm up the connection and the server
+    login(requests.Session())
+
+    print(f"{LOGINS_PER_LEVEL} logins per level against {URL}")
+    print(
+        f"{'users':>6}{'logins/s':>12}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'probe p99':>12}"
+    )
+    for concurrency in CONCURRENCY:
+        bench(concurrency)
+
+
+if __name__ == "__main__":
+    main()
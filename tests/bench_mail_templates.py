@@ -0,0 +1,102 @@
+""" This module benchmarks the rendering of the mail templates.
+
+For every template it reports the time to render one email by compiling
+the MJML and parsing the mustache template on every call, as the mail
+service used to, and through the compiled template cache.
+
+Usage: python tests/bench_mail_templates.py [number_of_renders]
+"""
+import os
+import sys
+import time
+
+import pystache
+from mjml import mjml_to_html
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.services.mail_service import (  # noqa: E402
+    OTP_MAIL_TEMPLATE,
+    VIDEO_MAIL_TEMPLATE,
+    WELCOME_MAIL_TEMPLATE,
+    get_mail_template,
+    render_mail,
+)
+
+
+# Configuration
+RENDERS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+TEMPLATES = {
+    VIDEO_MAIL_TEMPLATE: {"username": "user13", "video_id": "abc123"},
+    OTP_MAIL_TEMPLATE: {"verification_code": "123456"},
+    WELCOME_MAIL_TEMPLATE: {
+        "username": "user13",
+        "link": "https://helpmeout.tech",
+    },
+}
+
+
+def render_uncached(path: str, context: dict) -> str:
+    """
+    Renders a template the way the mail service did before the cache.
+
+    Args:
+        path (str): The path of the MJML template.
+        context (dict): The values of the template variables.
+
+    Returns:
+        str: The HTML of the email.
+    """
+    with open(path, "rb") as file:
+        html = mjml_to_html(file).html
+    return pystache.render(html, context)
+
+
+def time_renders(render, path: str, context: dict, count: int) -> float:
+    """
+    Returns the mean time of a render function.
+
+    Args:
+        render: The render function.
+        path (str): The path of the MJML template.
+        context (dict): The values of the template variables.
+        count (int): The number of renders.
+
+    Returns:
+        float: The mean time per email, in milliseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        render(path, context)
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    """ The main function """
+    os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+    print(f"{RENDERS} renders per template")
+    print(
+        f"{'template':<22}{'uncached ms':>14}{'cached ms':>12}"
+        f"{'speedup':>10}"
+    )
+    for path, context in TEMPLATES.items():
+        # Both paths must produce the same email
+        assert render_uncached(path, context) == render_mail(path, context)
+
+        # Compiling is slow, so time fewer uncached renders
+        uncached = time_renders(
+            render_uncached, path, context, max(1, RENDERS // 20)
+        )
+        get_mail_template(path)
+        cached = time_renders(render_mail, path, context, RENDERS)
+
+        name = os.path.basename(path)
+        print(
+            f"{name:<22}{uncached:>14.3f}{cached:>12.3f}"
+            f"{uncached / cached:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
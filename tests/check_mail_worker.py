@@ -0,0 +1,219 @@
+""" This module checks the mail worker against a local SMTP server.
+
+It queues emails in a scratch database and delivers them with the worker
+to an aiosmtpd server on localhost, then checks that every message
+arrived once over a reused connection, that a rejected recipient or a
+message that can't be rendered fails without retry or holding up the
+others, that a reissued one-time code is sent again, that two workers
+sharing the outbox never send a message twice, and that old sent
+messages are pruned.
+
+Usage: python tests/check_mail_worker.py [number_of_emails]
+Requires aiosmtpd, which the app itself does not need.
+"""
+import datetime
+import os
+import sys
+import tempfile
+import threading
+
+from aiosmtpd.controller import Controller
+
+# Configuration
+EMAILS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+HOST = "127.0.0.1"
+PORT = 8025
+REJECTED = "reject@example.com"
+
+os.environ.update(
+    {
+        "EMAIL_HOST": HOST,
+        "EMAIL_PORT": str(PORT),
+        "EMAIL_STARTTLS": "false",
+        "EMAIL_ADDRESS": "noreply@helpmeout.tech",
+        "EMAIL_NAME": "HelpMeOut",
+    }
+)
+os.environ.pop("EMAIL_PASSWORD", None)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+# The database is created in the working directory, keep it out of the repo
+# but keep the templates reachable at their relative paths
+os.chdir(tempfile.mkdtemp())
+os.symlink(os.path.join(ROOT, "app"), "app")
+
+from app.database import get_db  # noqa: E402
+from app.models.mail_models import OutboxMail  # noqa: E402
+from app.services.mail_service import (  # noqa: E402
+    queue_mail,
+    queue_otp,
+    queue_welcome_mail,
+)
+from app.services.mail_worker import (  # noqa: E402
+    SmtpConnection,
+    deliver_outbox,
+    prune_sent_mail,
+)
+
+
+class RecordingHandler:
+    """An aiosmtpd handler keeping the messages and the connections"""
+
+    def __init__(self):
+        self.messages: list[str] = []
+        self.peers: set = set()
+        self.lock = threading.Lock()
+
+    async def handle_RCPT(  # pylint: disable=invalid-name
+        self, server, session, envelope, address, rcpt_options
+    ):
+        """Refuses the rejected address, accepts any other."""
+        if address == REJECTED:
+            return "550 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(  # pylint: disable=invalid-name
+        self, server, session, envelope
+    ):
+        """Records the recipients and the client of a message."""
+        with self.lock:
+            self.messages.extend(envelope.rcpt_tos)
+            self.peers.add(session.peer)
+        return "250 Message accepted for delivery"
+
+
+def queue(db, prefix: str, count: int) -> list[str]:
+    """
+    Queues welcome emails, each twice to check the deduplication.
+
+    Args:
+        db: The database session.
+        prefix (str): Makes the usernames unique across checks.
+        count (int): The number of distinct emails.
+
+    Returns:
+        list[str]: The recipients.
+    """
+    recipients = [f"{prefix}{i}@example.com" for i in range(count)]
+    for _ in range(2):
+        for i, recipient in enumerate(recipients):
+            queue_welcome_mail(db, recipient, f"{prefix}{i}")
+    return recipients
+
+
+def deliver_all(connection: SmtpConnection) -> None:
+    """Delivers until no message was attempted."""
+    while deliver_outbox(connection, limit=7):
+        pass
+
+
+def check(condition: bool, message: str) -> bool:
+    """Prints the outcome of a check."""
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    return condition
+
+
+def main():
+    """ The main function """
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname=HOST, port=PORT)
+    controller.start()
+    db = next(get_db())
+    passed = True
+    try:
+        # One worker, one connection for the whole outbox
+        queue_mail(db, "broken", "broken@example.com", "", "missing", {})
+        recipients = queue(db, "single", EMAILS)
+        queue_welcome_mail(db, REJECTED, "rejected")
+        connection = SmtpConnection()
+        deliver_all(connection)
+        connection.close()
+
+        passed &= check(
+            sorted(handler.messages) == sorted(recipients),
+            f"{len(handler.messages)}/{EMAILS} emails delivered once",
+        )
+        passed &= check(
+            len(handler.peers) == 1,
+            f"{len(handler.peers)} SMTP connection(s) used",
+        )
+        rejected = (
+            db.query(OutboxMail)
+            .filter(OutboxMail.recipient == REJECTED)
+            .one()
+        )
+        passed &= check(
+            rejected.status == "failed" and rejected.attempts == 1,
+            f"rejected recipient {rejected.status} after "
+            f"{rejected.attempts} attempt(s)",
+        )
+        broken = (
+            db.query(OutboxMail)
+            .filter(OutboxMail.dedupe_key == "broken")
+            .one()
+        )
+        passed &= check(
+            broken.status == "failed" and broken.attempts == 1,
+            f"unknown template {broken.status} after "
+            f"{broken.attempts} attempt(s)",
+        )
+
+        # The same code issued twice is sent twice
+        handler.messages.clear()
+        for _ in range(2):
+            queue_otp(db, "otp@example.com", "123456", "OTP")
+        connection = SmtpConnection()
+        deliver_all(connection)
+        connection.close()
+        passed &= check(
+            handler.messages == ["otp@example.com"] * 2,
+            f"reissued code sent {len(handler.messages)} time(s)",
+        )
+
+        # Two workers sharing the outbox
+        handler.messages.clear()
+        recipients = queue(db, "shared", EMAILS)
+        connections = [SmtpConnection(), SmtpConnection()]
+        workers = [
+            threading.Thread(target=deliver_all, args=(connection,))
+            for connection in connections
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for connection in connections:
+            connection.close()
+
+        passed &= check(
+            sorted(handler.messages) == sorted(recipients),
+            f"{len(handler.messages)}/{EMAILS} emails delivered once by "
+            "two workers",
+        )
+
+        # Sent messages are pruned after their retention
+        db.query(OutboxMail).filter(
+            OutboxMail.recipient.like("single%")
+        ).update(
+            {
+                "sent_date": datetime.datetime.utcnow()
+                - datetime.timedelta(days=365)
+            },
+            synchronize_session=False,
+        )
+        pruned = prune_sent_mail(db)
+        db.commit()
+        passed &= check(
+            pruned == EMAILS and db.query(OutboxMail).count() > 0,
+            f"{pruned}/{EMAILS} old sent emails pruned",
+        )
+    finally:
+        db.close()
+        controller.stop()
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+""" This module checks the S3 storage backend against a local stand-in.
+
+It stores the chunks of a recording with the S3 backend, drops part of
+them from the local disk as if another node had received them, and
+finalizes the recording. It then checks that the merge composed every
+chunk in the bucket with a multipart upload, that reclaiming the chunks
+empties the bucket of them, and that serving the video redirects to a
+presigned URL without asking the bucket first.
+
+The bucket is mocked in process by moto, or lives on an S3-compatible
+server like MinIO when S3_ENDPOINT_URL is set, with credentials in the
+usual AWS_* variables.
+
+Usage: python tests/check_storage.py [number_of_chunks]
+Requires boto3, and moto without S3_ENDPOINT_URL.
+"""
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+
+# Configuration
+CHUNKS = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+SMALL_CHUNK = 300 * 1024
+LARGE_CHUNK = 6 * 1024 * 1024
+BUCKET = os.getenv("S3_BUCKET", "helpmeout-check")
+
+os.environ.update(
+    {
+        "STORAGE_BACKEND": "s3",
+        "STORAGE_REDIRECT": "true",
+        "S3_BUCKET": BUCKET,
+        "S3_REGION": os.getenv("S3_REGION", "us-east-1"),
+    }
+)
+if not os.getenv("S3_ENDPOINT_URL"):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+# The database and media are created in the working directory, keep them
+# out of the repo
+os.chdir(tempfile.mkdtemp())
+
+from app.database import get_db  # noqa: E402
+from app.models.user_models import User  # noqa: E402
+from app.models.video_models import Video  # noqa: E402
+from app.routes.video_routes import _media_response  # noqa: E402
+from app.services.paths import get_blob_path  # noqa: E402
+from app.services.storage import get_storage, media_key  # noqa: E402
+from app.services.storage_gc import delete_merged_chunks  # noqa: E402
+from app.services.streaming import list_published_blobs  # noqa: E402
+from app.services.uploads import finalize_recording, write_chunk  # noqa
+
+
+def mocked_bucket():
+    """Mocks S3 in process unless a real endpoint is configured."""
+    if os.getenv("S3_ENDPOINT_URL"):
+        return contextlib.nullcontext()
+
+    from moto import mock_aws  # pylint: disable=import-outside-toplevel
+
+    return mock_aws()
+
+
+def make_chunks(count: int) -> list[bytes]:
+    """
+    Returns the chunks of a recording: a first one larger than the
+    minimum part size, copied within the bucket, then small ones, like
+    browsers send, uploaded from buffers.
+
+    Args:
+        count (int): The number of chunks.
+
+    Returns:
+        list[bytes]: The chunks.
+    """
+    return [
+        os.urandom(LARGE_CHUNK if i == 0 else SMALL_CHUNK)
+        for i in range(count)
+    ]
+
+
+def count_calls(storage, operation: str) -> list:
+    """Records the calls of a client operation into the returned list."""
+    calls = []
+    storage.client.meta.events.register(
+        f"before-call.s3.{operation}", lambda **_: calls.append(operation)
+    )
+    return calls
+
+
+def check(condition: bool, message: str) -> bool:
+    """Prints the outcome of a check."""
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    return condition
+
+
+def main():
+    """ The main function """
+    with mocked_bucket():
+        storage = get_storage()
+        with contextlib.suppress(storage.client.exceptions.ClientError):
+            storage.client.create_bucket(Bucket=BUCKET)
+        passed = run_checks(storage)
+
+    sys.exit(0 if passed else 1)
+
+
+def run_checks(storage) -> bool:
+    """
+    Runs the checks against the bucket.
+
+    Args:
+        storage (S3Storage): The storage backend.
+
+    Returns:
+        bool: True if every check passed.
+    """
+    db = next(get_db())
+    passed = True
+    try:
+        db.add(User(username="storage", hashed_password="x"))
+        video = Video(id="storagecheck", username="storage", title="Check")
+        db.add(video)
+        db.commit()
+
+        chunks = make_chunks(CHUNKS)
+        for index, chunk in enumerate(chunks):
+            write_chunk(video.username, video.id, index, chunk)
+
+        # Every other chunk only reached the bucket through another node
+        for index in range(1, CHUNKS, 2):
+            os.remove(get_blob_path(video.username, video.id, index))
+
+        uploads = count_calls(storage, "UploadPartCopy")
+        location, merged = finalize_recording(db, video)
+        expected = b"".join(chunks)
+        with open(location, "rb") as file:
+            local = file.read()
+        stored = storage.get_range(media_key(location))
+
+        passed &= check(
+            merged and local == expected and stored == expected,
+            f"{CHUNKS} chunks merged in the bucket, {len(expected)} bytes",
+        )
+        passed &= check(
+            len(uploads) == 1,
+            f"{len(uploads)} large chunk(s) copied within the bucket",
+        )
+        passed &= check(
+            video.content_digest == hashlib.sha256(expected).hexdigest()
+            and video.published_key == media_key(location),
+            "merged video hashed and recorded as published",
+        )
+        passed &= check(
+            storage.get_range(media_key(location), 10, 19)
+            == expected[10:20],
+            "byte range read from the bucket",
+        )
+
+        heads = count_calls(storage, "HeadObject")
+        response = _media_response(
+            None,
+            location,
+            "video/webm",
+            published_key=video.published_key,
+        )
+        passed &= check(
+            response.status_code == 307 and not heads,
+            f"served by a presigned URL after {len(heads)} HEAD request(s)",
+        )
+
+        freed = delete_merged_chunks(db, video)
+        db.commit()
+        directory = os.path.dirname(location)
+        left = list_published_blobs(storage, directory)
+        passed &= check(
+            freed and not left and storage.size(media_key(location)),
+            f"chunks reclaimed from the bucket, {len(left)} left",
+        )
+    finally:
+        db.close()
+
+    return passed
+
+
+if __name__ == "__main__":
+    main()